@@ -1,26 +1,35 @@
 import uuid
+from dataclasses import asdict
+from datetime import datetime
+from typing import AsyncIterator, Mapping, Sequence
 
+from fastapi import UploadFile
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from api.dependencies import PaginationParameters
 from models.db import MessageStates
-from models.schemas.customer import CustomerCreate, ShowCustomer, ShowCustomers, CustomerEdit
-from models.schemas.mailing import (
-    MailingCreate,
-    ShowMailing,
-    MailingEdit,
-    ShowMailingAPIResponse,
-    ShowStatisticsByMailing,
-    ShowStatisticsMailings
-)
+from models.schemas.customer import CustomerCreate, ShowCustomer, ShowCustomers, CustomerEdit, ShowCustomersImport
+from models.schemas.mailing import MailingCreate, ShowMailing, MailingEdit, ShowMailingAPIResponse
 from models.schemas.message import ShowMessages, ShowMessage, CreateMessage
+from models.schemas.service import ShowPoolStatus, RateLimitEdit, ShowRateLimits, ShowCacheStats
+from repository.redis_client import get_redis
+from repository.session import get_pool_status
 from services.customer import CustomerDAL
 from services.mailing import MailingDAL
 from services.message import MessageDAL
+from utils.cache import get_cache_stats
+from utils.cursor import encode_cursor
+from utils.file_utils import FileFormats, iter_upload_lines, serialize_rows
+from utils.metrics import render_metrics
+from utils.rate_limit import get_rate_limiter
 from utils.time_utils import get_current_date
+from utils.validation import validate_rate_limit_name
 
 
-async def create_customer_controller(body: CustomerCreate, session: AsyncSession) -> ShowCustomer:
+async def create_customer_controller(body: CustomerCreate, session: AsyncSession) -> ORJSONResponse:
     """
     Creates a buyer in the database.
     :param body:
@@ -29,22 +38,39 @@ async def create_customer_controller(body: CustomerCreate, session: AsyncSession
     """
     customer_dal = CustomerDAL(session)
     customer = await customer_dal.create_customer(**body.dict())
-    return ShowCustomer(**customer.__dict__)
+    return _trusted_response(ShowCustomer.from_db(customer))
 
 
-async def get_customers_controller(session: AsyncSession, paginator: PaginationParameters) -> ShowCustomers:
+async def get_customers_controller(session: AsyncSession, paginator: PaginationParameters) -> ORJSONResponse:
     """
-    Outputs a list of customers from the database.
+    Outputs a page of customers from the database and the cursor of the next page.
     :param paginator:
     :param session:
     :return:
     """
     customer_dal = CustomerDAL(session)
-    customers = await customer_dal.get_customers(**paginator.__dict__)
-    return ShowCustomers(customers=[ShowCustomer(**customer.__dict__) for customer in customers])
+    customers = list(await customer_dal.get_customers(limit=paginator.limit + 1, after=paginator.after))
+    next_cursor = None
+    if len(customers) > paginator.limit:
+        next_cursor = encode_cursor(customers[paginator.limit - 1].customer_id)
+    return _trusted_response(ShowCustomers.construct(
+        customers=[ShowCustomer.from_db(customer) for customer in customers[:paginator.limit]],
+        next_cursor=next_cursor
+    ))
 
 
-async def edit_customer_controller(body: CustomerEdit, session: AsyncSession) -> ShowCustomer:
+async def import_customers_controller(file: UploadFile, file_format: FileFormats) -> ShowCustomersImport:
+    """
+    Streams customers from the uploaded file into the database.
+    :param file:
+    :param file_format:
+    :return:
+    """
+    stats = await CustomerDAL.import_customers(iter_upload_lines(file), file_format)
+    return ShowCustomersImport(**asdict(stats))
+
+
+async def edit_customer_controller(body: CustomerEdit, session: AsyncSession) -> ORJSONResponse:
     """
     Changes the value of the buyer in the database.
     :param body:
@@ -53,10 +79,10 @@ async def edit_customer_controller(body: CustomerEdit, session: AsyncSession) ->
     """
     customer_dal = CustomerDAL(session)
     customer = await customer_dal.edit_customer(**body.dict())
-    return ShowCustomer(**customer.__dict__)
+    return _trusted_response(ShowCustomer.from_db(customer))
 
 
-async def delete_customer_controller(id: uuid.UUID, session: AsyncSession) -> ShowCustomer:
+async def delete_customer_controller(id: uuid.UUID, session: AsyncSession) -> ORJSONResponse:
     """
     Deletes the customer from the database.
     :param id:
@@ -65,10 +91,10 @@ async def delete_customer_controller(id: uuid.UUID, session: AsyncSession) -> Sh
     """
     customer_dal = CustomerDAL(session)
     customer = await customer_dal.delete_customer(id=id)
-    return ShowCustomer(**customer.__dict__)
+    return _trusted_response(ShowCustomer.from_db(customer))
 
 
-async def create_mailing_controller(body: MailingCreate, session: AsyncSession) -> ShowMailing:
+async def create_mailing_controller(body: MailingCreate, session: AsyncSession) -> ORJSONResponse:
     """
     Creates a mailing list in a database.
     :param body:
@@ -77,10 +103,10 @@ async def create_mailing_controller(body: MailingCreate, session: AsyncSession)
     """
     mailing_dal = MailingDAL(session)
     mailing = await mailing_dal.create_mailing(**body.dict())
-    return ShowMailing(**mailing.__dict__)
+    return _trusted_response(ShowMailing.from_db(mailing))
 
 
-async def edit_mailing_controller(body: MailingEdit, session: AsyncSession) -> ShowMailing:
+async def edit_mailing_controller(body: MailingEdit, session: AsyncSession) -> ORJSONResponse:
     """
     Changes the mailing list in the database.
     :param body:
@@ -89,10 +115,10 @@ async def edit_mailing_controller(body: MailingEdit, session: AsyncSession) -> S
     """
     mailing_dal = MailingDAL(session)
     mailing = await mailing_dal.edit_mailing(**body.dict())
-    return ShowMailing(**mailing.__dict__)
+    return _trusted_response(ShowMailing.from_db(mailing))
 
 
-async def delete_mailing_controller(mailing_id: uuid.UUID, session: AsyncSession) -> ShowMailing:
+async def delete_mailing_controller(mailing_id: uuid.UUID, session: AsyncSession) -> ORJSONResponse:
     """
     Deletes the mailing list in the database.
     :param mailing_id:
@@ -101,7 +127,7 @@ async def delete_mailing_controller(mailing_id: uuid.UUID, session: AsyncSession
     """
     mailing_dal = MailingDAL(session)
     mailing = await mailing_dal.delete_mailing(mailing_id=mailing_id)
-    return ShowMailing(**mailing.__dict__)
+    return _trusted_response(ShowMailing.from_db(mailing))
 
 
 async def send_mailing_controller(mailing_id: uuid.UUID, session: AsyncSession) -> ShowMailingAPIResponse:
@@ -119,7 +145,7 @@ async def send_mailing_controller(mailing_id: uuid.UUID, session: AsyncSession)
 async def get_mailing_statistics_by_id_controller(
         mailing_id: uuid.UUID,
         session: AsyncSession
-) -> ShowStatisticsByMailing:
+) -> ORJSONResponse:
     """
     Outputs mailing statistics from the database.
     :param mailing_id:
@@ -127,32 +153,38 @@ async def get_mailing_statistics_by_id_controller(
     :return:
     """
     mailing_dal = MailingDAL(session)
-    return await mailing_dal.get_statistics_by_mailing(mailing_id)
+    return _trusted_response(await mailing_dal.get_statistics_by_mailing(mailing_id))
 
 
-async def get_statistics_mailings_controller(session: AsyncSession) -> ShowStatisticsMailings:
+async def get_statistics_mailings_controller(session: AsyncSession) -> ORJSONResponse:
     """
     Outputs statistics on all mailings from the database.
     :param session:
     :return:
     """
     mailing_dal = MailingDAL(session)
-    return await mailing_dal.get_statistics_mailings()
+    return _trusted_response(await mailing_dal.get_statistics_mailings())
 
 
-async def get_messages_controller(session: AsyncSession, paginator: PaginationParameters) -> ShowMessages:
+async def get_messages_controller(session: AsyncSession, paginator: PaginationParameters) -> ORJSONResponse:
     """
-    Outputs a list of all messages from the database.
+    Outputs a page of messages from the database and the cursor of the next page.
     :param paginator:
     :param session:
     :return:
     """
     message_dal = MessageDAL(session)
-    messages = await message_dal.get_messages(**paginator.__dict__)
-    return ShowMessages(messages=[ShowMessage(**message.__dict__) for message in messages])
+    messages = list(await message_dal.get_messages(limit=paginator.limit + 1, after=paginator.after))
+    next_cursor = None
+    if len(messages) > paginator.limit:
+        next_cursor = encode_cursor(messages[paginator.limit - 1].message_id)
+    return _trusted_response(ShowMessages.construct(
+        messages=[ShowMessage.from_db(message) for message in messages[:paginator.limit]],
+        next_cursor=next_cursor
+    ))
 
 
-async def create_message_controller(body: CreateMessage, session: AsyncSession) -> ShowMessage:
+async def create_message_controller(body: CreateMessage, session: AsyncSession) -> ORJSONResponse:
     """
     Creates a message in the database.
     :param body:
@@ -166,4 +198,150 @@ async def create_message_controller(body: CreateMessage, session: AsyncSession)
         mailing_id=body.mailing_id,
         customer_id=body.customer_id
     )
-    return ShowMessage(**message.__dict__)
+    return _trusted_response(ShowMessage.from_db(message))
+
+
+async def export_customers_controller(
+        session: AsyncSession,
+        file_format: FileFormats,
+        code: int | None = None
+) -> StreamingResponse:
+    """
+    Streams customers from the database into a file.
+    :param session:
+    :param file_format:
+    :param code:
+    :return:
+    """
+    customer_dal = CustomerDAL(session)
+    customers = customer_dal.stream_customers(code=code)
+    return _export_response(customers, file_format, ('customer_id', 'phone', 'code', 'time_zone'), 'customers')
+
+
+async def export_messages_controller(
+        session: AsyncSession,
+        file_format: FileFormats,
+        mailing_id: uuid.UUID | None = None,
+        status: MessageStates | None = None,
+        date_from: datetime | None = None,
+        date_to: datetime | None = None
+) -> StreamingResponse:
+    """
+    Streams messages from the database into a file.
+    :param session:
+    :param file_format:
+    :param mailing_id:
+    :param status:
+    :param date_from:
+    :param date_to:
+    :return:
+    """
+    message_dal = MessageDAL(session)
+    messages = message_dal.stream_messages(mailing_id=mailing_id, status=status, date_from=date_from, date_to=date_to)
+    fields = ('message_id', 'sending_date', 'status', 'mailing_id', 'customer_id')
+    return _export_response(messages, file_format, fields, 'messages')
+
+
+async def export_mailing_results_controller(
+        mailing_id: uuid.UUID,
+        session: AsyncSession,
+        file_format: FileFormats,
+        status: MessageStates | None = None
+) -> StreamingResponse:
+    """
+    Streams delivery results of the mailing from the database into a file.
+    :param mailing_id:
+    :param session:
+    :param file_format:
+    :param status:
+    :return:
+    """
+    message_dal = MessageDAL(session)
+    results = message_dal.stream_mailing_results(mailing_id=mailing_id, status=status)
+    fields = ('message_id', 'customer_id', 'phone', 'code', 'status', 'sending_date')
+    return _export_response(results, file_format, fields, f'mailing_{mailing_id}')
+
+
+def _export_response(
+        rows: AsyncIterator[Mapping],
+        file_format: FileFormats,
+        fields: Sequence[str],
+        filename: str
+) -> StreamingResponse:
+    """
+    Packs the rows into a streaming file response.
+    :param rows:
+    :param file_format:
+    :param fields:
+    :param filename:
+    :return:
+    """
+    return StreamingResponse(
+        serialize_rows(rows, file_format, fields),
+        media_type=file_format.media_type,
+        headers={'Content-Disposition': f'attachment; filename="{filename}.{file_format.value}"'}
+    )
+
+
+async def get_db_pool_status_controller() -> ShowPoolStatus:
+    """
+    Outputs the usage of the database connection pool.
+    :return:
+    """
+    return ShowPoolStatus(**get_pool_status())
+
+
+async def get_cache_stats_controller() -> ShowCacheStats:
+    """
+    Outputs hit and miss counters of the cache tiers of the process.
+    :return:
+    """
+    return ShowCacheStats(tiers=get_cache_stats())
+
+
+async def get_rate_limits_controller() -> ShowRateLimits:
+    """
+    Outputs the external API rate limits changed at runtime.
+    :return:
+    """
+    return ShowRateLimits(limits=await get_rate_limiter(get_redis()).get_limits())
+
+
+async def edit_rate_limit_controller(body: RateLimitEdit) -> ShowRateLimits:
+    """
+    Changes the external API rate limit for all workers.
+    :param body:
+    :return:
+    """
+    rate_limiter = get_rate_limiter(get_redis())
+    await rate_limiter.set_limit(**body.dict())
+    return ShowRateLimits(limits=await rate_limiter.get_limits())
+
+
+async def reset_rate_limit_controller(name: str) -> ShowRateLimits:
+    """
+    Returns the external API rate limit to its value from settings.
+    :param name:
+    :return:
+    """
+    rate_limiter = get_rate_limiter(get_redis())
+    await rate_limiter.reset_limit(validate_rate_limit_name(name))
+    return ShowRateLimits(limits=await rate_limiter.get_limits())
+
+
+async def get_metrics_controller() -> Response:
+    """
+    Outputs the metrics of the API in the Prometheus text format.
+    :return:
+    """
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
+def _trusted_response(model: BaseModel) -> ORJSONResponse:
+    """
+    Outputs the scheme as a response without validating it against the response model again. Only for schemes built
+    from trusted data, e.g. by TunedModel.from_db.
+    :param model:
+    :return:
+    """
+    return ORJSONResponse(model.dict())
@@ -1,21 +1,20 @@
+import uuid
+
 from fastapi import HTTPException
 
 from settings import settings
+from utils.cursor import decode_cursor
 
 
 class PaginationParameters:
-    __slots__ = ('limit', 'offset', '__dict__')
+    __slots__ = ('limit', 'after')
 
-    def __init__(self, limit: int = settings.PAGINATION_HIGH_LIMIT, offset: int = 0):
+    def __init__(self, limit: int = settings.PAGINATION_DEFAULT_LIMIT, cursor: str | None = None):
         if limit < settings.PAGINATION_LOW_LIMIT or limit > settings.PAGINATION_HIGH_LIMIT:
             raise HTTPException(
                 status_code=422,
-                detail='The pagination limit value is incorrect. Should be 1 to 10.'
-            )
-        if offset < 0:
-            raise HTTPException(
-                status_code=422,
-                detail='The pagination offset value is incorrect. Must be greater than 0.'
+                detail=f'The pagination limit value is incorrect. '
+                       f'Should be {settings.PAGINATION_LOW_LIMIT} to {settings.PAGINATION_HIGH_LIMIT}.'
             )
         self.limit = limit
-        self.offset = offset
+        self.after: uuid.UUID | None = decode_cursor(cursor) if cursor else None
@@ -1,6 +1,8 @@
 import uuid
+from datetime import datetime
 
-from fastapi import Depends, APIRouter
+from fastapi import Depends, APIRouter, UploadFile
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response
 from fastapi_cache.decorator import cache
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -16,14 +18,25 @@ from api.controllers import (
     create_message_controller,
     get_mailing_statistics_by_id_controller,
     get_statistics_mailings_controller,
-    delete_mailing_controller
+    delete_mailing_controller,
+    get_db_pool_status_controller,
+    get_cache_stats_controller,
+    import_customers_controller,
+    export_customers_controller,
+    export_messages_controller,
+    export_mailing_results_controller,
+    get_rate_limits_controller,
+    edit_rate_limit_controller,
+    reset_rate_limit_controller,
+    get_metrics_controller
 )
 from api.dependencies import PaginationParameters
 from models.schemas.customer import (
     ShowCustomer,
     CustomerCreate,
     ShowCustomers,
-    CustomerEdit
+    CustomerEdit,
+    ShowCustomersImport
 )
 from models.schemas.mailing import (
     ShowMailing,
@@ -38,8 +51,12 @@ from models.schemas.message import (
     ShowMessage,
     CreateMessage
 )
+from models.db import MessageStates
+from models.schemas.service import ShowPoolStatus, RateLimitEdit, ShowRateLimits, ShowCacheStats
 from repository.session import get_session_generator
 from settings import settings
+from utils.cache import versioned_key_builder, CUSTOMER_NAMESPACE, MAILING_NAMESPACE, MESSAGE_NAMESPACE
+from utils.file_utils import FileFormats
 
 
 customer_router = APIRouter(
@@ -62,29 +79,52 @@ statistics_router = APIRouter(
     tags=['statistics'],
 )
 
+service_router = APIRouter(
+    prefix='/service',
+    tags=['service'],
+)
+
+metrics_router = APIRouter(
+    tags=['metrics'],
+)
+
 
 @customer_router.post('/create', response_model=ShowCustomer)
 async def create_customer(
         body: CustomerCreate,
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowCustomer:
+) -> ORJSONResponse:
     return await create_customer_controller(body, session=session)
 
 
+@customer_router.post('/import', response_model=ShowCustomersImport)
+async def import_customers(file: UploadFile, file_format: FileFormats = FileFormats.CSV) -> ShowCustomersImport:
+    return await import_customers_controller(file, file_format=file_format)
+
+
 @customer_router.get('/list', response_model=ShowCustomers)
-@cache(expire=settings.EXPIRY_TIME_SEC)
+@cache(expire=settings.EXPIRY_TIME_SEC, namespace='customer', key_builder=versioned_key_builder(CUSTOMER_NAMESPACE))
 async def get_customers(
         paginator: PaginationParameters = Depends(PaginationParameters),
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowCustomers:
+) -> ORJSONResponse:
     return await get_customers_controller(session=session, paginator=paginator)
 
 
+@customer_router.get('/export', response_class=StreamingResponse)
+async def export_customers(
+        file_format: FileFormats = FileFormats.NDJSON,
+        code: int | None = None,
+        session: AsyncSession = Depends(get_session_generator)
+) -> StreamingResponse:
+    return await export_customers_controller(session=session, file_format=file_format, code=code)
+
+
 @customer_router.put('/edit', response_model=ShowCustomer)
 async def edit_customer(
         body: CustomerEdit,
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowCustomer:
+) -> ORJSONResponse:
     return await edit_customer_controller(body, session=session)
 
 
@@ -92,7 +132,7 @@ async def edit_customer(
 async def delete_customer(
         customer_id: uuid.UUID,
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowCustomer:
+) -> ORJSONResponse:
     return await delete_customer_controller(customer_id, session=session)
 
 
@@ -100,7 +140,7 @@ async def delete_customer(
 async def create_mailing(
         body: MailingCreate,
         session: AsyncSession = Depends(get_session_generator),
-) -> ShowMailing:
+) -> ORJSONResponse:
     return await create_mailing_controller(body, session=session)
 
 
@@ -108,7 +148,7 @@ async def create_mailing(
 async def edit_mailing(
         body: MailingEdit,
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowMailing:
+) -> ORJSONResponse:
     return await edit_mailing_controller(body, session=session)
 
 
@@ -116,7 +156,7 @@ async def edit_mailing(
 async def delete_mailing(
         mailing_id: uuid.UUID,
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowMailing:
+) -> ORJSONResponse:
     return await delete_mailing_controller(mailing_id, session=session)
 
 
@@ -128,20 +168,38 @@ async def send_mailing(
     return await send_mailing_controller(mailing_id, session=session)
 
 
+@mailing_router.get('/results', response_class=StreamingResponse)
+async def export_mailing_results(
+        mailing_id: uuid.UUID,
+        file_format: FileFormats = FileFormats.NDJSON,
+        status: MessageStates | None = None,
+        session: AsyncSession = Depends(get_session_generator)
+) -> StreamingResponse:
+    return await export_mailing_results_controller(mailing_id, session=session, file_format=file_format, status=status)
+
+
 @statistics_router.get('/by_id', response_model=ShowStatisticsByMailing)
-@cache(expire=settings.EXPIRY_TIME_SEC)
+@cache(
+    expire=settings.EXPIRY_TIME_SEC,
+    namespace='statistics',
+    key_builder=versioned_key_builder(MAILING_NAMESPACE, MESSAGE_NAMESPACE)
+)
 async def get_statistics_by_id(
         mailing_id: uuid.UUID,
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowStatisticsByMailing:
+) -> ORJSONResponse:
     return await get_mailing_statistics_by_id_controller(mailing_id, session=session)
 
 
 @statistics_router.get('/all', response_model=ShowStatisticsMailings)
-@cache(expire=settings.EXPIRY_TIME_SEC)
+@cache(
+    expire=settings.EXPIRY_TIME_SEC,
+    namespace='statistics',
+    key_builder=versioned_key_builder(MAILING_NAMESPACE, MESSAGE_NAMESPACE)
+)
 async def get_statistics_mailings(
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowStatisticsMailings:
+) -> ORJSONResponse:
     return await get_statistics_mailings_controller(session=session)
 
 
@@ -149,14 +207,63 @@ async def get_statistics_mailings(
 async def create_message(
         body: CreateMessage,
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowMessage:
+) -> ORJSONResponse:
     return await create_message_controller(body, session=session)
 
 
 @message_router.get('/list', response_model=ShowMessages)
-@cache(expire=settings.EXPIRY_TIME_SEC)
+@cache(expire=settings.EXPIRY_TIME_SEC, namespace='message', key_builder=versioned_key_builder(MESSAGE_NAMESPACE))
 async def get_messages(
         paginator: PaginationParameters = Depends(PaginationParameters),
         session: AsyncSession = Depends(get_session_generator)
-) -> ShowMessages:
+) -> ORJSONResponse:
     return await get_messages_controller(session=session, paginator=paginator)
+
+
+@message_router.get('/export', response_class=StreamingResponse)
+async def export_messages(
+        file_format: FileFormats = FileFormats.NDJSON,
+        mailing_id: uuid.UUID | None = None,
+        status: MessageStates | None = None,
+        date_from: datetime | None = None,
+        date_to: datetime | None = None,
+        session: AsyncSession = Depends(get_session_generator)
+) -> StreamingResponse:
+    return await export_messages_controller(
+        session=session,
+        file_format=file_format,
+        mailing_id=mailing_id,
+        status=status,
+        date_from=date_from,
+        date_to=date_to
+    )
+
+
+@service_router.get('/db_pool', response_model=ShowPoolStatus)
+async def get_db_pool_status() -> ShowPoolStatus:
+    return await get_db_pool_status_controller()
+
+
+@service_router.get('/cache', response_model=ShowCacheStats)
+async def get_cache_stats() -> ShowCacheStats:
+    return await get_cache_stats_controller()
+
+
+@service_router.get('/rate_limit', response_model=ShowRateLimits)
+async def get_rate_limits() -> ShowRateLimits:
+    return await get_rate_limits_controller()
+
+
+@service_router.put('/rate_limit', response_model=ShowRateLimits)
+async def edit_rate_limit(body: RateLimitEdit) -> ShowRateLimits:
+    return await edit_rate_limit_controller(body)
+
+
+@service_router.delete('/rate_limit', response_model=ShowRateLimits)
+async def reset_rate_limit(name: str) -> ShowRateLimits:
+    return await reset_rate_limit_controller(name)
+
+
+@metrics_router.get('/metrics', response_class=Response)
+async def get_metrics() -> Response:
+    return await get_metrics_controller()
@@ -0,0 +1,297 @@
+"""
+Load test of the customer, mailing, message and statistics routers. Requests of the configured mix are sent by
+concurrent clients to the app, driven in-process through ASGI or running on --url, over a seeded dataset.
+
+Every run has two phases with the same mix: in the no-cache phase the cached routes are requested with
+Cache-Control: no-cache, so every read goes to the database, in the cached phase they are served by the cache as
+usual. Writes of the mix invalidate the cache as they do in production, so the cached phase has misses too. Per route
+and phase it reports throughput, latency percentiles and error rates, with the cache tier counters.
+
+Needs the database (with migrations applied) and redis from .env, use a local database: the dataset is created with
+the operator code --code and deleted before and after the run. Created mailings start in a year, so they are not sent.
+Usage: python -m benchmarks.api_load [--url http://localhost:8080] [--concurrency 32] [--requests 5000]
+       [--mix customer_list=30,message_list=30,statistics_by_id=20,statistics_all=5,customer_create=5,...]
+       [--output api_load.json]
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import random
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+from benchmarks.dataset import delete_dataset, get_customer_ids, get_phone, seed_customers, seed_expired_mailings
+from benchmarks.utils import percentile, write_results
+from models.db import MessageStates
+from repository.redis_client import close_redis
+from repository.session import dispose_engine
+
+
+PHASES = ('no-cache', 'cached')
+DEFAULT_MIX = (
+    'customer_list=30,message_list=30,statistics_by_id=20,statistics_all=5,'
+    'customer_create=5,message_create=5,mailing_create=3,mailing_delete=2'
+)
+# Phones of the customers created by the load test follow the seeded ones.
+CREATED_PHONES_START = 5 * 10 ** 7
+
+
+@dataclass(kw_only=True, slots=True)
+class Dataset:
+    code: int
+    customer_ids: list[uuid.UUID]
+    mailing_ids: list[uuid.UUID]
+    # Mailing without seeded messages, the created messages are sent to its customers one by one.
+    target_mailing_id: uuid.UUID
+    created_mailing_ids: list[uuid.UUID] = field(default_factory=list)
+    customer_numbers: itertools.count = field(default_factory=lambda: itertools.count(CREATED_PHONES_START))
+    message_customers: itertools.count = field(default_factory=itertools.count)
+
+
+@dataclass(kw_only=True, slots=True)
+class RouteStats:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+
+Operation = Callable[[httpx.AsyncClient, Dataset, random.Random, dict[str, str]], Awaitable[httpx.Response]]
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+async def customer_list(client, dataset, rng, headers) -> httpx.Response:
+    return await client.get('/customer/list', params={'limit': rng.choice((10, 50, 100))}, headers=headers)
+
+
+async def message_list(client, dataset, rng, headers) -> httpx.Response:
+    return await client.get('/message/list', params={'limit': rng.choice((10, 50, 100))}, headers=headers)
+
+
+async def statistics_by_id(client, dataset, rng, headers) -> httpx.Response:
+    params = {'mailing_id': str(rng.choice(dataset.mailing_ids))}
+    return await client.get('/mailing/statistics/by_id', params=params, headers=headers)
+
+
+async def statistics_all(client, dataset, rng, headers) -> httpx.Response:
+    return await client.get('/mailing/statistics/all', headers=headers)
+
+
+async def customer_create(client, dataset, rng, headers) -> httpx.Response:
+    body = {
+        'phone': get_phone(dataset.code, next(dataset.customer_numbers)),
+        'code': dataset.code,
+        'time_zone': 'UTC+3',
+    }
+    return await client.post('/customer/create', json=body)
+
+
+async def message_create(client, dataset, rng, headers) -> httpx.Response:
+    customer_id = dataset.customer_ids[next(dataset.message_customers) % len(dataset.customer_ids)]
+    body = {
+        'sending_date': _now().isoformat(),
+        'status': rng.choice((MessageStates.DELIVERED.value, MessageStates.UNDELIVERED.value)),
+        'mailing_id': str(dataset.target_mailing_id),
+        'customer_id': str(customer_id),
+    }
+    return await client.post('/message/create', json=body)
+
+
+async def mailing_create(client, dataset, rng, headers) -> httpx.Response:
+    start_date = _now() + datetime.timedelta(days=365)
+    body = {
+        'start_date': start_date.isoformat(),
+        'message': 'Benchmark',
+        'filters': dataset.code,
+        'expiry_date': (start_date + datetime.timedelta(days=1)).isoformat(),
+    }
+    response = await client.post('/mailing/create', json=body)
+    if response.status_code == 200:
+        dataset.created_mailing_ids.append(uuid.UUID(response.json()['mailing_id']))
+    return response
+
+
+async def mailing_delete(client, dataset, rng, headers) -> httpx.Response:
+    if not dataset.created_mailing_ids:
+        return await mailing_create(client, dataset, rng, headers)
+    mailing_id = dataset.created_mailing_ids.pop()
+    return await client.delete('/mailing/delete', params={'mailing_id': str(mailing_id)})
+
+
+OPERATIONS: dict[str, Operation] = {
+    'customer_list': customer_list,
+    'message_list': message_list,
+    'statistics_by_id': statistics_by_id,
+    'statistics_all': statistics_all,
+    'customer_create': customer_create,
+    'message_create': message_create,
+    'mailing_create': mailing_create,
+    'mailing_delete': mailing_delete,
+}
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """
+    Parses the request mix.
+    :param mix: Weights of the operations, e.g. customer_list=30,message_list=70
+    :return: Weights by operation
+    """
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f'Unknown operation {name}, expected one of: {", ".join(OPERATIONS)}')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+async def seed_dataset(args: argparse.Namespace) -> Dataset:
+    await delete_dataset(args.code)
+    await seed_customers(args.customers, args.code)
+    mailing_ids = await seed_expired_mailings(args.mailings, args.code, args.messages_per_mailing)
+    target_mailing_ids = await seed_expired_mailings(1, args.code)
+    return Dataset(
+        code=args.code,
+        customer_ids=await get_customer_ids(args.code),
+        mailing_ids=mailing_ids,
+        target_mailing_id=target_mailing_ids[0]
+    )
+
+
+async def run_phase(
+        client: httpx.AsyncClient,
+        dataset: Dataset,
+        weights: dict[str, float],
+        phase: str,
+        args: argparse.Namespace
+) -> dict[str, Any]:
+    """
+    Sends the requests of the phase by concurrent clients and measures them.
+    :param client:
+    :param dataset:
+    :param weights:
+    :param phase:
+    :param args:
+    :return: Results of the phase
+    """
+    headers = {'Cache-Control': 'no-cache'} if phase == 'no-cache' else {}
+    names, cum_weights = list(weights), list(itertools.accumulate(weights.values()))
+    stats: defaultdict[str, RouteStats] = defaultdict(RouteStats)
+    remaining = iter(range(args.requests))
+    cache_before = (await client.get('/service/cache')).json()['tiers']
+
+    async def worker(number: int) -> None:
+        rng = random.Random(f'{args.seed}:{phase}:{number}')
+        for _ in remaining:
+            name = rng.choices(names, cum_weights=cum_weights)[0]
+            started = time.perf_counter()
+            try:
+                response = await OPERATIONS[name](client, dataset, rng, headers)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            route_stats = stats[name]
+            route_stats.latencies.append(time.perf_counter() - started)
+            route_stats.errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(number) for number in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    cache_after = (await client.get('/service/cache')).json()['tiers']
+
+    routes = {}
+    for name, route_stats in sorted(stats.items()):
+        latencies = route_stats.latencies
+        routes[name] = {
+            'requests': len(latencies),
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'error_rate': round(route_stats.errors / len(latencies), 4),
+            'latency_ms': {
+                f'p{q}': round(percentile(latencies, q) * 1000, 2) for q in (50, 90, 99)
+            } | {'max': round(max(latencies) * 1000, 2)},
+        }
+    return {
+        'elapsed_sec': round(elapsed, 3),
+        'throughput_rps': round(args.requests / elapsed, 1),
+        'routes': routes,
+        'cache': {
+            tier: {
+                counter: value - cache_before.get(tier, {}).get(counter, 0)
+                for counter, value in counters.items() if counter != 'size'
+            }
+            for tier, counters in cache_after.items()
+        },
+    }
+
+
+def create_client(url: str | None, concurrency: int) -> tuple[httpx.AsyncClient, Any]:
+    """
+    Creates the client of the app running on the url, or of the app of the process if no url is passed.
+    :param url:
+    :param concurrency:
+    :return: Client and the app to start, None if it runs elsewhere
+    """
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    if url:
+        return httpx.AsyncClient(base_url=url, limits=limits, timeout=60), None
+
+    from main import app
+
+    transport = httpx.ASGITransport(app=app)
+    return httpx.AsyncClient(transport=transport, base_url='http://benchmark', limits=limits, timeout=60), app
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    """
+    Seeds the dataset, runs the phases and deletes the dataset.
+    :param args:
+    :return: Results by phase
+    """
+    weights = parse_mix(args.mix)
+    client, app = create_client(args.url, args.concurrency)
+    if app is not None:
+        await app.router.startup()
+    try:
+        dataset = await seed_dataset(args)
+        results = {}
+        for phase in PHASES:
+            results[phase] = await run_phase(client, dataset, weights, phase, args)
+        return results
+    finally:
+        await client.aclose()
+        await delete_dataset(args.code)
+        if app is not None:
+            await app.router.shutdown()
+        await dispose_engine()
+        await close_redis()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='URL of the running app, the app is run in-process if not passed')
+    parser.add_argument('--code', type=int, default=998, help='Operator code of the dataset')
+    parser.add_argument('--customers', type=int, default=10000)
+    parser.add_argument('--mailings', type=int, default=50)
+    parser.add_argument('--messages-per-mailing', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=5000, help='Requests per phase')
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='File to write the results to as JSON')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    parameters = {key: value for key, value in vars(args).items() if key != 'output'}
+    write_results(args.output, 'api_load', parameters, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Seeds the benchmark datasets straight in the database. Every benchmark entity belongs to one operator code: the
+customers have it and the mailings filter by it, so a dataset is deleted by its code.
+"""
+import uuid
+
+from sqlalchemy import delete, select, text
+
+from models.db import Customer, Mailing, Message
+from repository.session import create_db_session
+from services.counter import CounterDAL
+
+
+SEED_CUSTOMERS = text(
+    """
+    INSERT INTO customer (customer_id, phone, code, time_zone, utc_offset_min)
+    SELECT gen_random_uuid(), :phone_base + n, :code, 'UTC+3', 180
+    FROM generate_series(1, :count) AS n
+    """
+)
+SEED_EXPIRED_MAILINGS = text(
+    """
+    INSERT INTO mailing (mailing_id, start_date, message, filters, expiry_date)
+    SELECT gen_random_uuid(), now() - interval '2 days', 'Benchmark', :code, now() - interval '1 day'
+    FROM generate_series(1, :count)
+    RETURNING mailing_id
+    """
+)
+SEED_MESSAGES = text(
+    """
+    INSERT INTO message (message_id, sending_date, status, attempts, mailing_id, customer_id)
+    SELECT
+        gen_random_uuid(),
+        mailing.start_date,
+        CASE WHEN random() < :delivered_share THEN 'DELIVERED' ELSE 'UNDELIVERED' END,
+        1,
+        mailing.mailing_id,
+        customer.customer_id
+    FROM mailing
+    CROSS JOIN LATERAL (
+        SELECT customer_id FROM customer WHERE code = mailing.filters ORDER BY customer_id LIMIT :count
+    ) AS customer
+    WHERE mailing.mailing_id = ANY(:mailing_ids)
+    """
+)
+
+
+def get_phone(code: int, number: int) -> int:
+    """
+    Outputs a valid phone of the benchmark customer, unique within the code.
+    :param code:
+    :param number: Number of the customer, less than 10 ** 8
+    :return:
+    """
+    return code * 10 ** 8 + number
+
+
+async def seed_customers(count: int, code: int) -> None:
+    """
+    Creates the customers with one INSERT ... SELECT.
+    :param count:
+    :param code:
+    :return:
+    """
+    async with create_db_session() as session:
+        await session.execute(SEED_CUSTOMERS, {'phone_base': get_phone(code, 0), 'code': code, 'count': count})
+        await session.commit()
+        await session.execute(text('ANALYZE customer'))
+        await session.commit()
+
+
+async def get_customer_ids(code: int) -> list[uuid.UUID]:
+    """
+    Outputs customer_id of the customers of the code in order.
+    :param code:
+    :return:
+    """
+    async with create_db_session() as session:
+        result = await session.execute(
+            select(Customer.customer_id).where(Customer.code == code).order_by(Customer.customer_id)
+        )
+        return list(result.scalars())
+
+
+async def seed_expired_mailings(count: int, code: int, messages_per_mailing: int = 0) -> list[uuid.UUID]:
+    """
+    Creates expired mailings to the customers of the code, with delivered and undelivered messages to the first
+    customers, and rebuilds the counters, so the mailings have statistics.
+    :param count:
+    :param code:
+    :param messages_per_mailing:
+    :return: mailing_id of the mailings
+    """
+    async with create_db_session() as session:
+        result = await session.execute(SEED_EXPIRED_MAILINGS, {'code': code, 'count': count})
+        mailing_ids = list(result.scalars())
+        if messages_per_mailing:
+            await session.execute(
+                SEED_MESSAGES,
+                {'mailing_ids': mailing_ids, 'count': messages_per_mailing, 'delivered_share': 0.9}
+            )
+        await session.commit()
+    await CounterDAL(create_db_session()).reconcile_counters(mailing_ids)
+    return mailing_ids
+
+
+async def delete_dataset(code: int) -> None:
+    """
+    Deletes the customers of the code, the mailings filtering by it and their messages.
+    :param code:
+    :return:
+    """
+    async with create_db_session() as session:
+        mailings = select(Mailing.mailing_id).where(Mailing.filters == code)
+        customers = select(Customer.customer_id).where(Customer.code == code)
+        await session.execute(
+            delete(Message)
+            .where(Message.mailing_id.in_(mailings) | Message.customer_id.in_(customers))
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(delete(Mailing).where(Mailing.filters == code))
+        await session.execute(delete(Customer).where(Customer.code == code))
+        await session.commit()
@@ -0,0 +1,116 @@
+"""
+Local stand-in for the external mailing API. Answers POST /send/{id} after a random latency and fails the configured
+share of requests with 500, so the sender can be measured without the real provider.
+
+Point settings.MAILING_API_URL to http://<host>:<port>/send/ to use it.
+Usage: python -m benchmarks.fake_provider [--port 8081] [--latency lognormal] [--latency-ms 50] [--error-rate 0.01]
+"""
+import argparse
+import asyncio
+import random
+from typing import Callable, Literal
+
+from aiohttp import web
+
+
+LatencyDistribution = Literal['fixed', 'uniform', 'normal', 'lognormal']
+
+
+def get_latency_sampler(
+        distribution: LatencyDistribution,
+        latency_ms: float,
+        jitter_ms: float,
+        rng: random.Random
+) -> Callable[[], float]:
+    """
+    Creates a sampler of response latencies.
+    :param distribution: fixed - always latency_ms, uniform - latency_ms +- jitter_ms, normal - mean latency_ms with
+    standard deviation jitter_ms, lognormal - median latency_ms with a long tail growing with jitter_ms
+    :param latency_ms:
+    :param jitter_ms:
+    :param rng:
+    :return: Sampler of latencies in seconds
+    """
+    if distribution == 'fixed':
+        return lambda: latency_ms / 1000
+    if distribution == 'uniform':
+        return lambda: max(rng.uniform(latency_ms - jitter_ms, latency_ms + jitter_ms), 0) / 1000
+    if distribution == 'normal':
+        return lambda: max(rng.gauss(latency_ms, jitter_ms), 0) / 1000
+    if distribution == 'lognormal':
+        sigma = jitter_ms / latency_ms if latency_ms else 0
+        return lambda: latency_ms * rng.lognormvariate(0, sigma) / 1000
+    raise ValueError(f'Unknown latency distribution: {distribution}')
+
+
+class FakeProvider:
+    """
+    aiohttp server implementing /send/{id} of the external mailing API.
+    """
+    __slots__ = ('sample_latency', 'error_rate', 'requests', 'errors', '_rng', '_runner')
+
+    def __init__(
+            self,
+            distribution: LatencyDistribution = 'lognormal',
+            latency_ms: float = 50,
+            jitter_ms: float = 20,
+            error_rate: float = 0,
+            seed: int | None = None
+    ):
+        self._rng = random.Random(seed)
+        self.sample_latency = get_latency_sampler(distribution, latency_ms, jitter_ms, self._rng)
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._runner: web.AppRunner | None = None
+
+    async def send(self, request: web.Request) -> web.Response:
+        await request.read()
+        self.requests += 1
+        await asyncio.sleep(self.sample_latency())
+        if self._rng.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({'code': 1, 'message': 'Internal error'}, status=500)
+        return web.json_response({'code': 0, 'message': 'OK'})
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/send/{id}', self.send)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """
+        Starts the server.
+        :param host:
+        :param port: Any free port if 0
+        :return: URL to put in settings.MAILING_API_URL
+        """
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        return f'http://{host}:{port}/send/'
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            runner, self._runner = self._runner, None
+            await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', choices=['fixed', 'uniform', 'normal', 'lognormal'], default='lognormal')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    provider = FakeProvider(args.latency, args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    web.run_app(provider.create_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Measures MessageDAL.send_messages end to end: a mailing to a seeded audience is sent through the fake provider and
+stored in Postgres. For every audience size it reports messages/sec, p50/p99 send latency, DB round trips and peak
+RSS of the sender.
+
+Needs the database (with migrations applied) and redis from .env, use a local database: the benchmark customers are
+created with the operator code --code and deleted with their messages before and after every run. Every size is sent
+in its own process, so its peak RSS is not inflated by the previous ones, while the fake provider runs in the parent.
+Usage: python -m benchmarks.sender [--sizes 1000 10000 100000 1000000] [--latency-ms 50] [--error-rate 0.01]
+       [--output sender.json]
+"""
+import argparse
+import asyncio
+import datetime
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import uuid
+from array import array
+from typing import Any
+
+from sqlalchemy import event
+
+from benchmarks.dataset import delete_dataset, seed_customers
+from benchmarks.fake_provider import FakeProvider
+from benchmarks.utils import percentile, write_results
+from models.db import Mailing
+from repository.http_client import close_http_session
+from repository.redis_client import close_redis
+from repository.session import create_db_session, dispose_engine, get_engine
+from services.message import MessageDAL
+
+
+# Settings of the sender processes, passed through the environment, so they apply to the defaults bound at import.
+# The processes are spawned, so they import the settings anew.
+SETTINGS_OPTIONS = {
+    'MAILING_API_URL': 'provider_url',
+    'MAILING_CONCURRENCY': 'concurrency',
+    'WORKER_CONCURRENCY': 'worker_concurrency',
+    'MESSAGE_BATCH_SIZE': 'batch_size',
+    'CUSTOMER_CHUNK_SIZE': 'chunk_size',
+    'RATE_LIMIT_ENABLED': 'rate_limit',
+}
+
+
+def get_peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+async def create_mailing(code: int) -> uuid.UUID:
+    """
+    Creates a mailing to the customers of the code, started a minute ago.
+    :param code:
+    :return: mailing_id
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    async with create_db_session() as session:
+        mailing = Mailing(
+            start_date=now - datetime.timedelta(minutes=1),
+            message='Benchmark',
+            filters=code,
+            expiry_date=now + datetime.timedelta(days=1)
+        )
+        session.add(mailing)
+        await session.commit()
+        return mailing.mailing_id
+
+
+async def benchmark_size(size: int, code: int) -> dict[str, Any]:
+    """
+    Sends a mailing to an audience of the size and measures it.
+    :param size:
+    :param code:
+    :return:
+    """
+    latencies = array('d')
+    round_trips = {'statements': 0, 'commits': 0}
+    send_message = MessageDAL.send_message
+
+    async def timed_send_message(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await send_message(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    def before_cursor_execute(*args) -> None:
+        round_trips['statements'] += 1
+
+    def commit(*args) -> None:
+        round_trips['commits'] += 1
+
+    sync_engine = get_engine().sync_engine
+    try:
+        await delete_dataset(code)
+        await seed_customers(size, code)
+        mailing_id = await create_mailing(code)
+
+        MessageDAL.send_message = staticmethod(timed_send_message)
+        event.listen(sync_engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(sync_engine, 'commit', commit)
+        started = time.perf_counter()
+        try:
+            response = await MessageDAL.send_messages(mailing_id)
+        finally:
+            elapsed = time.perf_counter() - started
+            event.remove(sync_engine, 'commit', commit)
+            event.remove(sync_engine, 'before_cursor_execute', before_cursor_execute)
+            MessageDAL.send_message = staticmethod(send_message)
+    finally:
+        await delete_dataset(code)
+        await close_http_session()
+        await close_redis()
+        await dispose_engine()
+
+    db_round_trips = round_trips['statements'] + round_trips['commits']
+    return {
+        'audience': size,
+        'response': response.message,
+        'sent': len(latencies),
+        'elapsed_sec': round(elapsed, 3),
+        'messages_per_sec': round(len(latencies) / elapsed, 1),
+        'send_latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            'p99': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        },
+        'db_statements': round_trips['statements'],
+        'db_commits': round_trips['commits'],
+        'db_round_trips': db_round_trips,
+        'db_round_trips_per_1k_messages': round(db_round_trips / len(latencies) * 1000, 2) if latencies else None,
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+
+
+def run_size(size: int, code: int) -> dict[str, Any]:
+    return asyncio.run(benchmark_size(size, code))
+
+
+async def run(args: argparse.Namespace) -> list[dict[str, Any]]:
+    """
+    Starts the fake provider and measures every audience size in a new process.
+    :param args:
+    :return: Results by size
+    """
+    provider = FakeProvider(args.latency, args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    args.provider_url = await provider.start()
+    for name, option in SETTINGS_OPTIONS.items():
+        value = getattr(args, option)
+        if value is not None:
+            os.environ[name] = str(value)
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for size in args.sizes:
+            requests, errors = provider.requests, provider.errors
+            with context.Pool(1) as pool:
+                result = await asyncio.to_thread(pool.apply, run_size, (size, args.code))
+            result['provider_requests'] = provider.requests - requests
+            result['provider_errors'] = provider.errors - errors
+            results.append(result)
+            print(f'{size} customers: {result["messages_per_sec"]} messages/sec', file=sys.stderr)
+    finally:
+        await provider.stop()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--code', type=int, default=999, help='Operator code of the benchmark customers')
+    parser.add_argument('--latency', choices=['fixed', 'uniform', 'normal', 'lognormal'], default='lognormal')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, help='settings.MAILING_CONCURRENCY')
+    parser.add_argument('--worker-concurrency', type=int, help='settings.WORKER_CONCURRENCY')
+    parser.add_argument('--batch-size', type=int, help='settings.MESSAGE_BATCH_SIZE')
+    parser.add_argument('--chunk-size', type=int, help='settings.CUSTOMER_CHUNK_SIZE')
+    parser.add_argument('--rate-limit', action='store_true', help='Keeps the rate limits of the external API')
+    parser.add_argument('--output', help='File to write the results to as JSON')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    parameters = {key: value for key, value in vars(args).items() if key != 'output'}
+    write_results(args.output, 'sender', parameters, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Measures the cost of converting database rows into a response body, per row, before and after the trusted path.
+
+Before: schemes are built with validation, validated once more against the response model and encoded with the
+default JSON encoder, as FastAPI does for a returned scheme. After: schemes are built by TunedModel.from_db and
+rendered by ORJSONResponse. No database is needed, the rows are ORM objects built in memory.
+Usage: python -m benchmarks.serialization [--rows 10000] [--repeat 5] [--output serialization.json]
+"""
+import argparse
+import datetime
+import json
+import time
+import uuid
+from typing import Any, Callable
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+
+from models.db import Customer, Message, MessageStates
+from models.schemas.customer import ShowCustomer, ShowCustomers
+from models.schemas.message import ShowMessage, ShowMessages
+
+from benchmarks.utils import write_results
+
+
+def make_customers(rows: int) -> list[Customer]:
+    return [
+        Customer(customer_id=uuid.uuid4(), phone=79270000000 + i, code=927, time_zone='UTC+3', utc_offset_min=180)
+        for i in range(rows)
+    ]
+
+
+def make_messages(rows: int) -> list[Message]:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    mailing_id = uuid.uuid4()
+    return [
+        Message(
+            message_id=uuid.uuid4(),
+            sending_date=now,
+            status=MessageStates.DELIVERED.value,
+            mailing_id=mailing_id,
+            customer_id=uuid.uuid4()
+        )
+        for _ in range(rows)
+    ]
+
+
+def validated_customers(customers: list[Customer]) -> bytes:
+    model = ShowCustomers(customers=[ShowCustomer(**customer.__dict__) for customer in customers])
+    return json.dumps(jsonable_encoder(ShowCustomers(**model.dict()))).encode()
+
+
+def trusted_customers(customers: list[Customer]) -> bytes:
+    model = ShowCustomers.construct(customers=[ShowCustomer.from_db(customer) for customer in customers])
+    return ORJSONResponse(model.dict()).body
+
+
+def validated_messages(messages: list[Message]) -> bytes:
+    model = ShowMessages(messages=[ShowMessage(**message.__dict__) for message in messages])
+    return json.dumps(jsonable_encoder(ShowMessages(**model.dict()))).encode()
+
+
+def trusted_messages(messages: list[Message]) -> bytes:
+    model = ShowMessages.construct(messages=[ShowMessage.from_db(message) for message in messages])
+    return ORJSONResponse(model.dict()).body
+
+
+def measure(func: Callable[[list], bytes], rows: list, repeat: int) -> float:
+    """
+    Outputs the best time of the conversion of the rows in seconds.
+    :param func:
+    :param rows:
+    :param repeat:
+    :return:
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(rows)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def run(rows: int, repeat: int) -> dict[str, Any]:
+    """
+    Measures both paths for customers and messages.
+    :param rows:
+    :param repeat:
+    :return: Results by payload
+    """
+    payloads = {
+        'customers': (make_customers(rows), validated_customers, trusted_customers),
+        'messages': (make_messages(rows), validated_messages, trusted_messages),
+    }
+    results = {}
+    for name, (objects, validated, trusted) in payloads.items():
+        before = measure(validated, objects, repeat)
+        after = measure(trusted, objects, repeat)
+        results[name] = {
+            'rows': rows,
+            'before_us_per_row': round(before / rows * 1e6, 3),
+            'after_us_per_row': round(after / rows * 1e6, 3),
+            'speedup': round(before / after, 2),
+        }
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='File to write the results to as JSON')
+    args = parser.parse_args()
+
+    results = run(args.rows, args.repeat)
+    write_results(args.output, 'serialization', {'rows': args.rows, 'repeat': args.repeat}, results)
+
+
+if __name__ == '__main__':
+    main()
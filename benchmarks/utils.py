@@ -0,0 +1,56 @@
+import datetime
+import json
+import math
+import platform
+import subprocess
+from typing import Any, Sequence
+
+
+def percentile(values: Sequence[float], q: float) -> float | None:
+    """
+    Outputs the percentile of the values by the nearest rank.
+    :param values:
+    :param q: Percentile from 0 to 100
+    :return: None if there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(q / 100 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def get_commit() -> str | None:
+    """
+    Outputs the commit the benchmark is run on.
+    :return: None if it is run outside of a git repository
+    """
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def write_results(path: str | None, benchmark: str, parameters: dict[str, Any], results: Any) -> None:
+    """
+    Prints the results of the benchmark and writes them to the file as JSON if it is passed. The commit, the date and
+    the parameters of the run are written with the results, so runs can be compared across commits.
+    :param path:
+    :param benchmark: Name of the benchmark
+    :param parameters: Parameters of the run
+    :param results:
+    :return:
+    """
+    report = {
+        'benchmark': benchmark,
+        'commit': get_commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'parameters': parameters,
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if path:
+        with open(path, 'w') as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,6 @@
+#!/bin/sh
+
+cd /app
+
+/bin/bash -c 'source /opt/venv/bin/activate &&
+celery --app=tasks.tasks:celery beat -l INFO'
\ No newline at end of file
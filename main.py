@@ -2,18 +2,37 @@ import logging
 
 import uvicorn
 from fastapi import FastAPI, APIRouter
+from fastapi.responses import ORJSONResponse
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.redis import RedisBackend
-from redis import asyncio as aioredis
 from starlette.middleware.cors import CORSMiddleware
 
-from api.routers import customer_router, mailing_router, message_router, statistics_router
+from api.routers import (
+    customer_router,
+    mailing_router,
+    message_router,
+    statistics_router,
+    service_router,
+    metrics_router
+)
+from repository.http_client import close_http_session
+from repository.redis_client import close_redis
+from repository.session import dispose_engine
 from settings import settings
+from utils.cache import (
+    ORJSONCoder,
+    create_cache_backend,
+    start_cache_invalidation_listener,
+    stop_cache_invalidation_listener
+)
 from utils.logger_config import configurate_logging_file
+from utils.db_instrumentation import QueryScopeMiddleware
+from utils.metrics import MetricsMiddleware
 
 
-app = FastAPI(**settings.get_backend_app_attributes)
+app = FastAPI(**settings.get_backend_app_attributes, default_response_class=ORJSONResponse)
 app.add_middleware(CORSMiddleware, **settings.get_middleware_attributes)
+app.add_middleware(QueryScopeMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 @app.on_event("startup")
@@ -32,11 +51,25 @@ async def app_startup():
     main_router.include_router(mailing_router)
     main_router.include_router(message_router)
     main_router.include_router(statistics_router)
+    main_router.include_router(service_router)
+    main_router.include_router(metrics_router)
     app.include_router(main_router)
 
     # Configuration redis
-    redis_conn = aioredis.from_url(**settings.get_redis_attributes)
-    FastAPICache.init(RedisBackend(redis_conn), prefix='fastapi-cache')
+    FastAPICache.init(create_cache_backend(), prefix='fastapi-cache', coder=ORJSONCoder)
+    start_cache_invalidation_listener()
+
+
+@app.on_event("shutdown")
+async def app_shutdown():
+    """
+    Releases the api resources at shutdown.
+    :return:
+    """
+    await stop_cache_invalidation_listener()
+    await dispose_engine()
+    await close_http_session()
+    await close_redis()
 
 
 if __name__ == "__main__":
@@ -2,7 +2,7 @@ import uuid
 import enum
 
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import Column, String, ForeignKey, DateTime, Integer, BigInteger
+from sqlalchemy import Column, String, ForeignKey, DateTime, Integer, BigInteger, Identity, UniqueConstraint, Index
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.sql import func
 
@@ -19,6 +19,8 @@ class Mailing(Base):
     message = Column(String, nullable=False)
     filters = Column(Integer, nullable=True)
     expiry_date = Column(DateTime(timezone=True), server_default=func.now())
+    send_from_hour = Column(Integer, nullable=True)
+    send_to_hour = Column(Integer, nullable=True)
 
     messages = relationship("Message", back_populates="mailings", cascade="all,delete")
 
@@ -29,11 +31,16 @@ class Mailing(Base):
 class Customer(Base):
     # The entity describes phone owners.
     __tablename__ = 'customer'
+    __table_args__ = (
+        Index('ix_customer_code_customer_id', 'code', 'customer_id'),
+        Index('ix_customer_code_utc_offset_min_customer_id', 'code', 'utc_offset_min', 'customer_id'),
+    )
 
     customer_id = Column(UUID(as_uuid=True), primary_key=True, unique=True, default=uuid.uuid4)
-    phone = Column(BigInteger, nullable=False)
+    phone = Column(BigInteger, nullable=False, unique=True)
     code = Column(Integer, nullable=True)
     time_zone = Column(String, nullable=True)
+    utc_offset_min = Column(Integer, nullable=False, default=0, server_default='0')
 
     messages = relationship("Message", back_populates="customers", cascade="all,delete")
 
@@ -54,10 +61,16 @@ class MessageStates(enum.Enum):
 class Message(Base):
     # The entity describes the message that was sent to the customer from the mailing list.
     __tablename__ = 'message'
+    __table_args__ = (
+        UniqueConstraint('mailing_id', 'customer_id', name='uq_message_mailing_id_customer_id'),
+        Index('ix_message_mailing_id_status_message_id', 'mailing_id', 'status', 'message_id'),
+        Index('ix_message_customer_id', 'customer_id'),
+    )
 
     message_id = Column(UUID(as_uuid=True), primary_key=True, unique=True, default=uuid.uuid4)
     sending_date = Column(DateTime(timezone=True), server_default=func.now())
     status = Column(String, default=MessageStates.UNDELIVERED.value)
+    attempts = Column(Integer, nullable=False, default=1, server_default='1')
 
     mailing_id = Column(UUID(as_uuid=True), ForeignKey('mailing.mailing_id'))
     customer_id = Column(UUID(as_uuid=True), ForeignKey('customer.customer_id'))
@@ -70,3 +83,77 @@ class Message(Base):
                f'sending data: {self.sending_date} ' \
                f'customer: {self.customer_id} ' \
                f'mailing: {self.mailing_id}'
+
+
+class MailingCounter(Base):
+    # The entity holds message counters of the mailing, maintained incrementally by the sending path.
+    __tablename__ = 'mailing_counter'
+
+    mailing_id = Column(UUID(as_uuid=True), ForeignKey('mailing.mailing_id', ondelete='CASCADE'), primary_key=True)
+    delivered_count = Column(Integer, nullable=False, default=0, server_default='0')
+    undelivered_count = Column(Integer, nullable=False, default=0, server_default='0')
+    total_count = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    reconciled_at = Column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f'mailing: {self.mailing_id} ' \
+               f'delivered: {self.delivered_count} ' \
+               f'undelivered: {self.undelivered_count}'
+
+
+class OutboxStates(enum.Enum):
+    # Lists the states of the outbox recipients.
+    PENDING = 'PENDING'
+    SENDING = 'SENDING'
+    DONE = 'DONE'
+
+    @classmethod
+    def list(cls):
+        return list(map(lambda c: c.value, cls))
+
+
+class MailingOutbox(Base):
+    # The entity describes a recipient of the mailing waiting to be claimed by a sender worker.
+    __tablename__ = 'mailing_outbox'
+    __table_args__ = (
+        UniqueConstraint('mailing_id', 'customer_id', name='uq_mailing_outbox_mailing_id_customer_id'),
+        Index('ix_mailing_outbox_mailing_id_state_outbox_id', 'mailing_id', 'state', 'outbox_id'),
+        Index('ix_mailing_outbox_customer_id', 'customer_id'),
+    )
+
+    outbox_id = Column(BigInteger, Identity(), primary_key=True)
+    mailing_id = Column(UUID(as_uuid=True), ForeignKey('mailing.mailing_id', ondelete='CASCADE'), nullable=False)
+    customer_id = Column(UUID(as_uuid=True), ForeignKey('customer.customer_id', ondelete='CASCADE'), nullable=False)
+    phone = Column(BigInteger, nullable=False)
+    code = Column(Integer, nullable=True)
+    state = Column(
+        String,
+        nullable=False,
+        default=OutboxStates.PENDING.value,
+        server_default=OutboxStates.PENDING.value
+    )
+    claimed_at = Column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f'outbox: {self.outbox_id} ' \
+               f'mailing: {self.mailing_id} ' \
+               f'customer: {self.customer_id} ' \
+               f'state: {self.state}'
+
+
+class MailingCheckpoint(Base):
+    # The entity holds the last customer whose message of the mailing is stored, by customer_id range and UTC offset
+    # bucket of the sender.
+    __tablename__ = 'mailing_checkpoint'
+
+    mailing_id = Column(UUID(as_uuid=True), ForeignKey('mailing.mailing_id', ondelete='CASCADE'), primary_key=True)
+    range_start = Column(UUID(as_uuid=True), primary_key=True)
+    utc_offset_min = Column(Integer, primary_key=True, default=0, server_default='0')
+    last_customer_id = Column(UUID(as_uuid=True), nullable=False)
+
+    def __repr__(self):
+        return f'mailing: {self.mailing_id} ' \
+               f'range: {self.range_start} ' \
+               f'utc offset: {self.utc_offset_min} ' \
+               f'last customer: {self.last_customer_id}'
@@ -1,3 +1,5 @@
+from typing import Any
+
 from pydantic import BaseModel
 
 
@@ -7,3 +9,15 @@ class TunedModel(BaseModel):
     """
     class Config:
         orm_mode = True
+
+    @classmethod
+    def from_db(cls, obj: Any, **values: Any) -> 'TunedModel':
+        """
+        Creates the scheme from an object read from the database without running the validators. Only for trusted
+        data, which already satisfies the scheme.
+        :param obj: Object whose attributes are the fields of the scheme
+        :param values: Fields which are not attributes of the object
+        :return:
+        """
+        fields = {name: getattr(obj, name) for name in cls.__fields__ if name not in values and hasattr(obj, name)}
+        return cls.construct(**fields, **values)
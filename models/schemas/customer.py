@@ -45,3 +45,10 @@ class ShowCustomer(TunedModel, _CustomerFull):
 
 class ShowCustomers(TunedModel):
     customers: list[ShowCustomer]
+    next_cursor: str | None = None
+
+
+class ShowCustomersImport(TunedModel):
+    accepted_count: int
+    rejected_count: int
+    errors: list[str] = []
@@ -1,11 +1,10 @@
 from datetime import datetime
 import uuid
 
-from pydantic import BaseModel, validator, Field, PositiveInt
+from pydantic import BaseModel, validator, root_validator, Field, PositiveInt
 
 from models.schemas.base_shemas import TunedModel
-from models.schemas.message import ShowMessages
-from utils.validation import validate_id, validate_datetime, validate_code
+from utils.validation import validate_id, validate_datetime, validate_code, validate_hour, validate_delivery_window
 
 
 # base schemes
@@ -14,6 +13,8 @@ class _MailingWithoutId(BaseModel):
     message: str = Field(default='Hello, World!')
     filters: PositiveInt = Field(default=927)
     expiry_date: datetime
+    send_from_hour: int | None = Field(default=None)
+    send_to_hour: int | None = Field(default=None)
 
     @validator('start_date')
     def validate_start_date(cls, value):
@@ -27,6 +28,14 @@ class _MailingWithoutId(BaseModel):
     def validate_expiry_date(cls, value):
         return validate_datetime(value)
 
+    @validator('send_from_hour', 'send_to_hour')
+    def validate_hour(cls, value):
+        return validate_hour(value)
+
+    @root_validator(skip_on_failure=True)
+    def validate_delivery_window(cls, values):
+        return validate_delivery_window(values)
+
 
 class _MailingFull(_MailingWithoutId):
     mailing_id: uuid.UUID
@@ -53,8 +62,6 @@ class ShowMailing(TunedModel, _MailingFull):
 class ShowStatisticsByMailing(ShowMailing):
     delivered_count: int
     undelivered_count: int
-    delivered_messages: ShowMessages = []
-    undelivered_messages: ShowMessages = []
 
 
 class ShowStatisticsMailings(TunedModel):
@@ -59,9 +59,10 @@ class CreateMessage(_MessageWithoutId):
 
 
 # output schemes
-class ShowMessage(_MessageFull):
+class ShowMessage(TunedModel, _MessageFull):
     pass
 
 
 class ShowMessages(TunedModel):
     messages: list[ShowMessage]
+    next_cursor: str | None = None
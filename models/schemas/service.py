@@ -0,0 +1,32 @@
+from pydantic import BaseModel, Field, NonNegativeFloat, PositiveInt, validator
+
+from models.schemas.base_shemas import TunedModel
+from utils.validation import validate_rate_limit_name
+
+
+# input schemes
+class RateLimitEdit(BaseModel):
+    name: str = Field(default='global')
+    rate: NonNegativeFloat = Field(default=100)
+    burst: PositiveInt = Field(default=100)
+
+    @validator('name')
+    def validate_name(cls, value):
+        return validate_rate_limit_name(value)
+
+
+# output schemes
+class ShowPoolStatus(TunedModel):
+    size: int
+    checked_in: int
+    checked_out: int
+    overflow: int
+    max_capacity: int
+
+
+class ShowRateLimits(TunedModel):
+    limits: dict[str, dict[str, float]]
+
+
+class ShowCacheStats(TunedModel):
+    tiers: dict[str, dict[str, int]]
@@ -0,0 +1,36 @@
+import aiohttp
+
+from settings import settings
+
+
+_http_session: aiohttp.ClientSession | None = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Outputs the client session of the external mailing API. The session and its keep-alive connection pool are
+    created on first use and reused by every request of the process.
+    :return:
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(**settings.get_http_connector_attributes)
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            headers=settings.MAILING_API_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=settings.TIMEOUT, sock_read=settings.TIMEOUT),
+            raise_for_status=True,
+        )
+    return _http_session
+
+
+async def close_http_session() -> None:
+    """
+    Closes the client session and its connections. The next request creates a new one.
+    :return:
+    """
+    global _http_session
+    if _http_session is None:
+        return
+    session, _http_session = _http_session, None
+    await session.close()
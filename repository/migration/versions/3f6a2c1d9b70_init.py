@@ -0,0 +1,226 @@
+"""init
+
+Revision ID: 3f6a2c1d9b70
+Revises:
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Callable
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '3f6a2c1d9b70'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# Databases created before the migrations were committed are stamped with revisions autogenerated at container
+# start, or not stamped at all, and already have some of the tables. Their tables are completed instead of created.
+# Duplicate messages of a customer in a mailing are dropped before their unique constraint is added, keeping the
+# delivered and latest one.
+DEDUPLICATE = {
+    'uq_message_mailing_id_customer_id': """
+        DELETE FROM message
+        WHERE message_id IN (
+            SELECT message_id
+            FROM (
+                SELECT
+                    message_id,
+                    row_number() OVER (
+                        PARTITION BY mailing_id, customer_id
+                        ORDER BY status = 'DELIVERED' DESC, sending_date DESC
+                    ) AS position
+                FROM message
+                WHERE mailing_id IS NOT NULL AND customer_id IS NOT NULL
+            ) AS ranked
+            WHERE position > 1
+        )
+    """,
+}
+# Counters of the mailings sent before the counter table existed.
+BACKFILL_COUNTERS = """
+    INSERT INTO mailing_counter (mailing_id, delivered_count, undelivered_count, total_count)
+    SELECT
+        mailing_id,
+        count(*) FILTER (WHERE status = 'DELIVERED'),
+        count(*) FILTER (WHERE status IS DISTINCT FROM 'DELIVERED'),
+        count(*)
+    FROM message
+    WHERE mailing_id IS NOT NULL
+    GROUP BY mailing_id
+"""
+
+
+def _customer_elements() -> tuple:
+    return (
+        sa.Column('customer_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('phone', sa.BigInteger(), nullable=False),
+        sa.Column('code', sa.Integer(), nullable=True),
+        sa.Column('time_zone', sa.String(), nullable=True),
+        sa.Column('utc_offset_min', sa.Integer(), server_default='0', nullable=False),
+        sa.PrimaryKeyConstraint('customer_id'),
+        sa.UniqueConstraint('customer_id'),
+        sa.UniqueConstraint('phone'),
+    )
+
+
+def _mailing_elements() -> tuple:
+    return (
+        sa.Column('mailing_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('start_date', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.Column('message', sa.String(), nullable=False),
+        sa.Column('filters', sa.Integer(), nullable=True),
+        sa.Column('expiry_date', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.Column('send_from_hour', sa.Integer(), nullable=True),
+        sa.Column('send_to_hour', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('mailing_id'),
+        sa.UniqueConstraint('mailing_id'),
+    )
+
+
+def _message_elements() -> tuple:
+    return (
+        sa.Column('message_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('sending_date', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.Column('status', sa.String(), nullable=True),
+        sa.Column('attempts', sa.Integer(), server_default='1', nullable=False),
+        sa.Column('mailing_id', postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column('customer_id', postgresql.UUID(as_uuid=True), nullable=True),
+        sa.ForeignKeyConstraint(['customer_id'], ['customer.customer_id']),
+        sa.ForeignKeyConstraint(['mailing_id'], ['mailing.mailing_id']),
+        sa.PrimaryKeyConstraint('message_id'),
+        sa.UniqueConstraint('message_id'),
+        sa.UniqueConstraint('mailing_id', 'customer_id', name='uq_message_mailing_id_customer_id'),
+    )
+
+
+def _mailing_counter_elements() -> tuple:
+    return (
+        sa.Column('mailing_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('delivered_count', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('undelivered_count', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('total_count', sa.Integer(), server_default='0', nullable=False),
+        sa.ForeignKeyConstraint(['mailing_id'], ['mailing.mailing_id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('mailing_id'),
+    )
+
+
+def _mailing_outbox_elements() -> tuple:
+    return (
+        sa.Column('outbox_id', sa.BigInteger(), sa.Identity(always=False), nullable=False),
+        sa.Column('mailing_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('customer_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('phone', sa.BigInteger(), nullable=False),
+        sa.Column('code', sa.Integer(), nullable=True),
+        sa.Column('state', sa.String(), server_default='PENDING', nullable=False),
+        sa.ForeignKeyConstraint(['customer_id'], ['customer.customer_id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['mailing_id'], ['mailing.mailing_id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('outbox_id'),
+        sa.UniqueConstraint('mailing_id', 'customer_id', name='uq_mailing_outbox_mailing_id_customer_id'),
+    )
+
+
+def _mailing_checkpoint_elements() -> tuple:
+    return (
+        sa.Column('mailing_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('range_start', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('utc_offset_min', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('last_customer_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.ForeignKeyConstraint(['mailing_id'], ['mailing.mailing_id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('mailing_id', 'range_start', 'utc_offset_min'),
+    )
+
+
+def _create_or_complete_table(name: str, elements: Callable[[], tuple]) -> bool:
+    """
+    Creates the table, or adds the columns, unique constraints and foreign keys it lacks if it already exists.
+    :param name:
+    :param elements: Function outputting the columns and constraints of the table
+    :return: Whether the table is created
+    """
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table(name):
+        op.create_table(name, *elements())
+        return True
+
+    columns = {column['name'] for column in inspector.get_columns(name)}
+    for element in elements():
+        if isinstance(element, sa.Column) and element.name not in columns:
+            op.add_column(name, element)
+
+    unique = {tuple(constraint['column_names']) for constraint in inspector.get_unique_constraints(name)}
+    unique |= {tuple(index['column_names']) for index in inspector.get_indexes(name) if index['unique']}
+    unique.add(tuple(inspector.get_pk_constraint(name)['constrained_columns']))
+    foreign = {
+        (tuple(constraint['constrained_columns']), constraint['referred_table'])
+        for constraint in inspector.get_foreign_keys(name)
+    }
+    table = sa.Table(name, sa.MetaData(), *elements())
+    for constraint in table.constraints:
+        if isinstance(constraint, sa.UniqueConstraint):
+            column_names = tuple(constraint.columns.keys())
+            if column_names not in unique:
+                _deduplicate(name, column_names, constraint.name)
+                op.create_unique_constraint(constraint.name, name, list(column_names))
+        elif isinstance(constraint, sa.ForeignKeyConstraint):
+            referred_table, referred_column = constraint.elements[0].target_fullname.split('.')
+            if (tuple(constraint.column_keys), referred_table) not in foreign:
+                op.create_foreign_key(
+                    None,
+                    name,
+                    referred_table,
+                    constraint.column_keys,
+                    [referred_column],
+                    ondelete=constraint.ondelete
+                )
+    return False
+
+
+def _deduplicate(name: str, column_names: tuple, constraint_name: str | None) -> None:
+    """
+    Drops the duplicates blocking the unique constraint if they can be dropped safely, otherwise stops the migration.
+    :param name:
+    :param column_names:
+    :param constraint_name:
+    :return:
+    """
+    columns = ', '.join(column_names)
+    duplicates = op.get_bind().execute(
+        sa.text(f'SELECT 1 FROM {name} GROUP BY {columns} HAVING count(*) > 1 LIMIT 1')
+    ).first()
+    if duplicates is None:
+        return
+    if constraint_name not in DEDUPLICATE:
+        raise RuntimeError(f'Table {name} has duplicates of ({columns}), resolve them before upgrading.')
+    op.execute(DEDUPLICATE[constraint_name])
+
+
+def upgrade() -> None:
+    _create_or_complete_table('customer', _customer_elements)
+    _create_or_complete_table('mailing', _mailing_elements)
+    _create_or_complete_table('message', _message_elements)
+    if _create_or_complete_table('mailing_counter', _mailing_counter_elements):
+        op.execute(BACKFILL_COUNTERS)
+    _create_or_complete_table('mailing_outbox', _mailing_outbox_elements)
+    op.create_index(
+        'ix_mailing_outbox_mailing_id_state_outbox_id',
+        'mailing_outbox',
+        ['mailing_id', 'state', 'outbox_id'],
+        unique=False,
+        if_not_exists=True
+    )
+    _create_or_complete_table('mailing_checkpoint', _mailing_checkpoint_elements)
+
+
+def downgrade() -> None:
+    op.drop_table('mailing_checkpoint')
+    op.drop_index('ix_mailing_outbox_mailing_id_state_outbox_id', table_name='mailing_outbox')
+    op.drop_table('mailing_outbox')
+    op.drop_table('mailing_counter')
+    op.drop_table('message')
+    op.drop_table('mailing')
+    op.drop_table('customer')
@@ -0,0 +1,37 @@
+"""add hot path indexes
+
+Revision ID: 8e4b0d7c2a15
+Revises: 3f6a2c1d9b70
+Create Date: 2026-10-18 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4b0d7c2a15'
+down_revision = '3f6a2c1d9b70'
+branch_labels = None
+depends_on = None
+
+# Name, table and columns of the indexes. They are built concurrently, so the tables stay writable.
+INDEXES = (
+    ('ix_customer_code_customer_id', 'customer', ['code', 'customer_id']),
+    ('ix_customer_code_utc_offset_min_customer_id', 'customer', ['code', 'utc_offset_min', 'customer_id']),
+    ('ix_message_mailing_id_status_message_id', 'message', ['mailing_id', 'status', 'message_id']),
+    ('ix_message_customer_id', 'message', ['customer_id']),
+    ('ix_mailing_outbox_customer_id', 'mailing_outbox', ['customer_id']),
+)
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
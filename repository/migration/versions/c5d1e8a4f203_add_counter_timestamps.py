@@ -0,0 +1,29 @@
+"""add counter timestamps
+
+Revision ID: c5d1e8a4f203
+Revises: 8e4b0d7c2a15
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d1e8a4f203'
+down_revision = '8e4b0d7c2a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'mailing_counter',
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False)
+    )
+    op.add_column('mailing_counter', sa.Column('reconciled_at', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('mailing_counter', 'reconciled_at')
+    op.drop_column('mailing_counter', 'updated_at')
@@ -0,0 +1,25 @@
+"""add outbox claimed_at
+
+Revision ID: d7a9f3b2e614
+Revises: c5d1e8a4f203
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a9f3b2e614'
+down_revision = 'c5d1e8a4f203'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('mailing_outbox', sa.Column('claimed_at', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.execute("UPDATE mailing_outbox SET state = 'PENDING' WHERE state = 'SENDING'")
+    op.drop_column('mailing_outbox', 'claimed_at')
@@ -0,0 +1,30 @@
+from redis import asyncio as aioredis
+
+from settings import settings
+
+
+_redis: aioredis.Redis | None = None
+
+
+def get_redis() -> aioredis.Redis:
+    """
+    Outputs the redis client of the process. The client and its connection pool are created on first use.
+    :return:
+    """
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(**settings.get_redis_attributes)
+    return _redis
+
+
+async def close_redis() -> None:
+    """
+    Closes the redis client and its connections. The next call creates a new one.
+    :return:
+    """
+    global _redis
+    if _redis is None:
+        return
+    redis, _redis = _redis, None
+    await redis.close()
+    await redis.connection_pool.disconnect()
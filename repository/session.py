@@ -1,20 +1,88 @@
+import time
 from typing import Generator
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from contextlib import asynccontextmanager
 
 from settings import settings
+from utils.db_instrumentation import instrument_engine
+from utils.metrics import DB_POOL_CHECKOUT_WAIT
+
+
+_engine: AsyncEngine | None = None
+_session_factory: sessionmaker | None = None
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Pool of the engine recording how long checkouts wait for a connection in db_pool_checkout_wait_seconds.
+    """
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+def get_engine() -> AsyncEngine:
+    """
+    Outputs the engine of the process. The engine and its connection pool are created on first use, with the hooks
+    timing its statements.
+    :return:
+    """
+    global _engine, _session_factory
+    if _engine is None:
+        _engine = create_async_engine(
+            settings.get_db_url,
+            future=True,
+            echo=False,
+            poolclass=TimedQueuePool,
+            **settings.get_db_pool_attributes
+        )
+        instrument_engine(_engine)
+        _session_factory = sessionmaker(_engine, expire_on_commit=False, class_=AsyncSession)
+    return _engine
+
+
+async def dispose_engine() -> None:
+    """
+    Closes all connections of the pool and drops the engine. The next session creates a new one.
+    :return:
+    """
+    global _engine, _session_factory
+    if _engine is None:
+        return
+    engine, _engine, _session_factory = _engine, None, None
+    await engine.dispose()
+
+
+def get_pool_status() -> dict[str, int]:
+    """
+    Outputs the usage of the connection pool.
+    :return:
+    """
+    if _engine is None:
+        return {'size': 0, 'checked_in': 0, 'checked_out': 0, 'overflow': 0, 'max_capacity': 0}
+    pool = _engine.pool
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'max_capacity': settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW,
+    }
 
 
 def create_db_session() -> AsyncSession:
     """
-    Creates a session.
+    Creates a session bound to the shared engine.
     :return:
     """
-    engine = create_async_engine(settings.get_db_url, future=True, echo=False)
-    async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
-    return async_session()
+    get_engine()
+    return _session_factory()
 
 
 @asynccontextmanager
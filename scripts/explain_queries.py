@@ -0,0 +1,149 @@
+"""
+Runs EXPLAIN on the read queries of the DALs and reports the ones planned with a sequential scan.
+
+The queries are captured from the DAL methods themselves, so the report follows the code. Sequential scans are
+disabled while planning, so a Seq Scan left in a plan means no index can serve the query, whatever the table size.
+Usage: python -m scripts.explain_queries
+"""
+import asyncio
+import json
+import sys
+import uuid
+from typing import Any, Awaitable, Callable
+
+from fastapi import HTTPException
+from sqlalchemy import event
+
+from repository.session import create_db_session, dispose_engine, get_engine
+from services.checkpoint import CheckpointDAL
+from services.counter import CounterDAL
+from services.customer import CustomerDAL
+from services.mailing import MailingDAL
+from services.message import MessageDAL
+
+
+FILTERS = 900
+UTC_OFFSET_MIN = 180
+
+
+async def _consume(stream) -> None:
+    async for _ in stream:
+        pass
+
+
+async def _get_counters(mailing_id: uuid.UUID) -> None:
+    async with create_db_session() as session:
+        await CounterDAL(session).get_counters(mailing_id)
+
+
+def get_dal_queries() -> dict[str, Callable[[], Awaitable[Any]]]:
+    """
+    Outputs the DAL calls whose queries are explained, by name.
+    :return:
+    """
+    return {
+        'CustomerDAL.get_customers': lambda: CustomerDAL(create_db_session()).get_customers(after=uuid.uuid4()),
+        'CustomerDAL.get_customers_chunk_by_filter': lambda: CustomerDAL(
+            create_db_session()
+        ).get_customers_chunk_by_filter(filters=FILTERS, after=uuid.uuid4(), exclude_mailing_id=uuid.uuid4()),
+        'CustomerDAL.get_customers_chunk_by_filter(utc_offset_min)': lambda: CustomerDAL(
+            create_db_session()
+        ).get_customers_chunk_by_filter(
+            filters=FILTERS,
+            utc_offset_min=UTC_OFFSET_MIN,
+            exclude_mailing_id=uuid.uuid4()
+        ),
+        'CustomerDAL.get_time_zones_by_filter': lambda: CustomerDAL(
+            create_db_session()
+        ).get_time_zones_by_filter(filters=FILTERS),
+        'CustomerDAL.get_customer_ranges_by_filter': lambda: CustomerDAL(
+            create_db_session()
+        ).get_customer_ranges_by_filter(filters=FILTERS),
+        'MailingDAL.get_mailing_by_id': lambda: MailingDAL(create_db_session()).get_mailing_by_id(uuid.uuid4()),
+        'MessageDAL.get_messages': lambda: MessageDAL(create_db_session()).get_messages(after=uuid.uuid4()),
+        'MessageDAL.has_retryable_messages': lambda: MessageDAL(
+            create_db_session()
+        ).has_retryable_messages(uuid.uuid4()),
+        'MessageDAL.stream_messages': lambda: _consume(
+            MessageDAL(create_db_session()).stream_messages(mailing_id=uuid.uuid4())
+        ),
+        'MessageDAL.stream_mailing_results': lambda: _consume(
+            MessageDAL(create_db_session()).stream_mailing_results(uuid.uuid4())
+        ),
+        'CounterDAL.get_counters': lambda: _get_counters(uuid.uuid4()),
+        'CheckpointDAL.get_checkpoint': lambda: CheckpointDAL(create_db_session()).get_checkpoint(uuid.uuid4()),
+    }
+
+
+async def capture_queries(call: Callable[[], Awaitable[Any]]) -> list[tuple[str, Any]]:
+    """
+    Runs the DAL call and outputs the SELECT statements it has executed with their parameters.
+    :param call:
+    :return:
+    """
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        if statement.lstrip().upper().startswith('SELECT'):
+            queries.append((statement, parameters))
+
+    sync_engine = get_engine().sync_engine
+    event.listen(sync_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        await call()
+    except HTTPException:
+        pass
+    finally:
+        event.remove(sync_engine, 'before_cursor_execute', before_cursor_execute)
+    return queries
+
+
+def find_seq_scans(plan: dict) -> list[str]:
+    """
+    Outputs the tables scanned sequentially in the plan.
+    :param plan:
+    :return:
+    """
+    tables = [plan['Relation Name']] if plan.get('Node Type') == 'Seq Scan' else []
+    for subplan in plan.get('Plans', ()):
+        tables.extend(find_seq_scans(subplan))
+    return tables
+
+
+async def explain(statement: str, parameters: Any) -> dict:
+    """
+    Outputs the plan of the statement with sequential scans disabled.
+    :param statement:
+    :param parameters:
+    :return:
+    """
+    async with get_engine().connect() as connection:
+        await connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        result = await connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters)
+        plan = result.scalar_one()
+        await connection.rollback()
+    return (json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+
+
+async def main() -> int:
+    """
+    Explains the DAL queries and prints their plans.
+    :return: 1 if any of them is planned with a sequential scan, otherwise 0
+    """
+    regressions = 0
+    try:
+        for name, call in get_dal_queries().items():
+            for statement, parameters in await capture_queries(call):
+                plan = await explain(statement, parameters)
+                seq_scans = find_seq_scans(plan)
+                status = f'SEQ SCAN on {", ".join(seq_scans)}' if seq_scans else 'ok'
+                print(f'{name}: {plan["Node Type"]}, cost {plan["Total Cost"]} - {status}')
+                regressions += bool(seq_scans)
+    finally:
+        await dispose_engine()
+    print(f'{regressions} queries with sequential scans.')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
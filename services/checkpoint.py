@@ -0,0 +1,104 @@
+import uuid
+from typing import Iterable
+
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
+
+from models.db import Mailing, MailingCheckpoint
+from services.dals import BaseDAL
+from utils.decorators import catch_exceptions, services_request
+
+
+# range_start of a mailing sent without splitting into customer_id ranges.
+FULL_RANGE = uuid.UUID(int=0)
+
+
+class CheckpointDAL(BaseDAL):
+    # Describes the progress of mailing runs, so a redelivered run resumes where the previous one stopped.
+    @services_request
+    @catch_exceptions
+    async def get_checkpoint(
+            self,
+            mailing_id: uuid.UUID,
+            range_start: uuid.UUID = FULL_RANGE,
+            utc_offset_min: int = 0
+    ) -> uuid.UUID | None:
+        """
+        Outputs the last customer_id of the range whose message of the mailing is stored.
+        :param mailing_id:
+        :param range_start: Inclusive lower bound of customer_id of the sender
+        :param utc_offset_min: UTC offset bucket of the sender, 0 if the mailing has no delivery window
+        :return: customer_id or None if the range is not started
+        """
+        result = await self.db_session.execute(
+            select(MailingCheckpoint.last_customer_id)
+            .where(
+                MailingCheckpoint.mailing_id == mailing_id,
+                MailingCheckpoint.range_start == range_start,
+                MailingCheckpoint.utc_offset_min == utc_offset_min,
+            )
+        )
+        return result.scalar_one_or_none()
+
+    @services_request
+    @catch_exceptions
+    async def save_checkpoint(
+            self,
+            mailing_id: uuid.UUID,
+            last_customer_id: uuid.UUID,
+            range_start: uuid.UUID = FULL_RANGE,
+            utc_offset_min: int = 0
+    ) -> None:
+        """
+        Moves the checkpoint of the range forward to last_customer_id. The checkpoint never moves back, so a stale
+        sender can not make a rerun repeat the work.
+        :param mailing_id:
+        :param last_customer_id:
+        :param range_start: Inclusive lower bound of customer_id of the sender
+        :param utc_offset_min: UTC offset bucket of the sender, 0 if the mailing has no delivery window
+        :return:
+        """
+        query = insert(MailingCheckpoint).values(
+            mailing_id=mailing_id,
+            range_start=range_start,
+            utc_offset_min=utc_offset_min,
+            last_customer_id=last_customer_id
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[
+                MailingCheckpoint.mailing_id,
+                MailingCheckpoint.range_start,
+                MailingCheckpoint.utc_offset_min,
+            ],
+            set_={'last_customer_id': query.excluded.last_customer_id},
+            where=MailingCheckpoint.last_customer_id < query.excluded.last_customer_id
+        )
+        await self.db_session.execute(query)
+        await self.db_session.commit()
+
+    async def reset_checkpoints(self, mailing_id: uuid.UUID) -> None:
+        """
+        Drops the checkpoints of the mailing, e.g. when its filters are changed. Does not commit, so the checkpoints
+        are dropped in the same transaction as the mailing is changed.
+        :param mailing_id:
+        :return:
+        """
+        await self.db_session.execute(delete(MailingCheckpoint).where(MailingCheckpoint.mailing_id == mailing_id))
+
+    async def reset_bucket_checkpoints(self, filters: int, utc_offsets: Iterable[int]) -> None:
+        """
+        Drops the checkpoints of the UTC offset buckets of the mailings by filter, e.g. when customers are moved into
+        these buckets after a change of daylight saving time and may sort before the checkpoints. Does not commit, so
+        the checkpoints are dropped in the same transaction as the customers are moved.
+        :param filters:
+        :param utc_offsets: UTC offsets in minutes of the buckets
+        :return:
+        """
+        await self.db_session.execute(
+            delete(MailingCheckpoint)
+            .where(
+                MailingCheckpoint.mailing_id.in_(select(Mailing.mailing_id).where(Mailing.filters == filters)),
+                MailingCheckpoint.utc_offset_min.in_(sorted(set(utc_offsets))),
+            )
+            .execution_options(synchronize_session=False)
+        )
@@ -0,0 +1,198 @@
+import datetime
+import logging
+import uuid
+from collections import defaultdict
+from typing import Iterable, Sequence
+
+from sqlalchemy import select, func, or_, update
+from sqlalchemy.dialects.postgresql import insert
+
+from models.db import Mailing, MailingCounter, Message, MessageStates
+from repository.session import create_db_session
+from services.dals import BaseDAL
+from settings import settings
+from utils.cache import MESSAGE_NAMESPACE
+from utils.decorators import catch_exceptions, services_request, invalidate_cache
+from utils.time_utils import get_current_date
+
+
+logger = logging.getLogger("uvicorn")
+
+
+MessagesCounts = dict[uuid.UUID, dict[str, int]]
+
+
+class CounterDAL(BaseDAL):
+    # Describes the per-mailing message counters.
+    async def increment_counters(self, messages: Iterable[dict]) -> None:
+        """
+        Adds the messages to the counters of their mailings. Does not commit, so the counters are changed in the same
+        transaction as the messages themselves.
+        :param messages: Dicts with mailing_id and status keys
+        :return:
+        """
+        counters = defaultdict(lambda: {'delivered_count': 0, 'undelivered_count': 0, 'total_count': 0})
+        for message in messages:
+            if message['mailing_id'] is None:
+                continue
+            counter = counters[message['mailing_id']]
+            if MessageStates(message['status']) is MessageStates.DELIVERED:
+                counter['delivered_count'] += 1
+            else:
+                counter['undelivered_count'] += 1
+            counter['total_count'] += 1
+
+        if not counters:
+            return
+
+        # Rows are locked in a stable order, so concurrent batches of several mailings can not deadlock.
+        query = insert(MailingCounter).values([
+            {'mailing_id': mailing_id, **counters[mailing_id]} for mailing_id in sorted(counters)
+        ])
+        query = query.on_conflict_do_update(
+            index_elements=[MailingCounter.mailing_id],
+            set_={
+                'delivered_count': MailingCounter.delivered_count + query.excluded.delivered_count,
+                'undelivered_count': MailingCounter.undelivered_count + query.excluded.undelivered_count,
+                'total_count': MailingCounter.total_count + query.excluded.total_count,
+                'updated_at': func.now(),
+            }
+        )
+        await self.db_session.execute(query)
+
+    async def move_to_delivered(self, counts: dict[uuid.UUID, int]) -> None:
+        """
+        Moves redelivered messages from the undelivered counters of their mailings to the delivered ones. Does not
+        commit, so the counters are changed in the same transaction as the messages themselves.
+        :param counts: Numbers of redelivered messages by mailing_id
+        :return:
+        """
+        for mailing_id in sorted(counts):
+            await self.db_session.execute(
+                update(MailingCounter)
+                .where(MailingCounter.mailing_id == mailing_id)
+                .values(
+                    delivered_count=MailingCounter.delivered_count + counts[mailing_id],
+                    undelivered_count=MailingCounter.undelivered_count - counts[mailing_id],
+                    updated_at=func.now(),
+                )
+            )
+
+    async def get_counters(self, mailing_id: uuid.UUID | None = None) -> MessagesCounts:
+        """
+        Outputs counts of messages by states by mailing_id.
+        :param mailing_id: Outputs only the counters of this mailing if passed
+        :return:
+        """
+        query = select(MailingCounter.mailing_id, MailingCounter.delivered_count, MailingCounter.undelivered_count)
+        if mailing_id is not None:
+            query = query.where(MailingCounter.mailing_id == mailing_id)
+        result = await self.db_session.execute(query)
+        return {
+            counter_mailing_id: {
+                MessageStates.DELIVERED.value: delivered_count,
+                MessageStates.UNDELIVERED.value: undelivered_count,
+            }
+            for counter_mailing_id, delivered_count, undelivered_count in result
+        }
+
+    @services_request
+    @catch_exceptions
+    async def get_mailings_to_reconcile(self) -> list[uuid.UUID]:
+        """
+        Outputs mailing_id of the mailings whose counters have changed since they were rebuilt and which are finished
+        (expired) or stale (not changed for settings.COUNTERS_RECONCILE_IDLE_SEC, e.g. after a crashed sender).
+        Counters of running mailings are left to their senders.
+        :return:
+        """
+        now = get_current_date()
+        idle_since = now - datetime.timedelta(seconds=settings.COUNTERS_RECONCILE_IDLE_SEC)
+        result = await self.db_session.execute(
+            select(MailingCounter.mailing_id)
+            .join(Mailing, Mailing.mailing_id == MailingCounter.mailing_id)
+            .where(
+                or_(MailingCounter.reconciled_at.is_(None), MailingCounter.reconciled_at < MailingCounter.updated_at),
+                or_(Mailing.expiry_date <= now, MailingCounter.updated_at < idle_since),
+            )
+            .order_by(MailingCounter.mailing_id)
+        )
+        return list(result.scalars())
+
+    @invalidate_cache(MESSAGE_NAMESPACE)
+    @services_request
+    @catch_exceptions
+    async def reconcile_counters(self, mailing_ids: Sequence[uuid.UUID]) -> None:
+        """
+        Rebuilds the counters of the mailings from the message table. Only the counter rows of these mailings are
+        locked, in the order of mailing_id like increment_counters does, so the senders of other mailings are not
+        blocked and concurrent transactions can not deadlock. Messages written concurrently are counted either by the
+        rebuild or by their own increment, never by both.
+        :param mailing_ids:
+        :return:
+        """
+        mailing_ids = sorted(set(mailing_ids))
+        if not mailing_ids:
+            return
+
+        # Mailings without a counter get an empty one, so it is locked as well.
+        await self.db_session.execute(
+            insert(MailingCounter)
+            .from_select(
+                ['mailing_id'],
+                select(Mailing.mailing_id).where(Mailing.mailing_id.in_(mailing_ids)).order_by(Mailing.mailing_id)
+            )
+            .on_conflict_do_nothing(index_elements=[MailingCounter.mailing_id])
+        )
+        await self.db_session.execute(
+            select(MailingCounter.mailing_id)
+            .where(MailingCounter.mailing_id.in_(mailing_ids))
+            .order_by(MailingCounter.mailing_id)
+            .with_for_update()
+        )
+
+        counts = (
+            select(
+                Message.mailing_id,
+                func.count().filter(Message.status == MessageStates.DELIVERED.value).label('delivered_count'),
+                func.count().filter(Message.status != MessageStates.DELIVERED.value).label('undelivered_count'),
+                func.count().label('total_count'),
+            )
+            .where(Message.mailing_id.in_(mailing_ids))
+            .group_by(Message.mailing_id)
+            .subquery()
+        )
+        await self.db_session.execute(
+            update(MailingCounter)
+            .where(MailingCounter.mailing_id.in_(mailing_ids))
+            .values(delivered_count=0, undelivered_count=0, total_count=0, reconciled_at=func.now())
+        )
+        await self.db_session.execute(
+            update(MailingCounter)
+            .where(MailingCounter.mailing_id == counts.c.mailing_id)
+            .values(
+                delivered_count=counts.c.delivered_count,
+                undelivered_count=counts.c.undelivered_count,
+                total_count=counts.c.total_count,
+            )
+        )
+        await self.db_session.commit()
+
+    @staticmethod
+    @catch_exceptions
+    async def reconcile_mailings(mailing_id: uuid.UUID | None = None) -> int:
+        """
+        Rebuilds the counters of the mailing, or of the finished and stale mailings, by batches of
+        settings.COUNTERS_RECONCILE_BATCH_SIZE mailings in short transactions.
+        :param mailing_id: Rebuilds only the counters of this mailing if passed
+        :return: Number of rebuilt counters
+        """
+        if mailing_id is not None:
+            mailing_ids = [mailing_id]
+        else:
+            mailing_ids = await CounterDAL(create_db_session()).get_mailings_to_reconcile()
+
+        batch_size = settings.COUNTERS_RECONCILE_BATCH_SIZE
+        for start in range(0, len(mailing_ids), batch_size):
+            await CounterDAL(create_db_session()).reconcile_counters(mailing_ids[start:start + batch_size])
+        logger.info(f'Counters of {len(mailing_ids)} mailings are rebuilt.')
+        return len(mailing_ids)
@@ -1,17 +1,36 @@
+import csv
+import json
+import math
 import uuid
-from typing import Generator
+from dataclasses import dataclass
+from typing import AsyncIterator, Generator, Mapping, Sequence
 
 from fastapi import HTTPException
-from sqlalchemy import select, delete
+from sqlalchemy import select, delete, func, exists, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Row
 
-from models.db import Customer
+from models.db import Customer, Message
 from repository.session import create_db_session
+from services.checkpoint import CheckpointDAL
 from services.dals import BaseDAL
-from utils.decorators import catch_exceptions, services_request
+from settings import settings
+from utils.cache import CUSTOMER_NAMESPACE, MESSAGE_NAMESPACE
+from utils.decorators import catch_exceptions, services_request, services_stream, invalidate_cache
+from utils.file_utils import FileFormats, iter_csv_records
+from utils.time_utils import get_utc_offset_min
+from utils.validation import validate_phone, validate_code, validate_empty
 
 
 class CustomerDAL(BaseDAL):
     # Contains the customer's business logic.
+    @dataclass(kw_only=True, slots=True)
+    class ImportStats:
+        accepted_count: int
+        rejected_count: int
+        errors: list[str]
+
+    @invalidate_cache(CUSTOMER_NAMESPACE)
     @services_request
     @catch_exceptions
     async def create_customer(self, phone: int, code: int, time_zone: str) -> Customer:
@@ -22,7 +41,12 @@ class CustomerDAL(BaseDAL):
         :param time_zone:
         :return: Customer in database
         """
-        new_customer = Customer(phone=phone, code=code, time_zone=time_zone)
+        new_customer = Customer(
+            phone=phone,
+            code=code,
+            time_zone=time_zone,
+            utc_offset_min=get_utc_offset_min(time_zone)
+        )
         self.db_session.add(new_customer)
         await self.db_session.flush()
         return new_customer
@@ -32,19 +56,25 @@ class CustomerDAL(BaseDAL):
     async def get_customers(
             self,
             limit: int = 10,
-            offset: int = 0,
+            after: uuid.UUID | None = None,
             pagination: bool = True
     ) -> Generator[Customer, None, None]:
         """
-        Get list of customer from database.
+        Get list of customer from database ordered by customer_id.
+        :param limit:
+        :param after: Last customer_id of the previous page
+        :param pagination:
         :return: List of customers
         """
+        query = select(Customer).order_by(Customer.customer_id)
+        if after is not None:
+            query = query.where(Customer.customer_id > after)
         if pagination:
-            customers = await self.db_session.execute(select(Customer).limit(limit).offset(offset))
-        else:
-            customers = await self.db_session.execute(select(Customer))
+            query = query.limit(limit)
+        customers = await self.db_session.execute(query)
         return (item for item in customers.scalars())
 
+    @invalidate_cache(CUSTOMER_NAMESPACE)
     @services_request
     @catch_exceptions
     async def edit_customer(self, customer_id: uuid.UUID, phone: int, code: int, time_zone: str) -> Customer:
@@ -61,6 +91,7 @@ class CustomerDAL(BaseDAL):
         customer.phone_number = phone
         customer.mobile_code = code
         customer.time_zone = time_zone
+        customer.utc_offset_min = get_utc_offset_min(time_zone)
         await self.db_session.commit()
         return customer
 
@@ -76,6 +107,7 @@ class CustomerDAL(BaseDAL):
         customer = result.scalars().one()
         return customer
 
+    @invalidate_cache(CUSTOMER_NAMESPACE, MESSAGE_NAMESPACE)
     @services_request
     @catch_exceptions
     async def delete_customer(self, customer_id: uuid.UUID) -> Customer:
@@ -104,3 +136,308 @@ class CustomerDAL(BaseDAL):
         """
         customers = await self.db_session.execute(select(Customer).where(Customer.code == filters))
         return (item for item in customers.scalars())
+
+    @services_request
+    @catch_exceptions
+    async def get_customers_chunk_by_filter(
+            self,
+            filters: int,
+            after: uuid.UUID | None = None,
+            limit: int = settings.CUSTOMER_CHUNK_SIZE,
+            lower: uuid.UUID | None = None,
+            upper: uuid.UUID | None = None,
+            exclude_mailing_id: uuid.UUID | None = None,
+            utc_offset_min: int | None = None
+    ) -> Sequence[Row]:
+        """
+        Outputs the next chunk of customers by filter ordered by customer_id. Only the columns needed for sending are
+        loaded, without ORM objects.
+        :param filters:
+        :param after: Last customer_id of the previous chunk
+        :param limit:
+        :param lower: Inclusive lower bound of customer_id
+        :param upper: Exclusive upper bound of customer_id
+        :param exclude_mailing_id: Skips the customers that already have a message of this mailing if passed
+        :param utc_offset_min: Outputs only the customers with this UTC offset if passed
+        :return: Rows with customer_id, phone, code and time_zone
+        """
+        query = (
+            select(Customer.customer_id, Customer.phone, Customer.code, Customer.time_zone)
+            .where(Customer.code == filters)
+            .order_by(Customer.customer_id)
+            .limit(limit)
+        )
+        if after is not None:
+            query = query.where(Customer.customer_id > after)
+        if lower is not None:
+            query = query.where(Customer.customer_id >= lower)
+        if upper is not None:
+            query = query.where(Customer.customer_id < upper)
+        if utc_offset_min is not None:
+            query = query.where(Customer.utc_offset_min == utc_offset_min)
+        if exclude_mailing_id is not None:
+            query = query.where(~exists().where(
+                Message.mailing_id == exclude_mailing_id,
+                Message.customer_id == Customer.customer_id
+            ))
+        result = await self.db_session.execute(query)
+        return result.all()
+
+    @services_request
+    @catch_exceptions
+    async def get_time_zones_by_filter(self, filters: int) -> dict[tuple[str | None, int], int]:
+        """
+        Groups the customers by filter by their time zone and stored UTC offset with one grouped query.
+        :param filters:
+        :return: Numbers of customers by time zone and UTC offset in minutes
+        """
+        result = await self.db_session.execute(
+            select(Customer.time_zone, Customer.utc_offset_min, func.count())
+            .where(Customer.code == filters)
+            .group_by(Customer.time_zone, Customer.utc_offset_min)
+        )
+        return {(time_zone, utc_offset_min): count for time_zone, utc_offset_min, count in result.all()}
+
+    @services_request
+    @catch_exceptions
+    async def update_utc_offsets(self, filters: int, utc_offsets: dict[str, int]) -> int:
+        """
+        Stores the current UTC offsets of the time zones of the customers by filter, e.g. after daylight saving time
+        has started or ended. The checkpoints of the buckets receiving customers are dropped in the same transaction,
+        so the moved customers are not skipped by the resumed runs of these buckets.
+        :param filters:
+        :param utc_offsets: UTC offsets in minutes by time zone
+        :return: Number of updated customers
+        """
+        count = 0
+        for time_zone in sorted(utc_offsets):
+            result = await self.db_session.execute(
+                update(Customer)
+                .where(
+                    Customer.code == filters,
+                    Customer.time_zone == time_zone,
+                    Customer.utc_offset_min != utc_offsets[time_zone],
+                )
+                .values(utc_offset_min=utc_offsets[time_zone])
+                .execution_options(synchronize_session=False)
+            )
+            count += result.rowcount
+        if count:
+            await CheckpointDAL(self.db_session).reset_bucket_checkpoints(filters, utc_offsets.values())
+        await self.db_session.commit()
+        return count
+
+    @services_request
+    @catch_exceptions
+    async def get_customer_ranges_by_filter(
+            self,
+            filters: int,
+            chunk_size: int = settings.MAILING_CHUNK_SIZE,
+            max_chunks: int = settings.MAILING_MAX_PARALLEL_CHUNKS
+    ) -> list[tuple[uuid.UUID, uuid.UUID | None]]:
+        """
+        Splits customers by filter into customer_id ranges of chunk_size customers. The chunk size is increased if
+        needed, so there are no more than max_chunks ranges.
+        :param filters:
+        :param chunk_size:
+        :param max_chunks:
+        :return: Inclusive lower and exclusive upper bounds of the ranges, the last upper bound is None
+        """
+        result = await self.db_session.execute(select(func.count()).where(Customer.code == filters))
+        count = result.scalar()
+        if not count:
+            return []
+        chunk_size = max(chunk_size, math.ceil(count / max_chunks))
+
+        numbered = (
+            select(Customer.customer_id, func.row_number().over(order_by=Customer.customer_id).label('number'))
+            .where(Customer.code == filters)
+            .subquery()
+        )
+        result = await self.db_session.execute(
+            select(numbered.c.customer_id)
+            .where((numbered.c.number - 1) % chunk_size == 0)
+            .order_by(numbered.c.customer_id)
+        )
+        bounds = result.scalars().all()
+        return list(zip(bounds, [*bounds[1:], None]))
+
+    @staticmethod
+    async def iter_customer_chunks_by_filter(
+            filters: int,
+            chunk_size: int = settings.CUSTOMER_CHUNK_SIZE,
+            lower: uuid.UUID | None = None,
+            upper: uuid.UUID | None = None,
+            after: uuid.UUID | None = None,
+            exclude_mailing_id: uuid.UUID | None = None,
+            utc_offset_min: int | None = None
+    ) -> AsyncIterator[Sequence[Row]]:
+        """
+        Lazily outputs chunks of customers by filter. Customers are read in keyset chunks over customer_id, each in its
+        own short session, so no more than one chunk is held in memory and no connection is held between chunks.
+        :param filters:
+        :param chunk_size:
+        :param lower: Inclusive lower bound of customer_id
+        :param upper: Exclusive upper bound of customer_id
+        :param after: Starts after this customer_id if passed
+        :param exclude_mailing_id: Skips the customers that already have a message of this mailing if passed
+        :param utc_offset_min: Outputs only the customers with this UTC offset if passed
+        :return: Chunks of customers async iterator
+        """
+        while True:
+            chunk = await CustomerDAL(create_db_session()).get_customers_chunk_by_filter(
+                filters=filters,
+                after=after,
+                limit=chunk_size,
+                lower=lower,
+                upper=upper,
+                exclude_mailing_id=exclude_mailing_id,
+                utc_offset_min=utc_offset_min
+            )
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1].customer_id
+
+    @staticmethod
+    async def iter_customers_by_filter(
+            filters: int,
+            chunk_size: int = settings.CUSTOMER_CHUNK_SIZE,
+            lower: uuid.UUID | None = None,
+            upper: uuid.UUID | None = None
+    ) -> AsyncIterator[Row]:
+        """
+        Lazily outputs customers by filter, read by CustomerDAL.iter_customer_chunks_by_filter.
+        :param filters:
+        :param chunk_size:
+        :param lower: Inclusive lower bound of customer_id
+        :param upper: Exclusive upper bound of customer_id
+        :return: Customers async iterator
+        """
+        async for chunk in CustomerDAL.iter_customer_chunks_by_filter(filters, chunk_size, lower, upper):
+            for customer in chunk:
+                yield customer
+
+    @services_stream
+    async def stream_customers(self, code: int | None = None) -> AsyncIterator[Mapping]:
+        """
+        Outputs customers through a server-side cursor ordered by customer_id.
+        :param code: Outputs only the customers of this operator code if passed
+        :return: Customers mappings
+        """
+        query = select(Customer.customer_id, Customer.phone, Customer.code, Customer.time_zone)
+        if code is not None:
+            query = query.where(Customer.code == code)
+        query = query.order_by(Customer.customer_id).execution_options(yield_per=settings.EXPORT_YIELD_PER)
+        result = await self.db_session.stream(query)
+        async for customer in result.mappings():
+            yield customer
+
+    @invalidate_cache(CUSTOMER_NAMESPACE)
+    @services_request
+    @catch_exceptions
+    async def upsert_customers(self, customers: list[dict]) -> int:
+        """
+        Creates customers with one multi-row insert. Customers whose phone is already taken are updated.
+        :param customers: Dicts with phone, code and time_zone keys, phones must be unique
+        :return: Number of created or updated customers
+        """
+        if not customers:
+            return 0
+        query = insert(Customer).values([{'customer_id': uuid.uuid4(), **customer} for customer in customers])
+        query = query.on_conflict_do_update(
+            index_elements=[Customer.phone],
+            set_={
+                'code': query.excluded.code,
+                'time_zone': query.excluded.time_zone,
+                'utc_offset_min': query.excluded.utc_offset_min,
+            }
+        )
+        await self.db_session.execute(query)
+        await self.db_session.commit()
+        return len(customers)
+
+    @staticmethod
+    async def import_customers(
+            lines: AsyncIterator[str],
+            file_format: FileFormats,
+            batch_size: int = settings.CUSTOMER_IMPORT_BATCH_SIZE
+    ) -> ImportStats:
+        """
+        Validates customers from CSV (with phone, code, time_zone header) or NDJSON lines and upserts them by phone in
+        batches. Invalid rows are rejected and do not stop the import.
+        :param lines:
+        :param file_format:
+        :param batch_size:
+        :return: Import statistics
+        """
+        stats = CustomerDAL.ImportStats(accepted_count=0, rejected_count=0, errors=[])
+        batch: dict[int, dict] = {}
+        header = None
+
+        async for line_number, record in CustomerDAL._iter_import_records(lines, file_format):
+            try:
+                if isinstance(record, csv.Error):
+                    raise record
+                if file_format is FileFormats.CSV:
+                    if header is None:
+                        header = [value.strip() for value in record]
+                        continue
+                    fields = dict(zip(header, record))
+                else:
+                    fields = json.loads(record)
+                customer = CustomerDAL._parse_customer(fields)
+            except (HTTPException, ValueError, TypeError, KeyError, csv.Error) as e:
+                stats.rejected_count += 1
+                if len(stats.errors) < settings.CUSTOMER_IMPORT_MAX_ERRORS:
+                    stats.errors.append(f'line {line_number}: {getattr(e, "detail", None) or e!r}')
+                continue
+
+            # A phone may occur once per insert, the later row wins.
+            batch[customer['phone']] = customer
+            stats.accepted_count += 1
+            if len(batch) >= batch_size:
+                await CustomerDAL(create_db_session()).upsert_customers(list(batch.values()))
+                batch = {}
+
+        await CustomerDAL(create_db_session()).upsert_customers(list(batch.values()))
+        return stats
+
+    @staticmethod
+    async def _iter_import_records(
+            lines: AsyncIterator[str],
+            file_format: FileFormats
+    ) -> AsyncIterator[tuple[int, list[str] | str | csv.Error]]:
+        """
+        Outputs the records of the imported file with the number of their first line. CSV is parsed with one reader
+        over all lines, so quoted fields may contain line breaks, NDJSON has one record per line. Blank records are
+        skipped.
+        :param lines:
+        :param file_format:
+        :return:
+        """
+        if file_format is FileFormats.CSV:
+            async for line_number, record in iter_csv_records(lines):
+                yield line_number, record
+            return
+        line_number = 0
+        async for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+
+    @staticmethod
+    def _parse_customer(fields: dict) -> dict:
+        """
+        Converts the fields of an imported row into customer values with the rules of the customer schemes.
+        :param fields:
+        :return:
+        """
+        time_zone = validate_empty(str(fields['time_zone']).strip())
+        return {
+            'phone': validate_phone(int(fields['phone'])),
+            'code': validate_code(int(fields['code'])),
+            'time_zone': time_zone,
+            'utc_offset_min': get_utc_offset_min(time_zone),
+        }
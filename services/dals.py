@@ -13,3 +13,13 @@ class BaseDAL:
 class ResponseCode(NamedTuple):
     code: int
     message: str
+
+
+MAILING_COMPLETED = ResponseCode(code=200, message='Mailing successfully completed')
+MAILING_COMPLETED_WITH_ERRORS = ResponseCode(code=200, message='Mailing completed successfully, but with errors.')
+MAILING_EXPIRED = ResponseCode(code=408, message='Mailing deadline expired')
+MAILING_OVERWRITTEN = ResponseCode(code=410, message='The task is overwritten.')
+MAILING_SCHEDULED = ResponseCode(code=202, message='Mailing is scheduled by delivery windows.')
+MAILING_QUEUED = ResponseCode(code=202, message='Mailing is queued for sending.')
+MAILING_WINDOW_CLOSED = ResponseCode(code=202, message='Delivery window is closed, the mailing is postponed.')
+MAILING_IN_PROGRESS = ResponseCode(code=202, message='Recipients of the mailing are being sent by other workers.')
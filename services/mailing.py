@@ -1,30 +1,25 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from datetime import datetime
 import uuid
-from typing import NamedTuple
 import pandas as pd
 
 from fastapi import HTTPException
 from sqlalchemy import select, delete
-from sqlalchemy.orm import selectinload
 
 from models.schemas.mailing import ShowStatisticsByMailing, ShowStatisticsMailings
-from models.schemas.message import ShowMessages, ShowMessage
 from repository.session import create_db_session
 from models.db import Mailing, MessageStates
-from services.dals import BaseDAL, ResponseCode
+from services.checkpoint import CheckpointDAL
+from services.counter import CounterDAL, MessagesCounts
+from services.dals import BaseDAL, ResponseCode, MAILING_QUEUED, MAILING_SCHEDULED
 from settings import settings
-from utils.async_utils import async_generator
-from utils.decorators import catch_exceptions, services_request
+from utils.cache import MAILING_NAMESPACE, MESSAGE_NAMESPACE
+from utils.decorators import catch_exceptions, services_request, invalidate_cache
 from utils.time_utils import get_current_date
 from tasks.tasks import run_mailing
 
 
 class MailingDAL(BaseDAL):
-    class MessagesListsByStates(NamedTuple):
-        delivered_messages: ShowMessages
-        undelivered_messages: ShowMessages
-
     @dataclass(kw_only=True, slots=True)
     class MailingStats:
         completed_mailings_count: int
@@ -33,23 +28,42 @@ class MailingDAL(BaseDAL):
         total_undelivered_messages: int
         mailings: list[ShowStatisticsByMailing]
 
+    @invalidate_cache(MAILING_NAMESPACE)
     @catch_exceptions
     @services_request
-    async def create_mailing(self, start_date: datetime, message: str, filters: int, expiry_date: datetime) -> Mailing:
+    async def create_mailing(
+            self,
+            start_date: datetime,
+            message: str,
+            filters: int,
+            expiry_date: datetime,
+            send_from_hour: int | None = None,
+            send_to_hour: int | None = None
+    ) -> Mailing:
         """
         Creates a mailing list in a database.
         :param start_date:
         :param message:
         :param filters:
         :param expiry_date:
+        :param send_from_hour: Local hour the delivery window opens at, no window if not passed
+        :param send_to_hour: Local hour the delivery window closes at
         :return:
         """
-        new_mailing = Mailing(start_date=start_date, message=message, filters=filters, expiry_date=expiry_date)
+        new_mailing = Mailing(
+            start_date=start_date,
+            message=message,
+            filters=filters,
+            expiry_date=expiry_date,
+            send_from_hour=send_from_hour,
+            send_to_hour=send_to_hour
+        )
         self.db_session.add(new_mailing)
         await self.db_session.commit()
         run_mailing.apply_async(args=(new_mailing.mailing_id,), eta=start_date)
         return new_mailing
 
+    @invalidate_cache(MAILING_NAMESPACE)
     @services_request
     @catch_exceptions
     async def edit_mailing(
@@ -58,7 +72,9 @@ class MailingDAL(BaseDAL):
             start_date: datetime,
             message: str,
             filters: int,
-            expiry_date: datetime
+            expiry_date: datetime,
+            send_from_hour: int | None = None,
+            send_to_hour: int | None = None
     ) -> Mailing:
         """
         Edit a mailing list in a database.
@@ -67,6 +83,8 @@ class MailingDAL(BaseDAL):
         :param message:
         :param filters:
         :param expiry_date:
+        :param send_from_hour: Local hour the delivery window opens at, no window if not passed
+        :param send_to_hour: Local hour the delivery window closes at
         :return:
         """
         result = await self.db_session.execute(select(Mailing).where(Mailing.mailing_id == mailing_id))
@@ -75,6 +93,10 @@ class MailingDAL(BaseDAL):
         mailing.message = message
         mailing.filters = filters
         mailing.expiry_date = expiry_date
+        mailing.send_from_hour = send_from_hour
+        mailing.send_to_hour = send_to_hour
+        # The filters may have changed, so the next run scans all customers again, skipping the sent ones.
+        await CheckpointDAL(self.db_session).reset_checkpoints(mailing_id)
         await self.db_session.commit()
         run_mailing.apply_async(args=(mailing_id,), eta=start_date)
         return mailing
@@ -87,6 +109,7 @@ class MailingDAL(BaseDAL):
             return False
         return mailing
 
+    @invalidate_cache(MAILING_NAMESPACE, MESSAGE_NAMESPACE)
     @services_request
     @catch_exceptions
     async def delete_mailing(self, mailing_id: uuid.UUID) -> Mailing:
@@ -120,76 +143,82 @@ class MailingDAL(BaseDAL):
     @catch_exceptions
     async def send_mailing(self, mailing_id: uuid.UUID) -> ResponseCode:
         """
-        Starts mailing by customer_id.
+        Starts mailing by customer_id. The mailing is only queued: it is sent by the run scheduled on its change, in
+        the dispatch mode of the workers, so the request never sends it alongside the run. A mailing with a delivery
+        window is sent bucket by bucket as the windows open.
         :param mailing_id:
         :return:
         """
-        from services.message import MessageDAL
-
         mailing = await self.get_mailing_by_id(mailing_id)
         await MailingDAL(create_db_session()).edit_mailing(
-            id=mailing.mailing_id,
+            mailing_id=mailing.mailing_id,
             start_date=get_current_date(),
             message=mailing.message,
             filters=mailing.filters,
-            expiry_date=get_current_date() + pd.DateOffset(minutes=settings.MAILING_OFFSET_MIN)
+            expiry_date=get_current_date() + pd.DateOffset(minutes=settings.MAILING_OFFSET_MIN),
+            send_from_hour=mailing.send_from_hour,
+            send_to_hour=mailing.send_to_hour
         )
-        return await MessageDAL.send_messages(mailing_id)
+        if mailing.send_from_hour is not None:
+            return MAILING_SCHEDULED
+        return MAILING_QUEUED
 
     @services_request
     @catch_exceptions
     async def get_statistics_by_mailing(self, mailing_id: uuid.UUID) -> ShowStatisticsByMailing:
         """
-        Outputs statistics on the mailing list customer_id.
+        Outputs statistics on the mailing list customer_id. Messages counts are read from the mailing counters.
         :param mailing_id:
         :return:
         """
-        current_datetime = get_current_date()
-
-        query = select(Mailing).options(selectinload(Mailing.messages)).where(Mailing.mailing_id == mailing_id)
-        result = await self.db_session.execute(query)
+        result = await self.db_session.execute(select(Mailing).where(Mailing.mailing_id == mailing_id))
         mailing = result.scalar()
 
         if not mailing:
             raise HTTPException(status_code=404, detail='Mailing is not found')
 
-        if mailing.expiry_date > current_datetime:
-            return ShowStatisticsByMailing(
-                **mailing.__dict__,
-                delivered_count=0,
-                undelivered_count=0,
-                delivered_messages=ShowMessages(messages=[]),
-                undelivered_messages=ShowMessages(messages=[]),
-            )
-
-        delivered_messages, undelivered_messages = await MailingDAL._split_messages_by_states(mailing)
-
-        return ShowStatisticsByMailing(
-            **mailing.__dict__,
-            delivered_count=len(delivered_messages.messages),
-            undelivered_count=len(undelivered_messages.messages),
-            delivered_messages=delivered_messages,
-            undelivered_messages=undelivered_messages,
-        )
+        counts = await CounterDAL(self.db_session).get_counters(mailing_id)
+        return MailingDAL._pack_statistics_by_mailing(mailing, counts, get_current_date())
 
     @services_request
     @catch_exceptions
     async def get_statistics_mailings(self) -> ShowStatisticsMailings:
         """
-        Outputs statistics on all mailings.
+        Outputs statistics on all mailings. Messages counts of all mailings are read from the mailing counters.
         :return:
         """
-        query = select(Mailing).options(selectinload(Mailing.messages))
-        result = await self.db_session.execute(query)
+        result = await self.db_session.execute(select(Mailing))
         mailings = result.scalars().all()
-        statistics = await MailingDAL._counting_statistics_by_mailings(mailings)
-        return ShowStatisticsMailings(**asdict(statistics))
+        counts = await CounterDAL(self.db_session).get_counters()
+        statistics = MailingDAL._counting_statistics_by_mailings(mailings, counts)
+        return ShowStatisticsMailings.from_db(statistics)
 
     @staticmethod
-    async def _counting_statistics_by_mailings(mailings: Mailing) -> MailingStats:
+    def _pack_statistics_by_mailing(
+            mailing: Mailing,
+            counts: MessagesCounts,
+            current_datetime: datetime
+    ) -> ShowStatisticsByMailing:
+        """
+        Packs the mailing with its message counts. A mailing that has not expired yet has no statistics.
+        :param mailing:
+        :param counts:
+        :param current_datetime:
+        :return:
+        """
+        states = counts.get(mailing.mailing_id, {}) if mailing.expiry_date <= current_datetime else {}
+        return ShowStatisticsByMailing.from_db(
+            mailing,
+            delivered_count=states.get(MessageStates.DELIVERED.value, 0),
+            undelivered_count=states.get(MessageStates.UNDELIVERED.value, 0),
+        )
+
+    @staticmethod
+    def _counting_statistics_by_mailings(mailings: list[Mailing], counts: MessagesCounts) -> MailingStats:
         """
         Packs a mailing list and counts statistics.
         :param mailings:
+        :param counts:
         :return:
         """
         current_datetime = get_current_date()
@@ -202,8 +231,8 @@ class MailingDAL(BaseDAL):
             mailings=[]
         )
 
-        async for mailing in async_generator(mailings):
-            statistics = await MailingDAL(create_db_session()).get_statistics_by_mailing(mailing.customer_id)
+        for mailing in mailings:
+            statistics = MailingDAL._pack_statistics_by_mailing(mailing, counts, current_datetime)
 
             if mailing.expiry_date < current_datetime:
                 result.completed_mailings_count += 1
@@ -212,23 +241,5 @@ class MailingDAL(BaseDAL):
 
             result.total_delivered_messages += statistics.delivered_count
             result.total_undelivered_messages += statistics.undelivered_count
-            result.mailings.append(ShowStatisticsByMailing(**statistics.__dict__))
+            result.mailings.append(statistics)
         return result
-
-    @staticmethod
-    async def _split_messages_by_states(mailing: Mailing) -> MessagesListsByStates:
-        """
-        Divides the mailing list by state.
-        :param mailing:
-        :return:
-        """
-        messages = MailingDAL.MessagesListsByStates(
-            delivered_messages=ShowMessages(messages=[]),
-            undelivered_messages=ShowMessages(messages=[])
-        )
-        async for message in async_generator(mailing.messages):
-            if message.status == MessageStates.DELIVERED.value:
-                messages.delivered_messages.messages.append(ShowMessage(**message.__dict__))
-            else:
-                messages.undelivered_messages.messages.append(ShowMessage(**message.__dict__))
-        return messages
@@ -1,26 +1,52 @@
+import asyncio
+import collections
 import datetime
 import logging
+import time
 import uuid
-from typing import Generator
+import weakref
+from typing import AsyncIterator, Generator, Mapping, Sequence
 
-import aiohttp as aiohttp
-from sqlalchemy import select
+import aiohttp
+from sqlalchemy import select, update, Select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Row
 
+from repository.http_client import get_http_session
+from repository.redis_client import get_redis
 from repository.session import create_db_session
-from services.dals import BaseDAL, ResponseCode
+from services.checkpoint import CheckpointDAL, FULL_RANGE
+from services.counter import CounterDAL
+from services.dals import (
+    BaseDAL,
+    ResponseCode,
+    MAILING_COMPLETED,
+    MAILING_COMPLETED_WITH_ERRORS,
+    MAILING_EXPIRED,
+    MAILING_OVERWRITTEN,
+    MAILING_SCHEDULED,
+    MAILING_WINDOW_CLOSED
+)
 from settings import settings
 from models.db import Message, MessageStates, Customer, Mailing
 
-from utils.async_utils import async_enumerate
-from utils.decorators import catch_exceptions, services_request
-from utils.time_utils import get_current_date
+from utils.async_utils import BoundedTaskPool
+from utils.cache import MESSAGE_NAMESPACE
+from utils.decorators import catch_exceptions, services_request, services_stream, invalidate_cache
+from utils.metrics import count_message, observe_mailing_api_request
+from utils.rate_limit import get_rate_limiter
+from utils.time_utils import get_current_date, get_delivery_window, get_time_zone_delivery_window
 
 
 logger = logging.getLogger("uvicorn")
 
+_worker_semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] = \
+    weakref.WeakKeyDictionary()
+
 
 class MessageDAL(BaseDAL):
     # Describes the business logic of the message.
+    @invalidate_cache(MESSAGE_NAMESPACE)
     @services_request
     @catch_exceptions
     async def create_message(
@@ -45,32 +71,163 @@ class MessageDAL(BaseDAL):
             customer_id=customer_id
         )
         self.db_session.add(new_message)
+        await CounterDAL(self.db_session).increment_counters([{'mailing_id': mailing_id, 'status': status}])
         await self.db_session.commit()
         return new_message
 
+    @invalidate_cache(MESSAGE_NAMESPACE)
+    @services_request
+    @catch_exceptions
+    async def create_messages(self, messages: list[dict]) -> int:
+        """
+        Creates messages in the database with multi-row inserts and updates the counters of their mailings in one
+        transaction.
+        :param messages: Dicts with sending_date, status, mailing_id and customer_id keys
+        :return: Number of created messages
+        """
+        count = await self.insert_messages(messages)
+        await self.db_session.commit()
+        return count
+
+    async def insert_messages(self, messages: list[dict]) -> int:
+        """
+        Inserts messages with multi-row inserts and updates the counters of their mailings without committing, so the
+        caller can add its own changes to the transaction. A message of a customer that already has one in the mailing
+        is skipped and not counted, so a rerun of the mailing never stores or counts a recipient twice.
+        :param messages: Dicts with sending_date, status, mailing_id and customer_id keys
+        :return: Number of inserted messages
+        """
+        if not messages:
+            return 0
+        rows = [
+            {**message, 'status': MessageStates(message['status']).value}
+            for message in messages
+        ]
+        query = (
+            insert(Message)
+            .on_conflict_do_nothing(index_elements=[Message.mailing_id, Message.customer_id])
+            .returning(Message.mailing_id, Message.status)
+        )
+        result = await self.db_session.execute(query, rows)
+        inserted = result.mappings().all()
+        await CounterDAL(self.db_session).increment_counters(inserted)
+        return len(inserted)
+
     @services_request
     @catch_exceptions
     async def get_messages(
             self,
             limit: int = 10,
-            offset: int = 0,
+            after: uuid.UUID | None = None,
             pagination: bool = True
     ) -> Generator[Message, None, None]:
         """
-        Outputs list of message from the database.
+        Outputs list of message from the database ordered by message_id.
+        :param limit:
+        :param after: Last message_id of the previous page
+        :param pagination:
         :return:
         """
+        query = select(Message).order_by(Message.message_id)
+        if after is not None:
+            query = query.where(Message.message_id > after)
         if pagination:
-            messages = await self.db_session.execute(select(Message).limit(limit).offset(offset))
-        else:
-            messages = await self.db_session.execute(select(Message))
+            query = query.limit(limit)
+        messages = await self.db_session.execute(query)
         return (item for item in messages.scalars())
 
+    @services_stream
+    async def stream_messages(
+            self,
+            mailing_id: uuid.UUID | None = None,
+            status: MessageStates | None = None,
+            date_from: datetime.datetime | None = None,
+            date_to: datetime.datetime | None = None
+    ) -> AsyncIterator[Mapping]:
+        """
+        Outputs messages through a server-side cursor ordered by message_id.
+        :param mailing_id:
+        :param status:
+        :param date_from: Outputs only messages sent at or after this date if passed
+        :param date_to: Outputs only messages sent before this date if passed
+        :return: Messages mappings
+        """
+        query = select(
+            Message.message_id,
+            Message.sending_date,
+            Message.status,
+            Message.mailing_id,
+            Message.customer_id
+        )
+        query = MessageDAL._filter_messages(query, mailing_id, status, date_from, date_to)
+        query = query.order_by(Message.message_id).execution_options(yield_per=settings.EXPORT_YIELD_PER)
+        result = await self.db_session.stream(query)
+        async for message in result.mappings():
+            yield message
+
+    @services_stream
+    async def stream_mailing_results(
+            self,
+            mailing_id: uuid.UUID,
+            status: MessageStates | None = None
+    ) -> AsyncIterator[Mapping]:
+        """
+        Outputs delivery results of the mailing with the phones of customers through a server-side cursor.
+        :param mailing_id:
+        :param status:
+        :return: Results mappings
+        """
+        query = (
+            select(
+                Message.message_id,
+                Message.customer_id,
+                Customer.phone,
+                Customer.code,
+                Message.status,
+                Message.sending_date
+            )
+            .join(Customer, Customer.customer_id == Message.customer_id)
+        )
+        query = MessageDAL._filter_messages(query, mailing_id, status)
+        query = query.order_by(Message.message_id).execution_options(yield_per=settings.EXPORT_YIELD_PER)
+        result = await self.db_session.stream(query)
+        async for message in result.mappings():
+            yield message
+
+    @staticmethod
+    def _filter_messages(
+            query: Select,
+            mailing_id: uuid.UUID | None = None,
+            status: MessageStates | None = None,
+            date_from: datetime.datetime | None = None,
+            date_to: datetime.datetime | None = None
+    ) -> Select:
+        """
+        Adds the passed filters to the messages query.
+        :param query:
+        :param mailing_id:
+        :param status:
+        :param date_from:
+        :param date_to:
+        :return:
+        """
+        if mailing_id is not None:
+            query = query.where(Message.mailing_id == mailing_id)
+        if status is not None:
+            query = query.where(Message.status == status.value)
+        if date_from is not None:
+            query = query.where(Message.sending_date >= date_from)
+        if date_to is not None:
+            query = query.where(Message.sending_date < date_to)
+        return query
+
     @staticmethod
     @catch_exceptions
     async def send_message(id: int, message: str, phone: int) -> tuple[int, str]:
         """
-        Opens a session with an external API to send a message. Sends a request to send a message to the customer.
+        Sends a request to send a message to the customer through the shared session of the external API. Responses
+        with an error status raise aiohttp.ClientResponseError. The latency and the status of the request are recorded
+        in the metrics.
         :param id:
         :param message:
         :param phone:
@@ -82,18 +239,35 @@ class MessageDAL(BaseDAL):
             "phone": phone,
             "text": message
         }
-        session_timeout = aiohttp.ClientTimeout(total=None, sock_connect=settings.TIMEOUT, sock_read=settings.TIMEOUT)
-        async with aiohttp.ClientSession(timeout=session_timeout) as session:
-            async with session.post(url=url, data=data) as resp:
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            async with get_http_session().post(url=url, json=data) as resp:
+                status = resp.status
                 return resp.status, await resp.text()
+        except aiohttp.ClientResponseError as e:
+            status = e.status
+            raise
+        finally:
+            observe_mailing_api_request(started, status)
 
     @staticmethod
     @catch_exceptions
-    async def send_messages(mailing_id: uuid.UUID) -> ResponseCode:
+    async def send_messages(
+            mailing_id: uuid.UUID,
+            lower: uuid.UUID | None = None,
+            upper: uuid.UUID | None = None,
+            utc_offset_min: int | None = None
+    ) -> ResponseCode:
         """
         Retrieves the mailing from the database by customer_id. Gets a list of customers that match the filters from the
-        database.
+        database. The run resumes after the checkpoint of its range and skips the customers that already have a
+        message of the mailing, so a redelivered run sends only to the remaining customers.
         :param mailing_id:
+        :param lower: Sends only to customers with customer_id greater or equal to it if passed
+        :param upper: Sends only to customers with customer_id less than it if passed
+        :param utc_offset_min: Sends only to customers with this UTC offset, until their delivery window closes, if
+        passed
         :return:
         """
         from services.mailing import MailingDAL
@@ -102,54 +276,580 @@ class MessageDAL(BaseDAL):
         mailing = await MailingDAL(create_db_session()).get_mailing_by_id(mailing_id)
 
         if mailing.start_date > get_current_date():
-            return ResponseCode(code=410, message='The task is overwritten.')
+            return MAILING_OVERWRITTEN
 
-        customers = await CustomerDAL(create_db_session()).get_customers_by_filter(filters=mailing.filters)
-        with_errors = await MessageDAL._start_mailing(customers, mailing)
+        window_end = None
+        if utc_offset_min is not None and mailing.send_from_hour is not None:
+            window_start, window_end = get_delivery_window(
+                get_current_date(),
+                utc_offset_min,
+                mailing.send_from_hour,
+                mailing.send_to_hour
+            )
+            if window_start > get_current_date():
+                return MAILING_WINDOW_CLOSED
+
+        range_start = lower or FULL_RANGE
+        checkpoint = await CheckpointDAL(create_db_session()).get_checkpoint(
+            mailing_id,
+            range_start,
+            utc_offset_min or 0
+        )
+        if checkpoint is not None:
+            logger.info(f'Mailing {mailing_id} is resumed after customer {checkpoint}.')
+        chunks = CustomerDAL.iter_customer_chunks_by_filter(
+            filters=mailing.filters,
+            lower=lower,
+            upper=upper,
+            after=checkpoint,
+            exclude_mailing_id=mailing_id,
+            utc_offset_min=utc_offset_min
+        )
+        with_errors = await MessageDAL._start_mailing(chunks, mailing, range_start, utc_offset_min or 0, window_end)
+
+        if isinstance(with_errors, ResponseCode):
+            return with_errors
 
         if with_errors:
-            return ResponseCode(code=200, message='Mailing completed successfully, but with errors.')
+            return MAILING_COMPLETED_WITH_ERRORS
 
-        return ResponseCode(code=200, message='Mailing successfully completed')
+        return MAILING_COMPLETED
 
     @staticmethod
-    async def _start_mailing(customers: Generator[Customer, None, None], mailing: Mailing) -> bool:
+    @catch_exceptions
+    async def split_mailing(mailing_id: uuid.UUID) -> ResponseCode | list[tuple[uuid.UUID, uuid.UUID | None]]:
         """
-        Starts an enumeration of messages in the customers list. After sending the message it creates a message in the
-        database. If the date from mailing.expiry_date becomes less than current time while the customers list is being
-        searched, the mailing is terminated prematurely.
-        :param customers:
+        Splits the customers of the mailing into customer_id ranges for parallel sending.
+        :param mailing_id:
+        :return: Ranges of customer_id or the response if the mailing is not to be sent
+        """
+        from services.mailing import MailingDAL
+        from services.customer import CustomerDAL
+
+        mailing = await MailingDAL(create_db_session()).get_mailing_by_id(mailing_id)
+
+        if mailing.start_date > get_current_date():
+            return MAILING_OVERWRITTEN
+
+        return await CustomerDAL(create_db_session()).get_customer_ranges_by_filter(filters=mailing.filters)
+
+    @staticmethod
+    @catch_exceptions
+    async def split_mailing_by_time_zones(
+            mailing_id: uuid.UUID,
+            utc_offset_min: int | None = None
+    ) -> ResponseCode | list[tuple[int, datetime.datetime]] | None:
+        """
+        Buckets the customers of the mailing by the UTC offset their time zones have when their delivery windows open,
+        with one grouped query, and finds the delivery window of each bucket. The offsets of time zones with daylight
+        saving time are recomputed on every split and stored offsets which have changed are updated, so the customers
+        are sent within their local window all year. Buckets whose window opens after the mailing expires are dropped.
+        :param mailing_id:
+        :param utc_offset_min: Buckets only the customers stored with this UTC offset if passed, e.g. the rest of a
+        bucket whose window has closed
+        :return: UTC offsets with the start of their windows in UTC, in the past if the window is open, None if the
+        mailing has no delivery window or the response if the mailing is not to be sent
+        """
+        from services.mailing import MailingDAL
+        from services.customer import CustomerDAL
+
+        mailing = await MailingDAL(create_db_session()).get_mailing_by_id(mailing_id)
+
+        if mailing.start_date > get_current_date():
+            return MAILING_OVERWRITTEN
+
+        if mailing.send_from_hour is None:
+            return None
+
+        now = get_current_date()
+        time_zones = await CustomerDAL(create_db_session()).get_time_zones_by_filter(filters=mailing.filters)
+        buckets: dict[int, datetime.datetime] = {}
+        changed_utc_offsets: dict[str, int] = {}
+        for time_zone, stored_utc_offset_min in time_zones:
+            if utc_offset_min is not None and stored_utc_offset_min != utc_offset_min:
+                continue
+            window_utc_offset_min, window_start, _ = get_time_zone_delivery_window(
+                now,
+                time_zone,
+                mailing.send_from_hour,
+                mailing.send_to_hour
+            )
+            if window_utc_offset_min != stored_utc_offset_min and time_zone is not None:
+                changed_utc_offsets[time_zone] = window_utc_offset_min
+            if window_start < mailing.expiry_date:
+                buckets[window_utc_offset_min] = window_start
+
+        if changed_utc_offsets:
+            count = await CustomerDAL(create_db_session()).update_utc_offsets(mailing.filters, changed_utc_offsets)
+            logger.info(f'Mailing {mailing_id}: UTC offsets of {count} customers are updated.')
+        return sorted(buckets.items())
+
+    @services_request
+    @catch_exceptions
+    async def claim_retry_batch(
+            self,
+            mailing: Mailing,
+            attempt: int,
+            round_started: datetime.datetime,
+            utc_offsets: list[int] | None = None,
+            limit: int = settings.OUTBOX_BATCH_SIZE
+    ) -> Sequence[Row]:
+        """
+        Claims a batch of undelivered messages of the mailing with no more than attempt attempts by counting the new
+        attempt in a short transaction. The messages are picked with FOR UPDATE SKIP LOCKED, so concurrent retries
+        never claim the same message, and only if they are not sent since the round has started, so a message is sent
+        once per round.
         :param mailing:
+        :param attempt: Number of the retry round
+        :param round_started: Start of the retry round
+        :param utc_offsets: Claims only the messages of the customers with these UTC offsets if passed
+        :param limit:
+        :return: Claimed messages with message_id, customer_id, phone and code
+        """
+        claimable = (
+            select(Message.message_id)
+            .where(
+                Message.mailing_id == mailing.mailing_id,
+                Message.status == MessageStates.UNDELIVERED.value,
+                Message.attempts <= attempt,
+                Message.attempts < settings.MESSAGE_MAX_ATTEMPTS,
+                Message.sending_date < round_started,
+            )
+            .order_by(Message.message_id)
+            .limit(limit)
+            .with_for_update(of=Message, skip_locked=True)
+        )
+        if utc_offsets is not None:
+            claimable = (
+                claimable
+                .join(Customer, Customer.customer_id == Message.customer_id)
+                .where(Customer.utc_offset_min.in_(utc_offsets))
+            )
+        result = await self.db_session.execute(
+            update(Message)
+            .where(Message.message_id.in_(claimable), Customer.customer_id == Message.customer_id)
+            .values(attempts=Message.attempts + 1, sending_date=get_current_date())
+            .returning(Message.message_id, Message.customer_id, Customer.phone, Customer.code)
+            .execution_options(synchronize_session=False)
+        )
+        messages = result.all()
+        await self.db_session.commit()
+        return messages
+
+    @invalidate_cache(MESSAGE_NAMESPACE)
+    @services_request
+    @catch_exceptions
+    async def complete_retry_batch(
+            self,
+            mailing_id: uuid.UUID,
+            delivered_ids: list[uuid.UUID],
+            released_ids: list[uuid.UUID]
+    ) -> None:
+        """
+        Marks the delivered messages together with the counters and takes back the attempt of the messages which are
+        not sent in one transaction.
+        :param mailing_id:
+        :param delivered_ids: message_id of the delivered messages
+        :param released_ids: message_id of the claimed messages which are not sent
         :return:
         """
-        with_errors = False
-        async for id, customer in async_enumerate(customers):
-            message_dal = MessageDAL(create_db_session())
-            current_date = get_current_date()
-            if mailing.expiry_date < current_date:
-                return ResponseCode(code=408, message='Mailing deadline expired')
+        if delivered_ids:
+            await self.db_session.execute(
+                update(Message)
+                .where(Message.message_id.in_(delivered_ids))
+                .values(status=MessageStates.DELIVERED.value)
+                .execution_options(synchronize_session=False)
+            )
+            await CounterDAL(self.db_session).move_to_delivered({mailing_id: len(delivered_ids)})
+        if released_ids:
+            await self.db_session.execute(
+                update(Message)
+                .where(Message.message_id.in_(released_ids))
+                .values(attempts=Message.attempts - 1)
+                .execution_options(synchronize_session=False)
+            )
+        await self.db_session.commit()
+
+    @staticmethod
+    async def retry_batch(
+            mailing: Mailing,
+            attempt: int,
+            round_started: datetime.datetime,
+            utc_offsets: list[int] | None = None,
+            limit: int = settings.OUTBOX_BATCH_SIZE
+    ) -> int:
+        """
+        Claims a batch of undelivered messages, sends them again with no transaction open and marks the delivered
+        ones. No connection is held while the batch is sent. The attempt of the messages which are not sent, because
+        the mailing has expired or the batch has failed, is taken back, and the delivered ones are marked even if the
+        batch fails.
+        :param mailing:
+        :param attempt: Number of the retry round
+        :param round_started: Start of the retry round
+        :param utc_offsets: Retries only the messages of the customers with these UTC offsets if passed
+        :param limit:
+        :return: Number of claimed messages
+        """
+        messages = await MessageDAL(create_db_session()).claim_retry_batch(
+            mailing,
+            attempt,
+            round_started,
+            utc_offsets,
+            limit
+        )
+
+        delivered_ids, sent_ids = [], set()
+
+        async def dispatch(id: int, message: Row) -> None:
+            status = await MessageDAL.send_to_customer(id, message, mailing)
+            if status is None:
+                return
+            sent_ids.add(message.message_id)
+            if status is MessageStates.DELIVERED:
+                delivered_ids.append(message.message_id)
+
+        try:
+            async with BoundedTaskPool(settings.MAILING_CONCURRENCY) as pool:
+                for id, message in enumerate(messages):
+                    if pool.failed:
+                        break
+                    await pool.spawn(dispatch, id, message)
+        finally:
+            released_ids = [message.message_id for message in messages if message.message_id not in sent_ids]
+            await MessageDAL(create_db_session()).complete_retry_batch(mailing.mailing_id, delivered_ids, released_ids)
+        return len(messages)
+
+    @services_request
+    @catch_exceptions
+    async def has_retryable_messages(self, mailing_id: uuid.UUID) -> bool:
+        """
+        Checks whether the mailing has undelivered messages with attempts left.
+        :param mailing_id:
+        :return:
+        """
+        result = await self.db_session.execute(
+            select(Message.message_id)
+            .where(
+                Message.mailing_id == mailing_id,
+                Message.status == MessageStates.UNDELIVERED.value,
+                Message.attempts < settings.MESSAGE_MAX_ATTEMPTS,
+            )
+            .limit(1)
+        )
+        return result.first() is not None
+
+    @services_request
+    @catch_exceptions
+    async def get_retryable_utc_offsets(self, mailing_id: uuid.UUID) -> list[int]:
+        """
+        Outputs the UTC offsets of the customers with undelivered messages of the mailing with attempts left.
+        :param mailing_id:
+        :return:
+        """
+        result = await self.db_session.execute(
+            select(Customer.utc_offset_min)
+            .join(Message, Message.customer_id == Customer.customer_id)
+            .where(
+                Message.mailing_id == mailing_id,
+                Message.status == MessageStates.UNDELIVERED.value,
+                Message.attempts < settings.MESSAGE_MAX_ATTEMPTS,
+            )
+            .distinct()
+        )
+        return list(result.scalars())
+
+    @staticmethod
+    @catch_exceptions
+    async def get_retry_window_start(mailing_id: uuid.UUID) -> datetime.datetime | None:
+        """
+        Finds when the next retry round of a mailing with a delivery window can send: if no customer with retryable
+        messages is within their window, the round waits for the first window to open.
+        :param mailing_id:
+        :return: Start of the first window in UTC or None if the round can send now
+        """
+        from services.mailing import MailingDAL
+
+        mailing = await MailingDAL(create_db_session()).get_mailing_by_id(mailing_id)
+        if mailing.send_from_hour is None:
+            return None
+        now = get_current_date()
+        utc_offsets = await MessageDAL(create_db_session()).get_retryable_utc_offsets(mailing_id)
+        window_starts = [
+            get_delivery_window(now, utc_offset_min, mailing.send_from_hour, mailing.send_to_hour)[0]
+            for utc_offset_min in utc_offsets
+        ]
+        if not window_starts or min(window_starts) <= now:
+            return None
+        return min(window_starts)
+
+    @staticmethod
+    @catch_exceptions
+    async def retry_messages(mailing_id: uuid.UUID, attempt: int) -> ResponseCode:
+        """
+        Runs a retry round of the mailing: sends again, by batches, the undelivered messages with no more than attempt
+        attempts until none of them are left or the mailing has expired. Each message is sent once per round. If the
+        mailing has a delivery window, only the customers within their window are retried, the rest are left to the
+        next rounds.
+        :param mailing_id:
+        :param attempt: Number of the retry round
+        :return:
+        """
+        from services.mailing import MailingDAL
+
+        mailing = await MailingDAL(create_db_session()).get_mailing_by_id(mailing_id)
+        round_started = get_current_date()
+        utc_offsets = None
+        if mailing.send_from_hour is not None:
+            utc_offsets = await MessageDAL(create_db_session()).get_retryable_utc_offsets(mailing_id)
+
+        while True:
+            now = get_current_date()
+            if mailing.expiry_date < now:
+                return MAILING_EXPIRED
+            open_utc_offsets = None
+            if utc_offsets is not None:
+                open_utc_offsets = [
+                    utc_offset_min for utc_offset_min in utc_offsets
+                    if get_delivery_window(now, utc_offset_min, mailing.send_from_hour, mailing.send_to_hour)[0] <= now
+                ]
+                if not open_utc_offsets:
+                    break
+            if not await MessageDAL.retry_batch(mailing, attempt, round_started, open_utc_offsets):
+                break
+
+        if await MessageDAL(create_db_session()).has_retryable_messages(mailing_id):
+            return MAILING_COMPLETED_WITH_ERRORS
+
+        return MAILING_COMPLETED
+
+    @staticmethod
+    def merge_responses(responses: list[ResponseCode]) -> ResponseCode:
+        """
+        Merges the responses of the mailing parts into the response of the whole mailing. The mailing is completed
+        only if every part is completed, otherwise the most severe response of the parts is output, and a response of
+        a part which is not known is output as it is.
+        :param responses:
+        :return:
+        """
+        for response in (
+            MAILING_OVERWRITTEN,
+            MAILING_EXPIRED,
+            MAILING_WINDOW_CLOSED,
+            MAILING_SCHEDULED,
+            MAILING_COMPLETED_WITH_ERRORS
+        ):
+            if response in responses:
+                return response
+        for response in responses:
+            if response != MAILING_COMPLETED:
+                return response
+        return MAILING_COMPLETED
+
+    @staticmethod
+    async def _start_mailing(
+            chunks: AsyncIterator[Sequence[Customer]],
+            mailing: Mailing,
+            range_start: uuid.UUID = FULL_RANGE,
+            utc_offset_min: int = 0,
+            window_end: datetime.datetime | None = None
+    ) -> bool | ResponseCode:
+        """
+        Starts an enumeration of messages in the chunks of customers and sends them concurrently. Customers are
+        consumed lazily, as free slots appear, and the sends of the next chunk start while those of the previous one
+        are in flight. No more than settings.MAILING_CONCURRENCY messages of the mailing and settings.WORKER_CONCURRENCY
+        messages of the worker process are in flight at once. After sending the message it creates a message in the
+        database. The checkpoint of the range is moved to the last customer of a chunk once the messages of the chunk
+        and of all chunks before it are stored, and never past a chunk with a failed or skipped send. If the date from
+        mailing.expiry_date becomes less than current time while the customers list is being searched or before a
+        send, the mailing is terminated prematurely, and if the delivery window closes, it is postponed.
+        :param chunks:
+        :param mailing:
+        :param range_start: Inclusive lower bound of customer_id of the sender
+        :param utc_offset_min: UTC offset bucket of the sender
+        :param window_end: End of the delivery window of the bucket if the mailing has one
+        :return:
+        """
+        with_errors = expired = False
+        id = 0
+        # Chunks after the checkpoint in order, as [number of unstored messages, last customer_id once all its sends
+        # are started].
+        unsaved_chunks: collections.deque[list] = collections.deque()
+
+        async def dispatch(id: int, customer: Customer, chunk: list) -> None:
+            nonlocal with_errors, expired
+            status = await MessageDAL.send_to_customer(id, customer, mailing)
+            if status is None:
+                expired = True
+                return
+            if status is MessageStates.UNDELIVERED:
+                with_errors = True
+            await buffer.add(
+                sending_date=get_current_date(),
+                status=status,
+                mailing_id=mailing.mailing_id,
+                customer_id=customer.customer_id,
+            )
+            chunk[0] -= 1
+
+        async def save_checkpoint() -> None:
+            last_customer_id = None
+            while unsaved_chunks and unsaved_chunks[0][0] == 0 and unsaved_chunks[0][1] is not None:
+                last_customer_id = unsaved_chunks.popleft()[1]
+            if last_customer_id is None:
+                return
+            await buffer.flush()
+            await CheckpointDAL(create_db_session()).save_checkpoint(
+                mailing.mailing_id,
+                last_customer_id,
+                range_start,
+                utc_offset_min
+            )
+
+        async with MessageBuffer() as buffer, BoundedTaskPool(settings.MAILING_CONCURRENCY) as pool:
+            async for customers in chunks:
+                chunk = [0, None]
+                unsaved_chunks.append(chunk)
+                for customer in customers:
+                    if pool.failed:
+                        await pool.join()
+                    if expired or mailing.expiry_date < get_current_date():
+                        await pool.join()
+                        await save_checkpoint()
+                        return MAILING_EXPIRED
+                    if window_end is not None and window_end < get_current_date():
+                        await pool.join()
+                        await save_checkpoint()
+                        return MAILING_WINDOW_CLOSED
+                    chunk[0] += 1
+                    await pool.spawn(dispatch, id, customer, chunk)
+                    id += 1
+                chunk[1] = customers[-1].customer_id
+                await save_checkpoint()
+            await pool.join()
+            await save_checkpoint()
+        if expired:
+            return MAILING_EXPIRED
+        logger.info(f'Mailing {mailing.mailing_id} is completed.')
+        return with_errors
+
+    @staticmethod
+    async def send_to_customer(id: int, customer: Customer, mailing: Mailing) -> MessageStates | None:
+        """
+        Sends the mailing message to the customer within the in-flight limit of the worker process. Waits for the rate
+        limits of the customer operator code and the global one before sending. The state of the message is counted by
+        mailing and operator code in the metrics.
+        :param id: Message id for the external API
+        :param customer:
+        :param mailing:
+        :return: State of the message or None if the mailing has expired before sending
+        """
+        async with _get_worker_semaphore():
+            if settings.RATE_LIMIT_ENABLED:
+                await get_rate_limiter(get_redis()).acquire(customer.code)
+            if mailing.expiry_date < get_current_date():
+                return None
             try:
                 await MessageDAL.send_message(
                     id=id,
                     phone=customer.phone,
                     message=mailing.message,
                 )
-                await message_dal.create_message(
-                    sending_date=get_current_date(),
-                    status=MessageStates.DELIVERED,
-                    mailing_id=mailing.mailing_id,
-                    customer_id=customer.customer_id,
-                )
             except Exception as e:
-                await message_dal.create_message(
-                    sending_date=get_current_date(),
-                    status=MessageStates.UNDELIVERED,
-                    mailing_id=mailing.mailing_id,
-                    customer_id=customer.customer_id,
-                )
-                with_errors = True
                 logger.error(e)
+                status = MessageStates.UNDELIVERED
+            else:
+                status = MessageStates.DELIVERED
             finally:
                 logger.debug(f'Customer {customer.customer_id} received message.')
-        logger.info(f'Mailing {mailing.mailing_id} is completed.')
-        return with_errors
+            count_message(mailing.mailing_id, customer.code, status.value)
+            return status
+
+
+class MessageBuffer:
+    """
+    Collects send outcomes and persists them with MessageDAL.create_messages. A batch is written when it reaches
+    batch_size or every flush_interval_sec seconds. Leaving the context manager always writes the rest, whether the
+    block is completed, returned early, cancelled or failed. Writes are serialized, so once flush returns every message
+    added before it is committed, even if a periodic write was in flight.
+    """
+    __slots__ = ('batch_size', 'flush_interval_sec', '_messages', '_flusher', '_lock')
+
+    def __init__(
+            self,
+            batch_size: int = settings.MESSAGE_BATCH_SIZE,
+            flush_interval_sec: int | float = settings.MESSAGE_FLUSH_INTERVAL_SEC
+    ):
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self._messages: list[dict] = []
+        self._flusher: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    async def add(
+            self,
+            sending_date: datetime,
+            status: MessageStates,
+            mailing_id: uuid.UUID,
+            customer_id: uuid.UUID
+    ) -> None:
+        """
+        Adds a message to the buffer and writes the batch if it is full.
+        :param sending_date:
+        :param status:
+        :param mailing_id:
+        :param customer_id:
+        :return:
+        """
+        self._messages.append({
+            'sending_date': sending_date,
+            'status': status,
+            'mailing_id': mailing_id,
+            'customer_id': customer_id,
+        })
+        if len(self._messages) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Writes the buffered messages to the database after the write in flight, if any. If the write fails, the
+        messages are returned to the buffer.
+        :return:
+        """
+        async with self._lock:
+            if not self._messages:
+                return
+            messages, self._messages = self._messages, []
+            try:
+                await MessageDAL(create_db_session()).create_messages(messages)
+            except BaseException:
+                self._messages[:0] = messages
+                raise
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval_sec)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(e)
+
+    async def __aenter__(self) -> 'MessageBuffer':
+        self._flusher = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._flusher.cancel()
+        await asyncio.shield(self.flush())
+
+
+def _get_worker_semaphore() -> asyncio.Semaphore:
+    """
+    Outputs the semaphore limiting in-flight messages of the worker process. A semaphore is bound to the event loop
+    it is used in, so one is kept per running loop.
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _worker_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _worker_semaphores[loop] = asyncio.Semaphore(settings.WORKER_CONCURRENCY)
+    return semaphore
@@ -0,0 +1,294 @@
+import asyncio
+import datetime
+import logging
+import uuid
+from typing import Sequence
+
+from sqlalchemy import select, update, literal, or_, and_, func
+from sqlalchemy.engine import Row
+from sqlalchemy.dialects.postgresql import insert
+
+from models.db import Customer, Mailing, MailingOutbox, OutboxStates
+from repository.session import create_db_session
+from services.dals import (
+    BaseDAL,
+    ResponseCode,
+    MAILING_COMPLETED,
+    MAILING_COMPLETED_WITH_ERRORS,
+    MAILING_EXPIRED,
+    MAILING_IN_PROGRESS,
+    MAILING_OVERWRITTEN
+)
+from services.message import MessageDAL
+from settings import settings
+from utils.async_utils import BoundedTaskPool
+from utils.cache import MESSAGE_NAMESPACE
+from utils.decorators import catch_exceptions, services_request, invalidate_cache
+from utils.time_utils import get_current_date
+
+
+logger = logging.getLogger("uvicorn")
+
+
+class OutboxDAL(BaseDAL):
+    # Describes the outbox of mailing recipients shared by sender workers.
+    @services_request
+    @catch_exceptions
+    async def materialize_recipients(self, mailing: Mailing) -> int:
+        """
+        Adds all customers matching the mailing filters to the outbox as PENDING with one INSERT ... SELECT. Recipients
+        already in the outbox are kept as they are.
+        :param mailing:
+        :return: Number of added recipients
+        """
+        recipients = select(
+            literal(mailing.mailing_id),
+            Customer.customer_id,
+            Customer.phone,
+            Customer.code
+        ).where(Customer.code == mailing.filters)
+        query = (
+            insert(MailingOutbox)
+            .from_select(['mailing_id', 'customer_id', 'phone', 'code'], recipients)
+            .on_conflict_do_nothing(index_elements=[MailingOutbox.mailing_id, MailingOutbox.customer_id])
+        )
+        result = await self.db_session.execute(query)
+        await self.db_session.commit()
+        return result.rowcount
+
+    @services_request
+    @catch_exceptions
+    async def claim_batch(self, mailing: Mailing, limit: int = settings.OUTBOX_BATCH_SIZE) -> Sequence[Row]:
+        """
+        Claims a batch of PENDING recipients, and of SENDING ones whose lease of settings.OUTBOX_LEASE_SEC has expired
+        (e.g. of a crashed worker), by marking them SENDING in a short transaction. The rows are picked with
+        FOR UPDATE SKIP LOCKED, so concurrent workers never claim the same recipient.
+        :param mailing:
+        :param limit:
+        :return: Claimed recipients with outbox_id, customer_id, phone, code and claimed_at
+        """
+        lease_expired = func.now() - datetime.timedelta(seconds=settings.OUTBOX_LEASE_SEC)
+        claimable = (
+            select(MailingOutbox.outbox_id)
+            .where(
+                MailingOutbox.mailing_id == mailing.mailing_id,
+                or_(
+                    MailingOutbox.state == OutboxStates.PENDING.value,
+                    and_(
+                        MailingOutbox.state == OutboxStates.SENDING.value,
+                        MailingOutbox.claimed_at < lease_expired
+                    ),
+                ),
+            )
+            .order_by(MailingOutbox.outbox_id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        result = await self.db_session.execute(
+            update(MailingOutbox)
+            .where(MailingOutbox.outbox_id.in_(claimable))
+            .values(state=OutboxStates.SENDING.value, claimed_at=func.now())
+            .returning(
+                MailingOutbox.outbox_id,
+                MailingOutbox.customer_id,
+                MailingOutbox.phone,
+                MailingOutbox.code,
+                MailingOutbox.claimed_at
+            )
+            .execution_options(synchronize_session=False)
+        )
+        recipients = result.all()
+        await self.db_session.commit()
+        return recipients
+
+    @invalidate_cache(MESSAGE_NAMESPACE)
+    @services_request
+    @catch_exceptions
+    async def complete_batch(
+            self,
+            messages: list[dict],
+            done_ids: list[int],
+            released_ids: list[int],
+            claimed_at: datetime.datetime | None = None
+    ) -> None:
+        """
+        Marks the sent recipients DONE together with their messages and returns the unsent ones to PENDING in one
+        transaction. Unsent recipients claimed again by another worker after the lease has expired are kept.
+        :param messages: Dicts with sending_date, status, mailing_id and customer_id keys
+        :param done_ids: outbox_id of the sent recipients
+        :param released_ids: outbox_id of the claimed recipients which are not sent
+        :param claimed_at: Time of the claim of the batch
+        :return:
+        """
+        await MessageDAL(self.db_session).insert_messages(messages)
+        if done_ids:
+            await self.db_session.execute(
+                update(MailingOutbox)
+                .where(MailingOutbox.outbox_id.in_(done_ids))
+                .values(state=OutboxStates.DONE.value)
+                .execution_options(synchronize_session=False)
+            )
+        if released_ids:
+            await self.db_session.execute(
+                update(MailingOutbox)
+                .where(
+                    MailingOutbox.outbox_id.in_(released_ids),
+                    MailingOutbox.state == OutboxStates.SENDING.value,
+                    MailingOutbox.claimed_at == claimed_at,
+                )
+                .values(state=OutboxStates.PENDING.value, claimed_at=None)
+                .execution_options(synchronize_session=False)
+            )
+        await self.db_session.commit()
+
+    @services_request
+    @catch_exceptions
+    async def renew_lease(
+            self,
+            outbox_ids: list[int],
+            claimed_at: datetime.datetime
+    ) -> tuple[set[int], datetime.datetime]:
+        """
+        Moves the claim of the batch to now, so it is not claimed again by another worker while it is being sent. Only
+        the recipients still claimed by this claim are renewed.
+        :param outbox_ids: outbox_id of the claimed recipients
+        :param claimed_at: Time of the current claim of the batch
+        :return: outbox_id of the renewed recipients and the time of the new claim
+        """
+        result = await self.db_session.execute(
+            update(MailingOutbox)
+            .where(
+                MailingOutbox.outbox_id.in_(outbox_ids),
+                MailingOutbox.state == OutboxStates.SENDING.value,
+                MailingOutbox.claimed_at == claimed_at,
+            )
+            .values(claimed_at=func.now())
+            .returning(MailingOutbox.outbox_id, MailingOutbox.claimed_at)
+            .execution_options(synchronize_session=False)
+        )
+        rows = result.all()
+        await self.db_session.commit()
+        return {row.outbox_id for row in rows}, rows[0].claimed_at if rows else claimed_at
+
+    @services_request
+    @catch_exceptions
+    async def has_claimed_recipients(self, mailing_id: uuid.UUID) -> bool:
+        """
+        Checks whether recipients of the mailing are claimed and not sent yet.
+        :param mailing_id:
+        :return:
+        """
+        result = await self.db_session.execute(
+            select(MailingOutbox.outbox_id)
+            .where(
+                MailingOutbox.mailing_id == mailing_id,
+                MailingOutbox.state == OutboxStates.SENDING.value,
+            )
+            .limit(1)
+        )
+        return result.first() is not None
+
+    @staticmethod
+    async def send_batch(mailing: Mailing, limit: int = settings.OUTBOX_BATCH_SIZE) -> int:
+        """
+        Claims a batch of recipients, sends them with no transaction open and marks them DONE with their messages. No
+        connection is held while the batch is sent. The lease of the batch is renewed every third of
+        settings.OUTBOX_LEASE_SEC while it is being sent, so a slow batch is not claimed again by another worker, and
+        recipients whose lease is lost anyway are not sent. Recipients which are not sent, because the mailing has
+        expired or their send has failed, are returned to PENDING, and the sent ones are marked even if the batch
+        fails.
+        :param mailing:
+        :param limit:
+        :return: Number of claimed recipients
+        """
+        recipients = await OutboxDAL(create_db_session()).claim_batch(mailing, limit)
+        if not recipients:
+            return 0
+
+        messages, done_ids = [], []
+        leased = {recipient.outbox_id for recipient in recipients}
+        claimed_at = recipients[0].claimed_at
+
+        async def renew_lease() -> None:
+            nonlocal leased, claimed_at
+            while True:
+                await asyncio.sleep(settings.OUTBOX_LEASE_SEC / 3)
+                try:
+                    leased, claimed_at = await OutboxDAL(create_db_session()).renew_lease(sorted(leased), claimed_at)
+                except Exception as e:
+                    logger.error(e)
+
+        async def dispatch(recipient: Row) -> None:
+            if recipient.outbox_id not in leased:
+                return
+            status = await MessageDAL.send_to_customer(recipient.outbox_id, recipient, mailing)
+            if status is None:
+                return
+            done_ids.append(recipient.outbox_id)
+            messages.append({
+                'sending_date': get_current_date(),
+                'status': status,
+                'mailing_id': mailing.mailing_id,
+                'customer_id': recipient.customer_id,
+            })
+
+        renewer = asyncio.create_task(renew_lease())
+        try:
+            async with BoundedTaskPool(settings.MAILING_CONCURRENCY) as pool:
+                for recipient in recipients:
+                    if pool.failed:
+                        break
+                    await pool.spawn(dispatch, recipient)
+        finally:
+            renewer.cancel()
+            done = set(done_ids)
+            released_ids = [recipient.outbox_id for recipient in recipients if recipient.outbox_id not in done]
+            await OutboxDAL(create_db_session()).complete_batch(messages, done_ids, released_ids, claimed_at)
+        return len(recipients)
+
+    @staticmethod
+    @catch_exceptions
+    async def prepare_mailing(mailing_id: uuid.UUID) -> ResponseCode:
+        """
+        Retrieves the mailing from the database and materializes its recipients in the outbox.
+        :param mailing_id:
+        :return:
+        """
+        from services.mailing import MailingDAL
+
+        mailing = await MailingDAL(create_db_session()).get_mailing_by_id(mailing_id)
+
+        if mailing.start_date > get_current_date():
+            return MAILING_OVERWRITTEN
+
+        count = await OutboxDAL(create_db_session()).materialize_recipients(mailing)
+        logger.info(f'Mailing {mailing_id}: {count} recipients are added to the outbox.')
+        return ResponseCode(code=202, message=f'{count} recipients are added to the outbox.')
+
+    @staticmethod
+    @catch_exceptions
+    async def send_mailing(mailing_id: uuid.UUID) -> ResponseCode:
+        """
+        Claims and sends batches of the mailing outbox until it is empty or the mailing has expired. Any number of
+        workers may run it for the same mailing at once. The mailing is completed by the worker which finds no
+        recipients claimed by the others, with errors if any of the workers has left undelivered messages.
+        :param mailing_id:
+        :return:
+        """
+        from services.mailing import MailingDAL
+
+        mailing = await MailingDAL(create_db_session()).get_mailing_by_id(mailing_id)
+
+        while True:
+            if mailing.expiry_date < get_current_date():
+                return MAILING_EXPIRED
+            if not await OutboxDAL.send_batch(mailing):
+                break
+
+        if await OutboxDAL(create_db_session()).has_claimed_recipients(mailing_id):
+            return MAILING_IN_PROGRESS
+
+        if await MessageDAL(create_db_session()).has_retryable_messages(mailing_id):
+            return MAILING_COMPLETED_WITH_ERRORS
+
+        return MAILING_COMPLETED
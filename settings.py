@@ -1,6 +1,7 @@
 import logging
 from datetime import datetime
 import os
+from typing import Literal
 
 import pydantic
 from pydantic import Field
@@ -28,6 +29,11 @@ class Settings(pydantic.BaseSettings):
     DB_NAME: str = Field(default=os.getenv('DB_NAME'))
     DB_USER: str = Field(default=os.getenv('DB_USER'))
     DB_PASS: str = Field(default=os.getenv('DB_PASS'))
+    DB_POOL_SIZE: int = Field(default=10)
+    DB_MAX_OVERFLOW: int = Field(default=20)
+    DB_POOL_RECYCLE_SEC: int = Field(default=1800)
+    DB_POOL_TIMEOUT_SEC: int = Field(default=30)
+    DB_POOL_PRE_PING: bool = Field(default=True)
 
     # Redis
     REDIS_DRIVER: str = Field(default='redis')
@@ -63,19 +69,79 @@ class Settings(pydantic.BaseSettings):
         'Authorization': f'Bearer {os.getenv("AUTH_TOKEN")}',
         'Content-Type': 'application/json',
     })
+    HTTP_CONNECTION_LIMIT: int = Field(default=200)
+    HTTP_CONNECTION_LIMIT_PER_HOST: int = Field(default=100)
+    HTTP_DNS_CACHE_TTL_SEC: int = Field(default=300)
+    HTTP_KEEPALIVE_TIMEOUT_SEC: int = Field(default=30)
+
+    # External mailing API rate limits, can be changed at runtime through /service/rate_limit.
+    RATE_LIMIT_ENABLED: bool = Field(default=True)
+    RATE_LIMIT_GLOBAL_PER_SEC: float = Field(default=100)  # 0 disables the limit
+    RATE_LIMIT_GLOBAL_BURST: int = Field(default=100)
+    RATE_LIMIT_OPERATOR_PER_SEC: float = Field(default=20)  # per operator code, 0 disables the limit
+    RATE_LIMIT_OPERATOR_BURST: int = Field(default=20)
+    RATE_LIMIT_CONFIG_KEY: str = Field(default='rate-limit:config')
+    RATE_LIMIT_KEY_PREFIX: str = Field(default='rate-limit')
 
     # Mailing queue
     MAILING_OFFSET_MIN: int = Field(default=5)
     TIMEOUT: int = Field(default=20)
     LATEST_QUEUE_DATE: datetime = Field(default=get_current_date())
     WAITING_TIME: int = Field(default=5)
-
-    # Cache
-    EXPIRY_TIME_SEC: int = Field(default=60)
+    MAILING_CONCURRENCY: int = Field(default=50)  # in-flight messages per mailing
+    WORKER_CONCURRENCY: int = Field(default=200)  # in-flight messages per worker process
+    MESSAGE_BATCH_SIZE: int = Field(default=500)
+    MESSAGE_FLUSH_INTERVAL_SEC: float = Field(default=1.0)
+    CUSTOMER_CHUNK_SIZE: int = Field(default=1000)
+    COUNTERS_RECONCILE_INTERVAL_SEC: int = Field(default=60 * 60)
+    COUNTERS_RECONCILE_IDLE_SEC: int = Field(default=15 * 60)  # counters of running mailings idle longer are rebuilt
+    COUNTERS_RECONCILE_BATCH_SIZE: int = Field(default=100)  # mailings rebuilt per transaction
+    MAILING_DISPATCH_MODE: Literal['inline', 'outbox', 'chord'] = Field(default='inline')
+    OUTBOX_BATCH_SIZE: int = Field(default=200)
+    OUTBOX_SENDERS: int = Field(default=4)  # sender tasks per mailing
+    OUTBOX_LEASE_SEC: int = Field(default=10 * 60)  # claims not renewed within it are claimed again
+    MESSAGE_MAX_ATTEMPTS: int = Field(default=5)  # including the first one
+    RETRY_BASE_DELAY_SEC: float = Field(default=30)
+    RETRY_MAX_DELAY_SEC: float = Field(default=30 * 60)
+    MAILING_CHUNK_SIZE: int = Field(default=10000)  # customers per chord subtask
+    MAILING_MAX_PARALLEL_CHUNKS: int = Field(default=32)
+    TASK_SCHEDULE_KEY_PREFIX: str = Field(default='task-schedule')  # redis keys scheduling a task once
+
+    # Cache, responses are invalidated by the writes, so the TTL only bounds the memory of the old versions.
+    EXPIRY_TIME_SEC: int = Field(default=60 * 60)
+    CACHE_VERSION_KEY_PREFIX: str = Field(default='cache-version')
+    CACHE_LOCAL_ENABLED: bool = Field(default=True)  # in-process tier in front of redis
+    CACHE_LOCAL_MAX_ITEMS: int = Field(default=1024)
+    CACHE_LOCAL_TTL_SEC: int = Field(default=30)
+    CACHE_INVALIDATION_CHANNEL: str = Field(default='cache-invalidation')
+
+    # Metrics, the API exposes them on /metrics. Celery workers push them to the pushgateway if its url is set, or
+    # expose them on METRICS_WORKER_PORT in the multiprocess mode (PROMETHEUS_MULTIPROC_DIR is set).
+    METRICS_PUSHGATEWAY_URL: str | None = Field(default=None)
+    METRICS_PUSH_JOB: str = Field(default='mailing-worker')
+    METRICS_WORKER_PORT: int | None = Field(default=None)
+
+    # Query instrumentation. Statements slower than the threshold are logged with redacted parameters, and with the
+    # plan of EXPLAIN ANALYZE if it is enabled (reads only, they are run twice). A request or a task running more
+    # statements than its budget is reported as a possible N+1, 0 disables the report.
+    SLOW_QUERY_THRESHOLD_MS: float = Field(default=200)
+    SLOW_QUERY_EXPLAIN: bool = Field(default=False)
+    QUERY_BUDGET_PER_REQUEST: int = Field(default=20)
+    QUERY_BUDGET_PER_TASK: int = Field(default=0)
+
+    # Customer import
+    UPLOAD_CHUNK_SIZE: int = Field(default=1024 * 1024)  # 1MB
+    CUSTOMER_IMPORT_BATCH_SIZE: int = Field(default=5000)
+    CUSTOMER_IMPORT_MAX_ERRORS: int = Field(default=100)
+
+    # Export
+    EXPORT_YIELD_PER: int = Field(default=1000)
+    EXPORT_CHUNK_ROWS: int = Field(default=1000)
 
     # Pagination depends
     PAGINATION_LOW_LIMIT: int = Field(default=1)
-    PAGINATION_HIGH_LIMIT: int = Field(default=10)
+    PAGINATION_HIGH_LIMIT: int = Field(default=1000)
+    PAGINATION_DEFAULT_LIMIT: int = Field(default=10)
 
     @property
     def get_backend_app_attributes(self) -> dict[str, str | bool | None]:
@@ -101,6 +167,26 @@ class Settings(pydantic.BaseSettings):
     def get_db_url(self) -> str:
         return f'{self.DB_DRIVER}://{self.DB_USER}:{self.DB_PASS}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}'
 
+    @property
+    def get_db_pool_attributes(self) -> dict[str, int | bool]:
+        return {
+            'pool_size': self.DB_POOL_SIZE,
+            'max_overflow': self.DB_MAX_OVERFLOW,
+            'pool_recycle': self.DB_POOL_RECYCLE_SEC,
+            'pool_timeout': self.DB_POOL_TIMEOUT_SEC,
+            'pool_pre_ping': self.DB_POOL_PRE_PING,
+        }
+
+    @property
+    def get_http_connector_attributes(self) -> dict[str, int | bool]:
+        return {
+            'limit': self.HTTP_CONNECTION_LIMIT,
+            'limit_per_host': self.HTTP_CONNECTION_LIMIT_PER_HOST,
+            'ttl_dns_cache': self.HTTP_DNS_CACHE_TTL_SEC,
+            'use_dns_cache': True,
+            'keepalive_timeout': self.HTTP_KEEPALIVE_TIMEOUT_SEC,
+        }
+
     @property
     def get_redis_attributes(self) -> dict[str, str | int | bool]:
         return {
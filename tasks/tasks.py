@@ -1,22 +1,393 @@
 import asyncio
+import contextvars
+import datetime
+import logging
+import random
 import uuid
+from typing import Any, Coroutine
 
-from celery import Celery
+from celery import Celery, chord
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, task_prerun, task_postrun
 
-from repository.session import get_session_generator
-from services.dals import ResponseCode
+from repository.http_client import get_http_session, close_http_session
+from repository.redis_client import get_redis, close_redis
+from repository.session import get_engine, dispose_engine, create_db_session
+from services.counter import CounterDAL
+from services.dals import (
+    ResponseCode,
+    MAILING_COMPLETED,
+    MAILING_COMPLETED_WITH_ERRORS,
+    MAILING_EXPIRED,
+    MAILING_IN_PROGRESS,
+    MAILING_WINDOW_CLOSED
+)
 from services.message import MessageDAL
+from services.outbox import OutboxDAL
 from settings import settings
+from utils.db_instrumentation import start_query_scope, finish_query_scope
+from utils.metrics import start_metrics_server, push_metrics, mark_process_dead
+from utils.time_utils import get_current_date
 
 
-celery = Celery('tasks', broker=settings.get_redis_attributes.get('url'))
+logger = logging.getLogger("uvicorn")
+
+celery = Celery(
+    'tasks',
+    broker=settings.get_redis_attributes.get('url'),
+    backend=settings.get_redis_attributes.get('url')
+)
+celery.conf.beat_schedule = {
+    'reconcile-mailing-counters': {
+        'task': 'tasks.tasks.reconcile_mailing_counters',
+        'schedule': settings.COUNTERS_RECONCILE_INTERVAL_SEC,
+    },
+}
+
+
+# The mark of a running retry chain outlives its rounds, in case the chain is lost without removing it.
+RETRY_CHAIN_TTL_SEC = settings.MESSAGE_MAX_ATTEMPTS * (settings.RETRY_MAX_DELAY_SEC + 24 * 60 * 60)
+
+_loop: asyncio.AbstractEventLoop | None = None
+# Query scopes of the running tasks by task_id.
+_query_scopes: dict[str, contextvars.Token] = {}
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Outputs the event loop of the worker process. The loop is created on first use and kept until the process shuts
+    down.
+    :return:
+    """
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
+def run_async(coro: Coroutine) -> Any:
+    """
+    Runs the coroutine in the event loop of the worker process. Connections of the engine pool, the http client and
+    the redis client are bound to the loop they were opened in, so they are reused by every task of the process.
+    :param coro:
+    :return:
+    """
+    return get_event_loop().run_until_complete(coro)
+
+
+async def open_resources() -> None:
+    """
+    Creates the engine, the http client and the redis client in the event loop of the worker process.
+    :return:
+    """
+    get_engine()
+    get_http_session()
+    get_redis()
+
+
+async def release_resources() -> None:
+    """
+    Closes the engine, the http client and the redis client of the worker process.
+    :return:
+    """
+    await dispose_engine()
+    await close_http_session()
+    await close_redis()
+
+
+@worker_init.connect
+def on_worker_init(**kwargs) -> None:
+    """
+    Exposes the metrics of the worker processes from the main worker process in the multiprocess mode.
+    :param kwargs:
+    :return:
+    """
+    start_metrics_server()
+
+
+@task_prerun.connect
+def on_task_prerun(task_id: str, task, **kwargs) -> None:
+    """
+    Starts counting the database statements of the task against settings.QUERY_BUDGET_PER_TASK.
+    :param task_id:
+    :param task:
+    :param kwargs:
+    :return:
+    """
+    _query_scopes[task_id] = start_query_scope(f'Task {task.name}[{task_id}]', settings.QUERY_BUDGET_PER_TASK)
+
+
+@task_postrun.connect
+def on_task_postrun(task_id: str, **kwargs) -> None:
+    """
+    Reports the database statements of the task and pushes the metrics of the worker process after every task if the
+    pushgateway is set.
+    :param task_id:
+    :param kwargs:
+    :return:
+    """
+    token = _query_scopes.pop(task_id, None)
+    if token is not None:
+        finish_query_scope(token)
+    try:
+        push_metrics()
+    except Exception as e:
+        logger.error(e)
+
+
+@worker_process_init.connect
+def on_worker_process_init(**kwargs) -> None:
+    """
+    Creates the event loop of the worker process with its engine, http client and redis client, so tasks do not pay
+    for them.
+    :param kwargs:
+    :return:
+    """
+    run_async(open_resources())
+
+
+@worker_process_shutdown.connect
+def on_worker_process_shutdown(**kwargs) -> None:
+    """
+    Releases the engine, the http client and the redis client of the worker process and closes its event loop at
+    shutdown. In the multiprocess mode of metrics the process is marked as dead.
+    :param kwargs:
+    :return:
+    """
+    global _loop
+    mark_process_dead()
+    if _loop is None or _loop.is_closed():
+        return
+    loop, _loop = _loop, None
+    try:
+        loop.run_until_complete(release_resources())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        loop.close()
 
 
 @celery.task
 def run_mailing(mailing_id: uuid.UUID) -> ResponseCode:
     """
-    Creates a celery task to start the mailing list.
+    Creates a celery task to start the mailing list. In the outbox mode the recipients are materialized in the
+    outbox and settings.OUTBOX_SENDERS sender tasks are started to share them. In the chord mode the customers are
+    split into customer_id ranges sent by parallel subtasks, and their results are merged by a chord callback. A
+    mailing with a delivery window is split into UTC offset buckets instead, each sent when its window opens.
     :param mailing_id:
     :return:
     """
-    return asyncio.run(MessageDAL(get_session_generator()).send_messages(mailing_id))
+    buckets = run_async(MessageDAL.split_mailing_by_time_zones(mailing_id))
+    if isinstance(buckets, ResponseCode):
+        return buckets
+    if buckets is not None:
+        for utc_offset_min, window_start in buckets:
+            schedule_bucket(mailing_id, utc_offset_min, window_start)
+        return ResponseCode(code=202, message=f'Mailing is split into {len(buckets)} time zone buckets.')
+    if settings.MAILING_DISPATCH_MODE == 'chord':
+        ranges = run_async(MessageDAL.split_mailing(mailing_id))
+        if isinstance(ranges, ResponseCode):
+            return ranges
+        if not ranges:
+            return MAILING_COMPLETED
+        chord(
+            send_mailing_chunk.s(mailing_id, lower, upper) for lower, upper in ranges
+        )(merge_mailing_chunks.s(mailing_id))
+        return ResponseCode(code=202, message=f'Mailing is split into {len(ranges)} chunks.')
+    if settings.MAILING_DISPATCH_MODE == 'outbox':
+        response = run_async(OutboxDAL.prepare_mailing(mailing_id))
+        if response.code == 202:
+            for _ in range(settings.OUTBOX_SENDERS):
+                send_outbox.delay(mailing_id)
+        return response
+    return schedule_retry(mailing_id, run_async(MessageDAL.send_messages(mailing_id)))
+
+
+@celery.task
+def send_outbox(mailing_id: uuid.UUID) -> ResponseCode:
+    """
+    Creates a celery task to send the outbox recipients of the mailing. Several tasks may send the same mailing. If
+    recipients are still claimed by other tasks, the outbox is checked again once their lease expires, so the
+    recipients of a crashed task are reclaimed even when no other task is left.
+    :param mailing_id:
+    :return:
+    """
+    response = run_async(OutboxDAL.send_mailing(mailing_id))
+    if response == MAILING_IN_PROGRESS:
+        # The mark expires before the check runs, so the check can schedule the next one.
+        if schedule_once(f'outbox:{mailing_id}', settings.OUTBOX_LEASE_SEC / 2):
+            send_outbox.apply_async(args=(mailing_id,), countdown=settings.OUTBOX_LEASE_SEC)
+        return response
+    return schedule_retry(mailing_id, response)
+
+
+@celery.task
+def reconcile_mailing_counters(mailing_id: uuid.UUID | None = None) -> int:
+    """
+    Creates a celery task to rebuild the mailing counters from the messages, e.g. after a crashed mailing. Without a
+    mailing only the counters of the finished and stale mailings are rebuilt.
+    :param mailing_id: Rebuilds only the counters of this mailing if passed
+    :return: Number of rebuilt counters
+    """
+    return run_async(CounterDAL.reconcile_mailings(mailing_id))
+
+
+@celery.task
+def send_mailing_chunk(
+        mailing_id: uuid.UUID,
+        lower: uuid.UUID | str | None,
+        upper: uuid.UUID | str | None
+) -> ResponseCode:
+    """
+    Creates a celery task to send the mailing to the customers of a customer_id range.
+    :param mailing_id:
+    :param lower: Inclusive lower bound of customer_id
+    :param upper: Exclusive upper bound of customer_id
+    :return:
+    """
+    lower = uuid.UUID(str(lower)) if lower else None
+    upper = uuid.UUID(str(upper)) if upper else None
+    return run_async(MessageDAL.send_messages(mailing_id, lower=lower, upper=upper))
+
+
+@celery.task
+def send_mailing_bucket(mailing_id: uuid.UUID, utc_offset_min: int) -> ResponseCode:
+    """
+    Creates a celery task to send the mailing to the customers with the UTC offset within their delivery window. If
+    the window closes before all of them are sent, the rest is bucketed again, as their offset may change with daylight
+    saving time by the next window, and sent when it opens.
+    :param mailing_id:
+    :param utc_offset_min:
+    :return:
+    """
+    response = run_async(MessageDAL.send_messages(mailing_id, utc_offset_min=utc_offset_min))
+    if response == MAILING_WINDOW_CLOSED:
+        buckets = run_async(MessageDAL.split_mailing_by_time_zones(mailing_id, utc_offset_min))
+        if isinstance(buckets, list):
+            for bucket_utc_offset_min, window_start in buckets:
+                schedule_bucket(mailing_id, bucket_utc_offset_min, window_start)
+        return response
+    return schedule_retry(mailing_id, response)
+
+
+@celery.task
+def merge_mailing_chunks(results: list, mailing_id: uuid.UUID) -> ResponseCode:
+    """
+    Creates a celery task merging the results of the mailing chunks into the result of the mailing. If the delivery
+    window of a chunk has closed, the mailing is run again, so the rest is sent by time zone buckets as their windows
+    open.
+    :param results:
+    :param mailing_id:
+    :return:
+    """
+    response = MessageDAL.merge_responses([ResponseCode(*result) for result in results])
+    logger.info(f'Mailing {mailing_id}: {response.message}')
+    if response == MAILING_WINDOW_CLOSED:
+        run_mailing.delay(mailing_id)
+        return response
+    return schedule_retry(mailing_id, response)
+
+
+@celery.task
+def retry_mailing(mailing_id: uuid.UUID, attempt: int) -> ResponseCode:
+    """
+    Creates a celery task to send again the undelivered messages of the mailing. The next round is scheduled while
+    undelivered messages with attempts left remain. When the chain of rounds ends, the mailing is checked again, so
+    the messages stored meanwhile by other senders start a new chain.
+    :param mailing_id:
+    :param attempt: Number of the retry round
+    :return:
+    """
+    response = run_async(MessageDAL.retry_messages(mailing_id, attempt))
+    logger.info(f'Mailing {mailing_id} retry {attempt}: {response.message}')
+    if response == MAILING_COMPLETED_WITH_ERRORS and attempt + 1 < settings.MESSAGE_MAX_ATTEMPTS:
+        return schedule_retry(mailing_id, response, attempt + 1)
+    unschedule(f'retry:{mailing_id}')
+    if response != MAILING_EXPIRED and run_async(MessageDAL(create_db_session()).has_retryable_messages(mailing_id)):
+        schedule_retry(mailing_id, MAILING_COMPLETED_WITH_ERRORS)
+    return response
+
+
+async def mark_scheduled(key: str, ttl_sec: int | float) -> bool:
+    """
+    Marks the scheduling of a task in redis unless it is already marked, so concurrent callers schedule it once.
+    :param key:
+    :param ttl_sec: Time the mark is kept
+    :return: Whether the mark is set by this call
+    """
+    key = f'{settings.TASK_SCHEDULE_KEY_PREFIX}:{key}'
+    return bool(await get_redis().set(key, 1, nx=True, ex=max(int(ttl_sec), 1)))
+
+
+def schedule_once(key: str, ttl_sec: int | float) -> bool:
+    """
+    Checks whether the task marked by the key is to be scheduled by this caller. If redis fails, the task is
+    scheduled, as running it twice is safer than not running it.
+    :param key:
+    :param ttl_sec: Time the mark is kept
+    :return:
+    """
+    try:
+        return run_async(mark_scheduled(key, ttl_sec))
+    except Exception as e:
+        logger.error(e)
+        return True
+
+
+async def unmark_scheduled(key: str) -> None:
+    """
+    Removes the mark of the scheduling of a task from redis.
+    :param key:
+    :return:
+    """
+    await get_redis().delete(f'{settings.TASK_SCHEDULE_KEY_PREFIX}:{key}')
+
+
+def unschedule(key: str) -> None:
+    """
+    Lets the task marked by the key be scheduled again. If redis fails, the mark expires by itself.
+    :param key:
+    :return:
+    """
+    try:
+        run_async(unmark_scheduled(key))
+    except Exception as e:
+        logger.error(e)
+
+
+def schedule_bucket(mailing_id: uuid.UUID, utc_offset_min: int, window_start: datetime.datetime) -> None:
+    """
+    Schedules the sending of the UTC offset bucket of the mailing when its window opens. A bucket is scheduled once
+    per window, so buckets merged after a change of daylight saving time are not sent twice at once.
+    :param mailing_id:
+    :param utc_offset_min:
+    :param window_start:
+    :return:
+    """
+    ttl_sec = (window_start - get_current_date()).total_seconds() + 24 * 60 * 60
+    if schedule_once(f'bucket:{mailing_id}:{utc_offset_min}:{window_start.isoformat()}', ttl_sec):
+        send_mailing_bucket.apply_async(args=(mailing_id, utc_offset_min), eta=window_start)
+
+
+def schedule_retry(mailing_id: uuid.UUID, response: ResponseCode, attempt: int = 1) -> ResponseCode:
+    """
+    Schedules a retry round of the mailing if it is completed with errors. Rounds are delayed with exponential
+    backoff and jitter, and stop after settings.MESSAGE_MAX_ATTEMPTS attempts or when the mailing expires. A round of
+    a mailing with a delivery window is delayed until a window of its undelivered customers opens. Only one chain of
+    rounds runs per mailing: the first round is scheduled by the first sender completed with errors, and the rounds
+    also retry the messages of the other senders.
+    :param mailing_id:
+    :param response: Response of the previous round
+    :param attempt: Number of the retry round to schedule
+    :return: The response of the previous round
+    """
+    if response != MAILING_COMPLETED_WITH_ERRORS or attempt >= settings.MESSAGE_MAX_ATTEMPTS:
+        return response
+    if attempt == 1 and not schedule_once(f'retry:{mailing_id}', RETRY_CHAIN_TTL_SEC):
+        return response
+    delay = min(settings.RETRY_BASE_DELAY_SEC * 2 ** (attempt - 1), settings.RETRY_MAX_DELAY_SEC)
+    countdown = delay / 2 + random.uniform(0, delay / 2)
+    window_start = run_async(MessageDAL.get_retry_window_start(mailing_id))
+    if isinstance(window_start, datetime.datetime):
+        countdown = max(countdown, (window_start - get_current_date()).total_seconds())
+    retry_mailing.apply_async(args=(mailing_id, attempt), countdown=countdown)
+    return response
@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+import unittest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ImportTest(unittest.TestCase):
+    def assert_imports(self, module: str) -> None:
+        # Each module is imported by a fresh interpreter, so an import cycle is not hidden by modules loaded before.
+        result = subprocess.run(
+            [sys.executable, '-c', f'import {module}'],
+            cwd=ROOT,
+            capture_output=True,
+            text=True
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_imports_main(self):
+        self.assert_imports('main')
+
+    def test_imports_tasks(self):
+        self.assert_imports('tasks.tasks')
@@ -0,0 +1,33 @@
+import unittest
+
+from services.dals import (
+    ResponseCode,
+    MAILING_COMPLETED,
+    MAILING_COMPLETED_WITH_ERRORS,
+    MAILING_EXPIRED,
+    MAILING_OVERWRITTEN,
+    MAILING_SCHEDULED,
+    MAILING_WINDOW_CLOSED
+)
+from services.message import MessageDAL
+
+
+class MergeResponsesTest(unittest.TestCase):
+    def test_completed_only_if_every_part_is_completed(self):
+        self.assertEqual(MessageDAL.merge_responses([MAILING_COMPLETED, MAILING_COMPLETED]), MAILING_COMPLETED)
+        self.assertEqual(
+            MessageDAL.merge_responses([MAILING_COMPLETED, MAILING_COMPLETED_WITH_ERRORS]),
+            MAILING_COMPLETED_WITH_ERRORS
+        )
+
+    def test_postponed_parts_are_not_reported_as_completed(self):
+        for response in (MAILING_WINDOW_CLOSED, MAILING_SCHEDULED, MAILING_OVERWRITTEN, MAILING_EXPIRED):
+            with self.subTest(response=response):
+                self.assertEqual(
+                    MessageDAL.merge_responses([MAILING_COMPLETED, response, MAILING_COMPLETED_WITH_ERRORS]),
+                    response
+                )
+
+    def test_unknown_part_response_is_propagated(self):
+        response = ResponseCode(code=500, message='Chunk has failed.')
+        self.assertEqual(MessageDAL.merge_responses([MAILING_COMPLETED, response]), response)
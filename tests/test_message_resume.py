@@ -0,0 +1,118 @@
+import asyncio
+import datetime
+import functools
+import types
+import unittest
+import uuid
+from unittest import mock
+
+from models.db import MessageStates
+from services.dals import MAILING_EXPIRED
+from services.message import MessageBuffer, MessageDAL
+from utils.time_utils import get_current_date
+
+
+CHUNK_SIZE = 3
+
+
+def make_customer(number: int) -> types.SimpleNamespace:
+    return types.SimpleNamespace(customer_id=uuid.UUID(int=number), phone=79000000000 + number, code=900)
+
+
+class FakeDatabase:
+    """
+    Messages and checkpoint of one mailing run, which survive the crash of the sender.
+    """
+    def __init__(self, customers: list[types.SimpleNamespace]):
+        self.customers = customers
+        self.stored: list[uuid.UUID] = []
+        self.checkpoint: uuid.UUID | None = None
+        self.fail_on: uuid.UUID | None = None
+
+    async def create_messages(self, messages: list[dict]) -> int:
+        # Commits are slower than sends, so periodic flushes and the flushes of the chunks overlap.
+        await asyncio.sleep(0.01)
+        customer_ids = [message['customer_id'] for message in messages]
+        if self.fail_on in customer_ids:
+            raise ConnectionError('Database is gone.')
+        self.stored.extend(customer_ids)
+        return len(messages)
+
+    async def save_checkpoint(self, mailing_id, last_customer_id, range_start, utc_offset_min) -> None:
+        unstored = [
+            customer.customer_id for customer in self.customers
+            if customer.customer_id <= last_customer_id and customer.customer_id not in self.stored
+        ]
+        assert not unstored, f'Checkpoint {last_customer_id} is saved before messages of {unstored} are stored.'
+        if self.checkpoint is None or self.checkpoint < last_customer_id:
+            self.checkpoint = last_customer_id
+
+    async def iter_chunks(self):
+        # Follows CustomerDAL.iter_customer_chunks_by_filter: customers after the checkpoint without a message.
+        customers = [
+            customer for customer in self.customers
+            if (self.checkpoint is None or customer.customer_id > self.checkpoint)
+            and customer.customer_id not in self.stored
+        ]
+        for start in range(0, len(customers), CHUNK_SIZE):
+            yield customers[start:start + CHUNK_SIZE]
+
+
+class MessageResumeTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = FakeDatabase([make_customer(number) for number in range(1, 11)])
+        self.mailing = types.SimpleNamespace(
+            mailing_id=uuid.uuid4(),
+            message='text',
+            expiry_date=get_current_date() + datetime.timedelta(days=1)
+        )
+        checkpoint_dal = mock.Mock()
+        checkpoint_dal.return_value.save_checkpoint = self.db.save_checkpoint
+        for patcher in (
+            mock.patch('services.message.create_db_session'),
+            mock.patch('services.message.CheckpointDAL', checkpoint_dal),
+            mock.patch.object(MessageDAL, 'create_messages', lambda dal, messages: self.db.create_messages(messages)),
+            mock.patch.object(MessageDAL, 'send_to_customer', self.send_to_customer),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    async def send_to_customer(id, customer, mailing) -> MessageStates:
+        await asyncio.sleep(0.001 * (id % 4))
+        return MessageStates.DELIVERED
+
+    async def test_resumes_after_crash_without_skipping_or_repeating_customers(self):
+        self.db.fail_on = uuid.UUID(int=5)
+        with mock.patch('services.message.MessageBuffer', functools.partial(MessageBuffer, 2, 0.005)):
+            with self.assertRaises(ConnectionError):
+                await MessageDAL._start_mailing(self.db.iter_chunks(), self.mailing)
+            self.assertLess(self.db.checkpoint or uuid.UUID(int=0), uuid.UUID(int=5))
+
+            self.db.fail_on = None
+            self.assertFalse(await MessageDAL._start_mailing(self.db.iter_chunks(), self.mailing))
+
+        self.assertCountEqual(self.db.stored, [customer.customer_id for customer in self.db.customers])
+        self.assertEqual(self.db.checkpoint, uuid.UUID(int=10))
+
+    async def test_checkpoint_is_not_moved_past_unsent_customers(self):
+        async def expire_on_seventh(id, customer, mailing):
+            if customer.customer_id == uuid.UUID(int=7):
+                self.mailing.expiry_date = get_current_date() - datetime.timedelta(seconds=1)
+                return None
+            return MessageStates.DELIVERED
+
+        with mock.patch.object(MessageDAL, 'send_to_customer', expire_on_seventh):
+            self.assertEqual(await MessageDAL._start_mailing(self.db.iter_chunks(), self.mailing), MAILING_EXPIRED)
+
+        self.assertEqual(self.db.checkpoint, uuid.UUID(int=6))
+        self.assertNotIn(uuid.UUID(int=7), self.db.stored)
+
+    async def test_flush_waits_for_the_write_in_flight(self):
+        buffer = MessageBuffer(batch_size=100, flush_interval_sec=0)
+        async with buffer:
+            await buffer.add(get_current_date(), MessageStates.DELIVERED, self.mailing.mailing_id, uuid.UUID(int=1))
+            # Lets the periodic flush take the message and start writing it.
+            await asyncio.sleep(0.001)
+            await buffer.flush()
+            self.assertEqual(self.db.stored, [uuid.UUID(int=1)])
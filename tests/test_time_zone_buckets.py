@@ -0,0 +1,35 @@
+import unittest
+from unittest import mock
+
+from services.customer import CustomerDAL
+
+
+class UtcOffsetUpdateTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.events = []
+        self.session = mock.AsyncMock()
+        self.session.__aenter__.return_value = self.session
+        self.session.commit.side_effect = lambda: self.events.append('commit')
+        checkpoint_dal = mock.Mock()
+        checkpoint_dal.return_value.reset_bucket_checkpoints = mock.AsyncMock(
+            side_effect=lambda filters, utc_offsets: self.events.append(('reset', filters, sorted(utc_offsets)))
+        )
+        patcher = mock.patch('services.customer.CheckpointDAL', checkpoint_dal)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_checkpointed_bucket_gaining_customers_is_reset_with_the_move(self):
+        # Customers of London move from the bucket of +0 to the checkpointed bucket of +60 when summer time starts.
+        self.session.execute.return_value = mock.Mock(rowcount=3)
+
+        count = await CustomerDAL(self.session).update_utc_offsets(900, {'Europe/London': 60})
+
+        self.assertEqual(count, 3)
+        self.assertEqual(self.events, [('reset', 900, [60]), 'commit'])
+
+    async def test_checkpoints_are_kept_if_no_customer_is_moved(self):
+        self.session.execute.return_value = mock.Mock(rowcount=0)
+
+        await CustomerDAL(self.session).update_utc_offsets(900, {'Europe/London': 60})
+
+        self.assertEqual(self.events, ['commit'])
@@ -1,7 +1,10 @@
 import asyncio
-from typing import Any
+import logging
+from typing import Any, AsyncIterable, Awaitable, Callable
 
 
+logger = logging.getLogger("uvicorn")
+
 async def async_generator(iterable: list | tuple | frozenset | set, sleep_sec: int | float = 0) -> Any:
     """
     Creates an asynchronous generator and outputs a value with a delay between iterations.
@@ -14,13 +17,99 @@ async def async_generator(iterable: list | tuple | frozenset | set, sleep_sec: i
         await asyncio.sleep(sleep_sec)
 
 
-async def async_enumerate(iterable: list | tuple | frozenset | set, sleep_sec: int | float = 0) -> Any:
+async def async_enumerate(
+        iterable: list | tuple | frozenset | set | AsyncIterable,
+        sleep_sec: int | float = 0
+) -> Any:
     """
-    Asynchronous enumerate wrapper.
+    Asynchronous enumerate wrapper. Accepts both synchronous and asynchronous iterables.
     :param iterable:
     :param sleep_sec:
     :return:
     """
+    if isinstance(iterable, AsyncIterable):
+        index = 0
+        async for item in iterable:
+            yield index, item
+            index += 1
+            await asyncio.sleep(sleep_sec)
+        return
     for index, item in enumerate(iterable):
         yield index, item
         await asyncio.sleep(sleep_sec)
+
+
+class BoundedTaskPool:
+    """
+    Runs coroutines concurrently, keeping no more than `limit` of them in flight. `spawn` waits for a free slot, so a
+    producer iterating a large collection is throttled by the pool instead of creating all tasks at once. Exceptions of
+    the tasks are kept and the first one is raised by `join`, so a failed task is never silently dropped.
+    """
+    __slots__ = ('_semaphore', '_tasks', '_errors')
+
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+        self._tasks: set[asyncio.Task] = set()
+        self._errors: list[BaseException] = []
+
+    @property
+    def failed(self) -> bool:
+        """
+        Whether any task has raised an exception not yet raised by `join`.
+        :return:
+        """
+        return bool(self._errors)
+
+    async def spawn(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> asyncio.Task:
+        """
+        Waits for a free slot and schedules func(*args, **kwargs) as a task.
+        :param func: Coroutine function
+        :return: Scheduled task
+        """
+        await self._semaphore.acquire()
+        task = asyncio.create_task(func(*args, **kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_done)
+        return task
+
+    def _on_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self._semaphore.release()
+        if not task.cancelled() and task.exception() is not None:
+            self._errors.append(task.exception())
+
+    async def join(self) -> None:
+        """
+        Waits until all scheduled tasks are finished and raises the first exception of the failed ones.
+        :return:
+        """
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._errors:
+            error, *others = self._errors
+            self._errors = []
+            for other in others:
+                logger.error(f'Task failed: {other!r}')
+            raise error
+
+    def cancel(self) -> None:
+        """
+        Cancels all scheduled tasks.
+        :return:
+        """
+        for task in self._tasks:
+            task.cancel()
+
+    async def __aenter__(self) -> 'BoundedTaskPool':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            await self.join()
+            return
+        # The block has already failed, its exception is raised and the ones of the tasks are only logged.
+        self.cancel()
+        try:
+            await self.join()
+        except Exception as e:
+            logger.error(f'Task failed: {e!r}')
@@ -0,0 +1,324 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi_cache.backends.redis import RedisBackend
+from fastapi_cache.coder import Coder
+from fastapi_cache.key_builder import default_key_builder
+from fastapi_cache.types import Backend
+from starlette.requests import Request
+from starlette.responses import Response
+
+from repository.redis_client import get_redis
+from settings import settings
+
+
+logger = logging.getLogger("uvicorn")
+
+CUSTOMER_NAMESPACE = 'customer'
+MAILING_NAMESPACE = 'mailing'
+MESSAGE_NAMESPACE = 'message'
+
+LOCAL_TIER = 'local'
+REDIS_TIER = 'redis'
+
+
+class ORJSONCoder(Coder):
+    """
+    Coder of fastapi-cache keeping responses as rendered JSON. A cached response is output as it is, without decoding
+    and validating it against the response model again.
+    """
+    @classmethod
+    def encode(cls, value: Any) -> bytes:
+        if isinstance(value, Response):
+            return value.body
+        return orjson.dumps(value, default=jsonable_encoder)
+
+    @classmethod
+    def decode(cls, value: bytes | str) -> Any:
+        return orjson.loads(value)
+
+    @classmethod
+    def decode_as_type(cls, value: bytes | str, *, type_: Any) -> Response:
+        return Response(content=value, media_type='application/json')
+
+
+@dataclass(kw_only=True, slots=True)
+class CacheTierStats:
+    hits: int = 0
+    misses: int = 0
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU cache. Every entry expires after its TTL, and the least recently used entry is dropped when
+    max_items is exceeded.
+    """
+    __slots__ = ('max_items', 'ttl_sec', '_entries')
+
+    def __init__(self, max_items: int = settings.CACHE_LOCAL_MAX_ITEMS, ttl_sec: int = settings.CACHE_LOCAL_TTL_SEC):
+        self.max_items = max_items
+        self.ttl_sec = ttl_sec
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> tuple[int, Any] | None:
+        """
+        Outputs the entry and marks it as recently used.
+        :param key:
+        :return: Seconds left to live and the value, None if there is no such entry or it has expired
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        ttl = expires_at - time.monotonic()
+        if ttl <= 0:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return int(ttl), value
+
+    def set(self, key: str, value: Any, ttl_sec: int | None = None) -> None:
+        """
+        Adds the entry. Its TTL is no longer than the TTL of the cache.
+        :param key:
+        :param value:
+        :param ttl_sec:
+        :return:
+        """
+        ttl_sec = min(ttl_sec or self.ttl_sec, self.ttl_sec)
+        if ttl_sec <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl_sec, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class TwoTierBackend(Backend):
+    """
+    Backend of fastapi-cache reading the in-process tier before redis. Values read from redis are kept in the
+    in-process tier, so repeated reads of hot keys do not leave the process. Keys are versioned, so an entry is not
+    read after the write that makes it stale.
+    """
+    __slots__ = ('redis_backend', 'local')
+
+    def __init__(self, redis_backend: RedisBackend, local: LocalCache | None = None):
+        self.redis_backend = redis_backend
+        self.local = local
+
+    async def get_with_ttl(self, key: str) -> tuple[int, Any]:
+        if self.local is not None:
+            entry = self.local.get(key)
+            _count(LOCAL_TIER, entry is not None)
+            if entry is not None:
+                return entry
+        ttl, value = await self.redis_backend.get_with_ttl(key)
+        _count(REDIS_TIER, value is not None)
+        if value is not None and self.local is not None:
+            self.local.set(key, value, ttl)
+        return ttl, value
+
+    async def get(self, key: str) -> Any:
+        _, value = await self.get_with_ttl(key)
+        return value
+
+    async def set(self, key: str, value: Any, expire: int | None = None) -> None:
+        await self.redis_backend.set(key, value, expire)
+        if self.local is not None:
+            self.local.set(key, value, expire)
+
+    async def clear(self, namespace: str | None = None, key: str | None = None) -> int:
+        if self.local is not None:
+            if key is not None:
+                self.local.delete(key)
+            else:
+                self.local.clear()
+        return await self.redis_backend.clear(namespace, key)
+
+
+_stats: dict[str, CacheTierStats] = {LOCAL_TIER: CacheTierStats(), REDIS_TIER: CacheTierStats()}
+_local_cache: LocalCache | None = None
+# Versions of the namespaces known to the process, trusted only while invalidations are received over pub/sub.
+_local_versions: dict[str, tuple[float, int]] = {}
+_versions_subscribed = False
+_listener: asyncio.Task | None = None
+
+
+def _count(tier: str, hit: bool) -> None:
+    if hit:
+        _stats[tier].hits += 1
+    else:
+        _stats[tier].misses += 1
+
+
+def create_cache_backend() -> Backend:
+    """
+    Creates the backend of fastapi-cache: redis, with the in-process tier in front of it if it is enabled.
+    :return:
+    """
+    global _local_cache
+    _local_cache = LocalCache() if settings.CACHE_LOCAL_ENABLED else None
+    return TwoTierBackend(RedisBackend(get_redis()), _local_cache)
+
+
+def get_cache_stats() -> dict[str, dict[str, int]]:
+    """
+    Outputs hit and miss counters of the cache tiers of the process.
+    :return:
+    """
+    return {
+        LOCAL_TIER: {
+            'hits': _stats[LOCAL_TIER].hits,
+            'misses': _stats[LOCAL_TIER].misses,
+            'size': len(_local_cache) if _local_cache is not None else 0,
+        },
+        REDIS_TIER: {
+            'hits': _stats[REDIS_TIER].hits,
+            'misses': _stats[REDIS_TIER].misses,
+        },
+    }
+
+
+def _get_version_key(namespace: str) -> str:
+    return f'{settings.CACHE_VERSION_KEY_PREFIX}:{namespace}'
+
+
+def _set_local_version(namespace: str, version: int) -> None:
+    _, known_version = _local_versions.get(namespace, (0, 0))
+    _local_versions[namespace] = (time.monotonic() + settings.CACHE_LOCAL_TTL_SEC, max(version, known_version))
+
+
+async def get_cache_versions(*namespaces: str) -> list[int]:
+    """
+    Outputs the current versions of the cache namespaces. While the process receives invalidations, the versions are
+    kept in the process, otherwise they are read from redis with one round trip.
+    :param namespaces:
+    :return:
+    """
+    if _versions_subscribed:
+        now = time.monotonic()
+        entries = [_local_versions.get(namespace) for namespace in namespaces]
+        if all(entry is not None and entry[0] > now for entry in entries):
+            return [version for _, version in entries]
+
+    versions = await get_redis().mget([_get_version_key(namespace) for namespace in namespaces])
+    versions = [int(version or 0) for version in versions]
+    if _versions_subscribed:
+        for namespace, version in zip(namespaces, versions):
+            _set_local_version(namespace, version)
+    return versions
+
+
+async def bump_cache_versions(*namespaces: str) -> None:
+    """
+    Moves the cache namespaces to new versions, so the responses cached under the previous ones are not read anymore
+    and expire by their TTL. The new versions are published to the other processes.
+    :param namespaces:
+    :return:
+    """
+    async with get_redis().pipeline(transaction=False) as pipeline:
+        for namespace in namespaces:
+            pipeline.incr(_get_version_key(namespace))
+        versions = await pipeline.execute()
+    versions = dict(zip(namespaces, versions))
+    for namespace, version in versions.items():
+        _set_local_version(namespace, version)
+    await get_redis().publish(settings.CACHE_INVALIDATION_CHANNEL, json.dumps(versions))
+
+
+async def _listen_invalidations() -> None:
+    """
+    Receives the versions bumped by other processes. The versions known to the process are dropped whenever the
+    subscription is (re)established, as invalidations may have been missed while it was down.
+    :return:
+    """
+    global _versions_subscribed
+    while True:
+        pubsub = get_redis().pubsub()
+        try:
+            await pubsub.subscribe(settings.CACHE_INVALIDATION_CHANNEL)
+            _local_versions.clear()
+            _versions_subscribed = True
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                for namespace, version in json.loads(message['data']).items():
+                    _set_local_version(namespace, int(version))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(e)
+        finally:
+            _versions_subscribed = False
+            await pubsub.close()
+        await asyncio.sleep(1)
+
+
+def start_cache_invalidation_listener() -> None:
+    """
+    Starts receiving the cache invalidations of the other processes, if the in-process tier is enabled.
+    :return:
+    """
+    global _listener
+    if settings.CACHE_LOCAL_ENABLED and _listener is None:
+        _listener = asyncio.create_task(_listen_invalidations())
+
+
+async def stop_cache_invalidation_listener() -> None:
+    """
+    Stops receiving the cache invalidations.
+    :return:
+    """
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.cancel()
+    try:
+        await listener
+    except asyncio.CancelledError:
+        pass
+
+
+def versioned_key_builder(*namespaces: str) -> Callable:
+    """
+    Creates a key builder of fastapi-cache that puts the versions of the namespaces the endpoint reads into the key.
+    The key is built from the path and the query of the request, not from the endpoint arguments, whose sessions and
+    dependencies differ in every request.
+    :param namespaces: Namespaces whose data the endpoint outputs
+    :return:
+    """
+    async def key_builder(
+            func: Callable,
+            namespace: str = '',
+            *,
+            request: Request | None = None,
+            response: Response | None = None,
+            args: tuple,
+            kwargs: dict[str, Any]
+    ) -> str:
+        versions = '.'.join(map(str, await get_cache_versions(*namespaces)))
+        if request is None:
+            return f'{versions}:{default_key_builder(func, namespace, args=args, kwargs=kwargs)}'
+        query = sorted(request.query_params.multi_items())
+        cache_key = hashlib.md5(f'{request.url.path}:{query}'.encode()).hexdigest()
+        return f'{namespace}:{versions}:{cache_key}'
+
+    return key_builder
@@ -0,0 +1,26 @@
+import base64
+import binascii
+import uuid
+
+from fastapi import HTTPException
+
+
+def encode_cursor(key: uuid.UUID) -> str:
+    """
+    Packs the key of the last row of a page into an opaque cursor.
+    :param key:
+    :return:
+    """
+    return base64.urlsafe_b64encode(key.bytes).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor: str) -> uuid.UUID:
+    """
+    Unpacks the key of the last row of a page from the cursor.
+    :param cursor:
+    :return:
+    """
+    try:
+        return uuid.UUID(bytes=base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=422, detail='The pagination cursor is incorrect.')
@@ -0,0 +1,202 @@
+import collections
+import contextvars
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Mapping
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from settings import settings
+from utils.metrics import DB_QUERY_DURATION
+
+
+logger = logging.getLogger("uvicorn")
+
+# Name of the DAL method running the statements, set by utils.decorators.catch_exceptions.
+current_dal_method: contextvars.ContextVar[str | None] = contextvars.ContextVar('current_dal_method', default=None)
+
+UNKNOWN_METHOD = 'unknown'
+STATEMENT_LOG_LENGTH = 500
+
+
+@dataclass(kw_only=True, slots=True)
+class QueryScope:
+    """
+    Statements run by one HTTP request or celery task.
+    """
+    name: str
+    budget: int
+    count: int = 0
+    duration: float = 0
+    statements: collections.Counter = field(default_factory=collections.Counter)
+
+
+_query_scope: contextvars.ContextVar[QueryScope | None] = contextvars.ContextVar('query_scope', default=None)
+
+
+def start_query_scope(name: str, budget: int) -> contextvars.Token:
+    """
+    Starts counting the statements of the request or the task. The scope is inherited by the tasks it creates.
+    :param name: Name of the request or the task
+    :param budget: Number of statements above which an N+1 pattern is reported, 0 disables the report
+    :return: Token to pass to finish_query_scope
+    """
+    return _query_scope.set(QueryScope(name=name, budget=budget))
+
+
+def finish_query_scope(token: contextvars.Token) -> QueryScope | None:
+    """
+    Stops counting the statements of the scope. If it has run more statements than its budget, the most repeated ones
+    are logged with their DAL methods, as that is how an N+1 pattern looks.
+    :param token:
+    :return: Finished scope
+    """
+    scope = _query_scope.get()
+    _query_scope.reset(token)
+    if scope is None:
+        return None
+    if scope.budget and scope.count > scope.budget:
+        repeated = '; '.join(
+            f'{count}x {method}: {_shorten(statement)}'
+            for (method, statement), count in scope.statements.most_common(3)
+        )
+        logger.warning(
+            f'{scope.name} has run {scope.count} queries in {scope.duration * 1000:.1f} ms, over the budget of '
+            f'{scope.budget}. Possible N+1, most repeated: {repeated}'
+        )
+    else:
+        logger.debug(f'{scope.name} has run {scope.count} queries in {scope.duration * 1000:.1f} ms.')
+    return scope
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """
+    Adds the hooks timing every statement of the engine. The time is recorded in db_query_duration_seconds by the
+    DAL method running the statement and counted in the scope of the request or the task. Statements slower than
+    settings.SLOW_QUERY_THRESHOLD_MS are logged with redacted parameters and, if settings.SLOW_QUERY_EXPLAIN, with
+    the plan of EXPLAIN ANALYZE.
+    :param engine:
+    :return:
+    """
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine.sync_engine, 'handle_error', _handle_error)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    duration = time.perf_counter() - conn.info['query_started'].pop()
+    method = current_dal_method.get() or UNKNOWN_METHOD
+    DB_QUERY_DURATION.labels(method).observe(duration)
+
+    scope = _query_scope.get()
+    if scope is not None:
+        scope.count += 1
+        scope.duration += duration
+        scope.statements[(method, statement)] += 1
+
+    if duration * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS:
+        message = (
+            f'Slow query {duration * 1000:.1f} ms in {method}: {_shorten(statement)} '
+            f'parameters: {redact_parameters(parameters, executemany)}'
+        )
+        if settings.SLOW_QUERY_EXPLAIN and _is_explainable(statement, context, executemany):
+            message = f'{message}\n{_explain_analyze(conn, statement, parameters)}'
+        logger.warning(message)
+
+
+def _handle_error(exception_context) -> None:
+    # A failed statement does not reach after_cursor_execute, so its start is dropped here.
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+def redact_parameters(parameters: Any, executemany: bool = False) -> Any:
+    """
+    Hides the values of the statement parameters, keeping their names or number.
+    :param parameters:
+    :param executemany:
+    :return:
+    """
+    if executemany:
+        return f'<{len(parameters)} rows>'
+    if isinstance(parameters, Mapping):
+        return {key: '?' for key in parameters}
+    if isinstance(parameters, (list, tuple)):
+        return ['?'] * len(parameters)
+    return '?'
+
+
+def _is_explainable(statement: str, context, executemany: bool) -> bool:
+    """
+    Checks whether the statement can be run again under EXPLAIN ANALYZE: only single reads, not streamed through a
+    server-side cursor.
+    :param statement:
+    :param context:
+    :param executemany:
+    :return:
+    """
+    if executemany or context is None or context.execution_options.get('stream_results'):
+        return False
+    return statement.lstrip().upper().startswith('SELECT')
+
+
+def _explain_analyze(conn, statement: str, parameters: Any) -> str:
+    """
+    Runs the statement again under EXPLAIN ANALYZE on a separate cursor of the same connection, so the rows of the
+    original statement are kept.
+    :param conn:
+    :param statement:
+    :param parameters:
+    :return: Plan
+    """
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        # A failed EXPLAIN must not abort the transaction of the original statement.
+        cursor.execute('SAVEPOINT explain_analyze')
+        try:
+            cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {statement}', parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT explain_analyze')
+            return f'EXPLAIN ANALYZE failed: {e}'
+        cursor.execute('RELEASE SAVEPOINT explain_analyze')
+        return plan
+    except Exception as e:
+        return f'EXPLAIN ANALYZE failed: {e}'
+    finally:
+        cursor.close()
+
+
+def _shorten(statement: str) -> str:
+    statement = ' '.join(statement.split())
+    if len(statement) > STATEMENT_LOG_LENGTH:
+        return f'{statement[:STATEMENT_LOG_LENGTH]}...'
+    return statement
+
+
+class QueryScopeMiddleware:
+    """
+    ASGI middleware counting the statements of every API request against settings.QUERY_BUDGET_PER_REQUEST.
+    """
+    __slots__ = ('app',)
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        token = start_query_scope(f'{scope["method"]} {scope["path"]}', settings.QUERY_BUDGET_PER_REQUEST)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            finish_query_scope(token)
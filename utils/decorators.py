@@ -1,22 +1,42 @@
+import logging
+import time
+from functools import wraps
 from typing import Any
 
 from fastapi import HTTPException
 from sqlalchemy.exc import NoResultFound, IntegrityError
 
+from utils.cache import bump_cache_versions
+from utils.db_instrumentation import current_dal_method
+from utils.metrics import DAL_CALL_DURATION
+
+
+logger = logging.getLogger("uvicorn")
+
 
 def catch_exceptions(func: Any) -> Any:
     """
-    Decorator for accessing the database. Traps SQL errors.
+    Decorator for accessing the database. Traps SQL errors and records the duration of the call in
+    dal_call_duration_seconds by the name of the method. The statements run by the call are attributed to the method.
     :param func:
     :return: Callable func
     """
+    method = func.__qualname__
+    observe = DAL_CALL_DURATION.labels(method).observe
+
+    @wraps(func)
     async def wrapped(*args, **kwargs):
+        token = current_dal_method.set(method)
+        started = time.perf_counter()
         try:
             return await func(*args, **kwargs)
         except NoResultFound:
             raise HTTPException(status_code=404, detail='No entry found')
         except IntegrityError:
             raise HTTPException(status_code=403, detail='Already taken')
+        finally:
+            observe(time.perf_counter() - started)
+            current_dal_method.reset(token)
     return wrapped
 
 
@@ -26,9 +46,49 @@ def services_request(func: Any) -> Any:
     :param func:
     :return:
     """
+    @wraps(func)
     async def wrapped(self, *args, **kwargs) -> Any:
         async with self.db_session as session:
             self.db_session = session
             return await func(self, *args, **kwargs)
 
     return wrapped
+
+
+def services_stream(func: Any) -> Any:
+    """
+    Creates an asynchronous context manager for accessing the database from an asynchronous generator. The session
+    stays open until the generator is exhausted or closed.
+    :param func:
+    :return:
+    """
+    @wraps(func)
+    async def wrapped(self, *args, **kwargs) -> Any:
+        async with self.db_session as session:
+            self.db_session = session
+            async for item in func(self, *args, **kwargs):
+                yield item
+
+    return wrapped
+
+
+def invalidate_cache(*namespaces: str) -> Any:
+    """
+    Decorator for the DAL methods writing to the database. Bumps the versions of the cache namespaces after the
+    method has completed, so the cached responses of these namespaces are fresh after the write.
+    :param namespaces:
+    :return:
+    """
+    def decorator(func: Any) -> Any:
+        @wraps(func)
+        async def wrapped(*args, **kwargs) -> Any:
+            result = await func(*args, **kwargs)
+            try:
+                await bump_cache_versions(*namespaces)
+            except Exception as e:
+                logger.error(e)
+            return result
+
+        return wrapped
+
+    return decorator
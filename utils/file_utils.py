@@ -0,0 +1,157 @@
+import collections
+import csv
+import enum
+import io
+import json
+from typing import AsyncIterator, Mapping, Sequence
+
+from fastapi import UploadFile
+
+from settings import settings
+
+
+class FileFormats(str, enum.Enum):
+    # Lists the formats of imported and exported files.
+    CSV = 'csv'
+    NDJSON = 'ndjson'
+
+    @property
+    def media_type(self) -> str:
+        return {FileFormats.CSV: 'text/csv', FileFormats.NDJSON: 'application/x-ndjson'}[self]
+
+
+async def iter_upload_lines(
+        file: UploadFile,
+        chunk_size: int = settings.UPLOAD_CHUNK_SIZE,
+        encoding: str = 'utf-8'
+) -> AsyncIterator[str]:
+    """
+    Reads the uploaded file by chunks and outputs it line by line, so no more than one chunk is held in memory.
+    :param file:
+    :param chunk_size: Chunk size in bytes
+    :param encoding:
+    :return: Lines with their line breaks, so quoted CSV fields keep the line breaks they contain
+    """
+    tail = b''
+    while chunk := await file.read(chunk_size):
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield (line + b'\n').decode(encoding)
+    if tail:
+        yield tail.decode(encoding)
+
+
+def _ends_in_quoted_field(line: str, in_quoted_field: bool) -> bool:
+    """
+    Follows the quoting of the default csv dialect through the line: a quote opens a quoted field only at the start
+    of a field, and inside it a doubled quote is a literal one.
+    :param line:
+    :param in_quoted_field: Whether the line starts inside a quoted field
+    :return: Whether the line ends inside a quoted field, i.e. the record goes on in the next line
+    """
+    if '"' not in line:
+        return in_quoted_field
+    field_start, quote_seen = not in_quoted_field, False
+    for char in line:
+        if in_quoted_field:
+            if char == '"':
+                in_quoted_field, quote_seen = False, True
+        elif char == '"' and (field_start or quote_seen):
+            in_quoted_field, field_start, quote_seen = True, False, False
+        else:
+            field_start, quote_seen = char in ',\r\n', False
+    return in_quoted_field
+
+
+class _LineFeed:
+    """
+    Iterator of the lines pushed to it, read by one csv.reader. A record is complete once its last line does not end
+    inside a quoted field, so the reader is never left in the middle of a record.
+    """
+    __slots__ = ('_lines', '_in_quoted_field')
+
+    def __init__(self):
+        self._lines: collections.deque[str] = collections.deque()
+        self._in_quoted_field = False
+
+    def push(self, line: str) -> None:
+        self._lines.append(line)
+        self._in_quoted_field = _ends_in_quoted_field(line, self._in_quoted_field)
+
+    @property
+    def has_lines(self) -> bool:
+        return bool(self._lines)
+
+    @property
+    def has_record(self) -> bool:
+        return self.has_lines and not self._in_quoted_field
+
+    def __iter__(self) -> '_LineFeed':
+        return self
+
+    def __next__(self) -> str:
+        if not self._lines:
+            raise StopIteration
+        return self._lines.popleft()
+
+
+async def iter_csv_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, list[str] | csv.Error]]:
+    """
+    Parses the lines with one csv.reader, so RFC 4180 records with quoted fields spanning several lines are read as
+    one record. Blank records are skipped.
+    :param lines: Lines with their line breaks
+    :return: Number of the first line of the record and its values, or the error if the record is malformed
+    """
+    feed = _LineFeed()
+    reader = csv.reader(feed)
+    async for line in lines:
+        feed.push(line)
+        while feed.has_record:
+            line_number = reader.line_num + 1
+            try:
+                values = next(reader)
+            except csv.Error as e:
+                yield line_number, e
+                continue
+            if any(value.strip() for value in values):
+                yield line_number, values
+    if feed.has_lines:
+        yield reader.line_num + 1, csv.Error('unexpected end of data, a quoted field is not closed')
+
+
+async def serialize_rows(
+        rows: AsyncIterator[Mapping],
+        file_format: FileFormats,
+        fields: Sequence[str],
+        chunk_rows: int = settings.EXPORT_CHUNK_ROWS
+) -> AsyncIterator[str]:
+    """
+    Serializes rows to CSV (with header) or NDJSON. Rows are written by chunks of chunk_rows, so only one chunk is
+    held in memory.
+    :param rows:
+    :param file_format:
+    :param fields: Keys of the rows to output, in order
+    :param chunk_rows:
+    :return: Serialized chunks
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if file_format is FileFormats.CSV:
+        writer.writerow(fields)
+
+    count = 0
+    async for row in rows:
+        if file_format is FileFormats.CSV:
+            writer.writerow([row[field] for field in fields])
+        else:
+            buffer.write(json.dumps({field: row[field] for field in fields}, default=str))
+            buffer.write('\n')
+        count += 1
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
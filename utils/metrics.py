@@ -0,0 +1,206 @@
+import os
+import socket
+import time
+import uuid
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    push_to_gateway,
+    start_http_server,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from settings import settings
+
+
+# Observing a metric costs a label lookup, a lock and an addition, which is negligible next to a request to the
+# external API, so the metrics are kept on the send hot path.
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds',
+    'Latency of the API requests by route.',
+    ['method', 'route', 'status'],
+)
+DAL_CALL_DURATION = Histogram(
+    'dal_call_duration_seconds',
+    'Duration of the DAL method calls.',
+    ['method'],
+)
+DB_QUERY_DURATION = Histogram(
+    'db_query_duration_seconds',
+    'Duration of the database statements by the DAL method running them.',
+    ['method'],
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds',
+    'Time waited for a connection of the engine pool.',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+MAILING_MESSAGES = Counter(
+    'mailing_messages',
+    'Messages sent by mailing, operator code and state.',
+    ['mailing_id', 'code', 'status'],
+)
+MAILING_API_DURATION = Histogram(
+    'mailing_api_request_duration_seconds',
+    'Latency of the external mailing API requests.',
+)
+MAILING_API_RESPONSES = Counter(
+    'mailing_api_responses',
+    'Responses of the external mailing API by status code, error if no response was received.',
+    ['status'],
+)
+
+
+class ProcessStateCollector:
+    """
+    Collects the state of the process at scrape time: connections of the engine pool and reads of the cache tiers.
+    """
+    def describe(self):
+        # Without describe the registry collects once on register, while this module and the ones collect imports
+        # are still loading.
+        return []
+
+    def collect(self):
+        from repository.session import get_pool_status
+        from utils.cache import get_cache_stats
+
+        connections = GaugeMetricFamily('db_pool_connections', 'Connections of the engine pool.', labels=['state'])
+        for state, value in get_pool_status().items():
+            connections.add_metric([state], value)
+        yield connections
+
+        reads = CounterMetricFamily('cache_reads', 'Reads of the cache tiers by result.', labels=['tier', 'result'])
+        hit_ratio = GaugeMetricFamily('cache_hit_ratio', 'Share of the reads served by the tier.', labels=['tier'])
+        for tier, stats in get_cache_stats().items():
+            hits, misses = stats['hits'], stats['misses']
+            reads.add_metric([tier, 'hit'], hits)
+            reads.add_metric([tier, 'miss'], misses)
+            hit_ratio.add_metric([tier], hits / (hits + misses) if hits + misses else 0)
+        yield reads
+        yield hit_ratio
+
+
+_process_state_collector = ProcessStateCollector()
+REGISTRY.register(_process_state_collector)
+
+
+def is_multiprocess() -> bool:
+    return bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+
+def get_registry() -> CollectorRegistry:
+    """
+    Outputs the registry to expose. In the multiprocess mode (PROMETHEUS_MULTIPROC_DIR is set) the metrics of all
+    processes are merged from their files, with the state of the exposing process.
+    :return:
+    """
+    if not is_multiprocess():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(_process_state_collector)
+    return registry
+
+
+def render_metrics() -> bytes:
+    """
+    Outputs the metrics in the Prometheus text format.
+    :return:
+    """
+    return generate_latest(get_registry())
+
+
+def observe_mailing_api_request(started: float, status: int | str) -> None:
+    """
+    Records a request to the external mailing API.
+    :param started: time.perf_counter() before the request
+    :param status: Status code of the response or error
+    :return:
+    """
+    MAILING_API_DURATION.observe(time.perf_counter() - started)
+    MAILING_API_RESPONSES.labels(str(status)).inc()
+
+
+def count_message(mailing_id: uuid.UUID, code: int | None, status: str) -> None:
+    """
+    Records a sent message.
+    :param mailing_id:
+    :param code: Operator code of the customer
+    :param status: State of the message
+    :return:
+    """
+    MAILING_MESSAGES.labels(str(mailing_id), str(code), status).inc()
+
+
+def start_metrics_server() -> None:
+    """
+    Exposes the metrics of the celery worker processes on settings.METRICS_WORKER_PORT. Used in the multiprocess mode,
+    from the main worker process.
+    :return:
+    """
+    if settings.METRICS_WORKER_PORT and is_multiprocess():
+        start_http_server(settings.METRICS_WORKER_PORT, registry=get_registry())
+
+
+def push_metrics() -> None:
+    """
+    Pushes the metrics of the process to settings.METRICS_PUSHGATEWAY_URL, grouped by host and process.
+    :return:
+    """
+    if not settings.METRICS_PUSHGATEWAY_URL:
+        return
+    push_to_gateway(
+        settings.METRICS_PUSHGATEWAY_URL,
+        job=settings.METRICS_PUSH_JOB,
+        registry=REGISTRY,
+        grouping_key={'instance': f'{socket.gethostname()}:{os.getpid()}'},
+    )
+
+
+def mark_process_dead() -> None:
+    """
+    Drops the live gauges of the stopped process in the multiprocess mode.
+    :return:
+    """
+    if is_multiprocess():
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency of the API requests by route template, so the paths with ids and query
+    parameters fall into one series.
+    """
+    __slots__ = ('app',)
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get('route')
+            HTTP_REQUEST_DURATION.labels(
+                scope['method'],
+                route.path if route is not None else 'unmatched',
+                str(status)
+            ).observe(time.perf_counter() - started)
@@ -0,0 +1,124 @@
+import asyncio
+import weakref
+
+from redis import asyncio as aioredis
+
+from settings import settings
+
+
+GLOBAL_LIMIT_NAME = 'global'
+OPERATOR_LIMIT_NAME = 'code'
+
+# GCRA over several keys at once: a token is taken from every key or from none of them. KEYS[1] is the hash with
+# runtime limits, the rest are the keys of the limits. ARGV holds (name, default rate, default burst) per limit key.
+# A limit is looked up in the hash by "<name>:rate" / "<name>:burst", then by the generic name before the last colon,
+# then the default is used. A rate of 0 disables the limit. Outputs 0 if the tokens are taken, otherwise the time to
+# wait in microseconds.
+_GCRA_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+local limits = {}
+local wait = 0
+
+for i = 2, #KEYS do
+    local name = ARGV[(i - 2) * 3 + 1]
+    local generic = string.match(name, '^(.*):[^:]*$') or name
+    local config = redis.call(
+        'HMGET', KEYS[1], name .. ':rate', name .. ':burst', generic .. ':rate', generic .. ':burst'
+    )
+    local rate = tonumber(config[1]) or tonumber(config[3]) or tonumber(ARGV[(i - 2) * 3 + 2])
+    local burst = tonumber(config[2]) or tonumber(config[4]) or tonumber(ARGV[(i - 2) * 3 + 3])
+    if rate > 0 then
+        local interval = 1000000 / rate
+        local tat = math.max(tonumber(redis.call('GET', KEYS[i])) or now, now)
+        local allow_at = tat - (math.max(burst, 1) - 1) * interval
+        if allow_at > now then
+            wait = math.max(wait, allow_at - now)
+        end
+        table.insert(limits, {KEYS[i], tat + interval})
+    end
+end
+
+if wait > 0 then
+    return math.ceil(wait)
+end
+for _, limit in ipairs(limits) do
+    redis.call('SET', limit[1], string.format('%d', limit[2]), 'PX', math.ceil((limit[2] - now) / 1000) + 1000)
+end
+return 0
+"""
+
+
+class RateLimiter:
+    """
+    Distributed limiter of external API requests shared by all processes through redis. Requests are limited by the
+    operator code of the customer and globally. Limits come from settings and can be changed at runtime with
+    set_limit, without restarting the workers.
+    """
+    __slots__ = ('_redis', '_script')
+
+    def __init__(self, redis: aioredis.Redis):
+        self._redis = redis
+        self._script = redis.register_script(_GCRA_SCRIPT)
+
+    async def acquire(self, code: int | None = None) -> None:
+        """
+        Waits until a request to the customer of the operator code is allowed.
+        :param code: Operator code of the customer
+        :return:
+        """
+        names = [GLOBAL_LIMIT_NAME]
+        args = [GLOBAL_LIMIT_NAME, settings.RATE_LIMIT_GLOBAL_PER_SEC, settings.RATE_LIMIT_GLOBAL_BURST]
+        if code is not None:
+            name = f'{OPERATOR_LIMIT_NAME}:{code}'
+            names.append(name)
+            args.extend((name, settings.RATE_LIMIT_OPERATOR_PER_SEC, settings.RATE_LIMIT_OPERATOR_BURST))
+
+        keys = [settings.RATE_LIMIT_CONFIG_KEY, *(f'{settings.RATE_LIMIT_KEY_PREFIX}:{name}' for name in names)]
+        while wait_us := await self._script(keys=keys, args=args):
+            await asyncio.sleep(int(wait_us) / 1_000_000)
+
+    async def set_limit(self, name: str, rate: float, burst: int) -> None:
+        """
+        Changes the limit at runtime for all processes.
+        :param name: 'global', 'code' for every operator or 'code:<code>' for one operator
+        :param rate: Requests per second, 0 disables the limit
+        :param burst: Requests allowed at once
+        :return:
+        """
+        await self._redis.hset(settings.RATE_LIMIT_CONFIG_KEY, mapping={f'{name}:rate': rate, f'{name}:burst': burst})
+
+    async def reset_limit(self, name: str) -> None:
+        """
+        Returns the limit to its value from settings.
+        :param name:
+        :return:
+        """
+        await self._redis.hdel(settings.RATE_LIMIT_CONFIG_KEY, f'{name}:rate', f'{name}:burst')
+
+    async def get_limits(self) -> dict[str, dict[str, float]]:
+        """
+        Outputs the limits changed at runtime.
+        :return:
+        """
+        config = await self._redis.hgetall(settings.RATE_LIMIT_CONFIG_KEY)
+        limits: dict[str, dict[str, float]] = {}
+        for field, value in config.items():
+            name, _, parameter = field.rpartition(':')
+            limits.setdefault(name, {})[parameter] = float(value)
+        return limits
+
+
+_rate_limiters: weakref.WeakKeyDictionary[aioredis.Redis, RateLimiter] = weakref.WeakKeyDictionary()
+
+
+def get_rate_limiter(redis: aioredis.Redis) -> RateLimiter:
+    """
+    Outputs the rate limiter of the redis client, so the script is registered once per client.
+    :param redis:
+    :return:
+    """
+    rate_limiter = _rate_limiters.get(redis)
+    if rate_limiter is None:
+        rate_limiter = _rate_limiters[redis] = RateLimiter(redis)
+    return rate_limiter
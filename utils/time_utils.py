@@ -1,4 +1,9 @@
 import datetime
+import re
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+
+UTC_OFFSET_MATCH_PATTERN = re.compile(r'^(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?$', re.IGNORECASE)
 
 
 def get_current_date() -> datetime:
@@ -7,3 +12,81 @@ def get_current_date() -> datetime:
     :return:
     """
     return datetime.datetime.now(datetime.timezone.utc)
+
+
+def get_utc_offset_min(time_zone: str | None, at: datetime.datetime | None = None) -> int:
+    """
+    Converts the time zone of the customer to its offset from UTC. Offsets like 'UTC+3', '+03:00' and IANA names like
+    'Europe/Moscow' are accepted, an empty or unknown time zone is taken as UTC. The offset of an IANA zone changes
+    with daylight saving time, so it is taken at the passed moment.
+    :param time_zone:
+    :param at: Moment of the offset, now if not passed
+    :return: Offset in minutes
+    """
+    if not time_zone:
+        return 0
+    time_zone = time_zone.strip()
+    match = UTC_OFFSET_MATCH_PATTERN.match(time_zone)
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = int(hours) * 60 + int(minutes or 0)
+        return -offset if sign == '-' else offset
+    try:
+        zone = ZoneInfo(time_zone)
+    except (ZoneInfoNotFoundError, ValueError):
+        return 0
+    return int((at or get_current_date()).astimezone(zone).utcoffset().total_seconds() // 60)
+
+
+def get_delivery_window(
+        now: datetime.datetime,
+        utc_offset_min: int,
+        send_from_hour: int,
+        send_to_hour: int
+) -> tuple[datetime.datetime, datetime.datetime]:
+    """
+    Outputs the delivery window of the customers with the UTC offset which is open now or opens next. The window
+    starts at send_from_hour and ends at send_to_hour of the local time, it passes midnight if send_to_hour is less
+    than send_from_hour and lasts all day if they are equal.
+    :param now:
+    :param utc_offset_min:
+    :param send_from_hour:
+    :param send_to_hour:
+    :return: Start and end of the window in UTC
+    """
+    offset = datetime.timedelta(minutes=utc_offset_min)
+    duration = datetime.timedelta(hours=(send_to_hour - send_from_hour) % 24 or 24)
+    local_now = now.astimezone(datetime.timezone.utc) + offset
+    for days in (-1, 0, 1):
+        start = datetime.datetime.combine(
+            local_now.date() + datetime.timedelta(days=days),
+            datetime.time(send_from_hour),
+            tzinfo=datetime.timezone.utc
+        )
+        if local_now < start + duration:
+            return start - offset, start + duration - offset
+
+
+def get_time_zone_delivery_window(
+        now: datetime.datetime,
+        time_zone: str | None,
+        send_from_hour: int,
+        send_to_hour: int
+) -> tuple[int, datetime.datetime, datetime.datetime]:
+    """
+    Outputs the delivery window of the customers with the time zone which is open now or opens next, with the UTC
+    offset the zone has when the window opens. If daylight saving time starts or ends before the window, the window
+    is moved with it.
+    :param now:
+    :param time_zone:
+    :param send_from_hour:
+    :param send_to_hour:
+    :return: UTC offset in minutes, start and end of the window in UTC
+    """
+    utc_offset_min = get_utc_offset_min(time_zone, now)
+    window_start, window_end = get_delivery_window(now, utc_offset_min, send_from_hour, send_to_hour)
+    window_utc_offset_min = get_utc_offset_min(time_zone, window_start)
+    if window_utc_offset_min != utc_offset_min:
+        utc_offset_min = window_utc_offset_min
+        window_start, window_end = get_delivery_window(now, utc_offset_min, send_from_hour, send_to_hour)
+    return utc_offset_min, window_start, window_end
@@ -10,6 +10,7 @@ from models.db import MessageStates
 
 PHONE_MATCH_PATTERN = re.compile(r'^\d{11}$')
 CODE_MATCH_PATTERN = re.compile(r'^\d{3}$')
+RATE_LIMIT_NAME_MATCH_PATTERN = re.compile(r'^(global|code|code:\d{3})$')
 
 
 def validate_id(value: Any) -> uuid.UUID:
@@ -76,3 +77,36 @@ def validate_datetime(value: Any) -> datetime.datetime:
     if not isinstance(value, datetime.datetime):
         raise HTTPException(status_code=422, detail='The datetime is incorrect')
     return value
+
+
+def validate_rate_limit_name(value: Any) -> str:
+    """
+    Checks the rate limit name for validity.
+    :param value:
+    :return:
+    """
+    if not re.match(RATE_LIMIT_NAME_MATCH_PATTERN, str(value)):
+        raise HTTPException(status_code=422, detail="The rate limit name should be 'global', 'code' or 'code:<code>'")
+    return value
+
+
+def validate_hour(value: Any) -> int | None:
+    """
+    Checks the hour of the day for validity.
+    :param value:
+    :return:
+    """
+    if value is not None and not 0 <= value <= 23:
+        raise HTTPException(status_code=422, detail='The hour should be from 0 to 23')
+    return value
+
+
+def validate_delivery_window(values: dict) -> dict:
+    """
+    Checks that the delivery window hours are passed together.
+    :param values:
+    :return:
+    """
+    if (values.get('send_from_hour') is None) != (values.get('send_to_hour') is None):
+        raise HTTPException(status_code=422, detail='send_from_hour and send_to_hour should be passed together')
+    return values